@@ -0,0 +1,72 @@
+"""Server for the benchmarks: runs PythonServer on the given port or URL (unix:///path, shm://name).
+Usage: python bench_server.py port-or-url [single|multithread|event_loop [codec]]
+Module also provides trivial functions, that are called by the benchmarks.
+"""
+import sys
+import os
+import array
+import resource
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+
+def noop( *args ):
+    """Does nothing: measures pure overhead of the call"""
+    pass
+
+def identity( x ):
+    return x
+
+def cpu_time():
+    """CPU time, used by the server process, in seconds"""
+    times = os.times()
+    return times[0] + times[1]
+
+class Target( object ):
+    """Object, whose attributes are read and set by the benchmarks"""
+    def __init__( self ):
+        self.value = 0
+
+target = Target()
+
+def new_object():
+    """Returns new object, registered for the client: released by the benchmark of MSG_RELEASE_OBJECT"""
+    return Target()
+
+_blobs = {}
+def blob( size, kind="str" ):
+    """Returns cached buffer of the given size and kind: "str", "bytearray" or "array" (of doubles)"""
+    key = (size, kind)
+    if key not in _blobs:
+        if kind == "str":
+            _blobs[key] = "x" * size
+        elif kind == "bytearray":
+            _blobs[key] = bytearray( size )
+        else:
+            _blobs[key] = array.array( "d", [0.0] ) * (size // 8)
+    return _blobs[key]
+
+server = None #PythonServer, when the module is run as the script
+
+def memory_rss():
+    """Resident memory of the server process in bytes (peak resident memory, where /proc is not available)"""
+    try:
+        with open( "/proc/self/statm" ) as statm:
+            return int( statm.read().split()[1] ) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024
+
+def server_state():
+    """Returns resident memory of the server process and the number of the objects, registered for the clients"""
+    return memory_rss(), len( server.objects ) if server is not None else None
+
+if __name__ == "__main__":
+    port = int( sys.argv[1] ) if sys.argv[1].isdigit() else sys.argv[1]
+    mode = sys.argv[2] if len( sys.argv ) > 2 else "single"
+    if len( sys.argv ) > 3:
+        python_remote.set_codec( sys.argv[3] )
+    sys.modules[ "bench_server" ] = sys.modules[ "__main__" ] #Clients import this module: they must see the server
+    server = python_remote.PythonServer( port,
+                                         multithread = (mode == "multithread"),
+                                         event_loop = (mode == "event_loop"),
+                                         are_buffers_local = True )
+    server.start()
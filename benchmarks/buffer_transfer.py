@@ -0,0 +1,44 @@
+"""Time of receiving big buffers from the server (they are sent as out-of-band frames) and of sending them as arguments.
+Usage: python buffer_transfer.py [repetitions [server-mode]]
+"""
+import sys
+import time
+from call_latency import free_port, start_server
+
+SIZES = [ 65536, 1 << 20, 16 << 20 ]
+KINDS = [ "str", "bytearray", "array" ]
+
+def timed( func, repetitions ):
+    """Returns the best time of one call in seconds"""
+    best = None
+    for i in xrange( repetitions ):
+        t0 = time.time()
+        func()
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    repetitions = int( sys.argv[1] ) if len( sys.argv ) > 1 else 20
+    mode = sys.argv[2] if len( sys.argv ) > 2 else "single"
+    far_side, process = start_server( free_port(), mode )
+    try:
+        bench = far_side.import_module( "bench_server" )
+        print "Buffer transfer, server mode: %s"%mode
+        print "%-10s %10s %12s %10s"%("kind", "size", "time", "MB/s")
+        for kind in KINDS:
+            for size in SIZES:
+                bench.blob( size, kind ) #Create it on the server
+                elapsed = timed( lambda: bench.blob( size, kind ), repetitions )
+                print "%-10s %10d %10.3fms %10.1f"%(kind, size, elapsed * 1e3, size / elapsed / 1e6 )
+        for size in SIZES:
+            data = "x" * size
+            elapsed = timed( lambda: bench.noop( data ), repetitions )
+            print "%-10s %10d %10.3fms %10.1f"%("str arg", size, elapsed * 1e3, size / elapsed / 1e6 )
+        far_side.stop_server()
+    finally:
+        process.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Latency of the no-op MSG_CALL: starts bench_server.py in a subprocess and prints latency percentiles.
+Results can be saved and compared with the run of the other revision (e.g. the baseline checkout):
+    python call_latency.py -o before.json          #in the baseline checkout
+    python call_latency.py --compare before.json
+Usage: python call_latency.py [options] [number-of-calls [server-mode]]
+"""
+import sys
+import os
+import time
+import json
+import socket
+import subprocess
+import optparse
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+
+def free_port():
+    s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    s.bind( (socket.gethostname(), 0) )
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server( port, mode="single" ):
+    """Starts benchmark server in a subprocess and returns connected client and the process"""
+    script = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "bench_server.py" )
+    process = subprocess.Popen( [sys.executable, script, str( port ), mode] )
+    deadline = time.time() + 10
+    while True:
+        try:
+            return python_remote.FarSide( socket.gethostname(), port ), process
+        except socket.error:
+            if time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep( 0.05 )
+
+def git_revision():
+    try:
+        return subprocess.Popen( ["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 cwd=os.path.dirname( os.path.abspath( __file__ ) ) ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def percentile( sorted_values, fraction ):
+    return sorted_values[ min( len( sorted_values ) - 1, int( len( sorted_values ) * fraction ) ) ]
+
+def measure( func, count ):
+    """Calls func count times, returns sorted list of latencies in seconds"""
+    timer = time.time
+    latencies = []
+    for i in xrange( count ):
+        t0 = timer()
+        func()
+        latencies.append( timer() - t0 )
+    latencies.sort()
+    return latencies
+
+METRICS = ("p50", "p90", "p99", "pipelined") #Microseconds per call
+
+def compare( report, baseline ):
+    """Prints the results next to the baseline ones, with the relative change"""
+    print "Compared with revision %s (%s server):"%(baseline.get( "revision" ), baseline.get( "mode" ))
+    print "  %-10s %10s %10s %8s"%("", "baseline", "now", "change")
+    for name in METRICS:
+        old, new = baseline[ "latency_us" ][ name ], report[ "latency_us" ][ name ]
+        print "  %-10s %8.1fus %8.1fus %+7.1f%%"%(name, old, new, (new / old - 1) * 100)
+
+def main():
+    parser = optparse.OptionParser( usage="python call_latency.py [options] [number-of-calls [server-mode]]" )
+    parser.add_option( "-o", "--output", help="write JSON report to the file" )
+    parser.add_option( "--compare", metavar="FILE", help="compare with the JSON report of the other revision" )
+    options, args = parser.parse_args()
+    count = int( args[0] ) if len( args ) > 0 else 20000
+    mode = args[1] if len( args ) > 1 else "single"
+    far_side, process = start_server( free_port(), mode )
+    try:
+        noop = far_side.import_module( "bench_server" ).noop
+        measure( noop, min( count, 1000 ) ) #Warm up
+        latencies = measure( noop, count )
+        results = dict( [ (name, percentile( latencies, fraction ) * 1e6)
+                          for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)) ] )
+        print "No-op MSG_CALL, %d calls, server mode: %s"%(count, mode)
+        for name in ("p50", "p90", "p99"):
+            print "  %s: %.1f us"%(name, results[ name ])
+        #Pipelined calls: many requests in flight
+        t0 = time.time()
+        for i in xrange( count // 1000 ):
+            for future in [ noop._async_() for j in xrange( 1000 ) ]:
+                future.result()
+        results[ "pipelined" ] = (time.time() - t0) / (count // 1000 * 1000) * 1e6
+        print "  pipelined: %.1f us per call"%results[ "pipelined" ]
+        far_side.stop_server()
+    finally:
+        process.wait()
+    report = dict( revision=git_revision(), python=sys.version.split()[0], calls=count, mode=mode, latency_us=results )
+    if options.output:
+        with open( options.output, "w" ) as output:
+            json.dump( report, output, indent=1, sort_keys=True )
+    if options.compare:
+        with open( options.compare ) as baseline:
+            compare( report, json.load( baseline ) )
+
+if __name__ == "__main__":
+    main()
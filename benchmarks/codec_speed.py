@@ -0,0 +1,56 @@
+"""Encoding and decoding speed of simple_pickle compared to cPickle, on typical call arguments.
+Usage: python codec_speed.py [repetitions]
+"""
+import sys
+import os
+import time
+import cPickle
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+import simple_pickle
+from python_remote import FarSide, MSG_CALL, OUT_OF_BAND_MIN_SIZE
+
+far_side = FarSide( "tcp://localhost:0", connect=False ) #Only wraps the arguments, as they are wrapped for the server
+target = far_side.get_wrapper( 10 ) #Proxy, passed as the argument
+
+def call_frame( msg_id, args ):
+    """Request frame of the call, as FarSide.call_async sends it: (msg_id, (MSG_CALL, remote ID, wrapped args))"""
+    return (msg_id, (MSG_CALL, 10, far_side.wrap_argument( args )))
+
+SHAPES = [
+    ("no-op call", call_frame( 1, () )),
+    ("call, 3 scalars", call_frame( 2, (1, 2.5, "name") )),
+    ("call, dict", call_frame( 3, ({"x":1, "y":u"text", "z":None},) )),
+    ("call, proxy argument", call_frame( 4, (target, 1) )),
+    ("call, 1000 ints", call_frame( 5, (range(1000),) )),
+    ("call, 1000 floats", call_frame( 6, ([i*0.5 for i in xrange(1000)],) )),
+    ("call, 100 strings", call_frame( 7, (["item%d"%i for i in xrange(100)],) )),
+    #Longer strings are sent as the out-of-band frames, without serialization
+    ("call, 60K string", call_frame( 8, ("x"*(OUT_OF_BAND_MIN_SIZE - 5536),) )),
+    ("call, nested records", call_frame( 9, ([{"id":i, "name":"n%d"%i, "tags":("a","b")} for i in xrange(100)],) )),
+    ]
+
+def timed( func, arg, repetitions ):
+    """Returns time of one call in microseconds"""
+    start = time.time()
+    for i in xrange( repetitions ):
+        func( arg )
+    return (time.time() - start) * 1e6 / repetitions
+
+def main():
+    repetitions = int( sys.argv[1] ) if len( sys.argv ) > 1 else 2000
+    dumps_cpickle = lambda x: cPickle.dumps( x, cPickle.HIGHEST_PROTOCOL )
+    print "%-22s %10s %10s %10s %10s %8s %8s"%("shape", "cPk dump", "sp dump", "cPk load", "sp load", "cPk size", "sp size")
+    for name, message in SHAPES:
+        data_cpickle = dumps_cpickle( message )
+        data_simple = simple_pickle.dumps( message )
+        print "%-22s %8.2fus %8.2fus %8.2fus %8.2fus %8d %8d"%(
+            name,
+            timed( dumps_cpickle, message, repetitions ),
+            timed( simple_pickle.dumps, message, repetitions ),
+            timed( cPickle.loads, data_cpickle, repetitions ),
+            timed( simple_pickle.loads, data_simple, repetitions ),
+            len( data_cpickle ), len( data_simple ) )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Prepared calls compared to the ordinary MSG_CALL: wall time and CPU time of the client and the server per call,
+for the calls with 3 scalar arguments.
+Usage: python prepared_calls.py [number-of-calls]
+"""
+import sys
+import os
+import time
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+from call_latency import free_port, start_server
+from bench_server import cpu_time
+
+def run( name, call, count, server_cpu_time ):
+    """Makes count calls one by one, and then count calls pipelined, printing time per call"""
+    for pipelined in (False, True):
+        wall, client, server = time.time(), cpu_time(), server_cpu_time()
+        if pipelined:
+            for i in xrange( count // 1000 ):
+                for future in [ call._async_( i, j, 0.5 ) for j in xrange( 1000 ) ]:
+                    future.result()
+        else:
+            for i in xrange( count ):
+                call( i, 1, 0.5 )
+        wall, client, server = time.time() - wall, cpu_time() - client, server_cpu_time() - server
+        print "  %-10s %-10s wall %6.1f us, client cpu %6.1f us, server cpu %6.1f us"%(
+            name, "pipelined" if pipelined else "one by one",
+            wall / count * 1e6, client / count * 1e6, server / count * 1e6 )
+
+def main():
+    count = int( sys.argv[1] ) if len( sys.argv ) > 1 else 20000
+    far_side, process = start_server( free_port() )
+    try:
+        bench = far_side.import_module( "bench_server" )
+        noop = bench.noop
+        server_cpu_time = bench.cpu_time
+        prepared = far_side.prepare( noop, (int, int, float) )
+        for i in xrange( 1000 ): #Warm up
+            noop( i, 1, 0.5 )
+            prepared( i, 1, 0.5 )
+        print "Calls with 3 scalar arguments, %d calls"%count
+        run( "MSG_CALL", noop, count, server_cpu_time )
+        run( "prepared", prepared, count, server_cpu_time )
+        far_side.stop_server()
+    finally:
+        process.wait()
+
+if __name__ == "__main__":
+    main()
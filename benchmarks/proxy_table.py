@@ -0,0 +1,58 @@
+"""Client-side cost of many live proxies: memory per proxy, creation and lookup time, full GC time,
+and latency of the no-op call while they are alive.
+Usage: python proxy_table.py [number-of-proxies [number-of-calls]]
+"""
+import sys
+import os
+import gc
+import time
+import resource
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+from call_latency import free_port, start_server, percentile, measure
+
+def resident_memory():
+    """Returns resident memory of the process in bytes"""
+    try:
+        with open( "/proc/self/statm" ) as statm:
+            return int( statm.read().split()[1] ) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * 1024
+
+def main():
+    count = int( sys.argv[1] ) if len( sys.argv ) > 1 else 1000000
+    calls = int( sys.argv[2] ) if len( sys.argv ) > 2 else 20000
+    far_side, process = start_server( free_port() )
+    try:
+        noop = far_side.import_module( "bench_server" ).noop
+        get_wrapper = far_side.get_wrapper
+        #Proxies of the IDs, not known to the server: their releases are ignored by it
+        base = 1 << 20
+        memory = resident_memory()
+        t0 = time.time()
+        proxies = [ get_wrapper( base + i ) for i in xrange( count ) ]
+        created = time.time() - t0
+        print "%d proxies"%count
+        print "  memory: %.1f bytes per proxy"%( float( resident_memory() - memory ) / count )
+        print "  creation: %.2f us per proxy"%( created / count * 1e6 )
+        t0 = time.time()
+        for i in xrange( count ):
+            get_wrapper( base + i )
+        print "  lookup: %.2f us per proxy"%( (time.time() - t0) / count * 1e6 )
+        t0 = time.time()
+        gc.collect()
+        print "  full gc: %.1f ms"%( (time.time() - t0) * 1e3 )
+        measure( noop, min( calls, 1000 ) ) #Warm up
+        latencies = measure( noop, calls )
+        print "  no-op call: p50 %.1f us, p99 %.1f us, max %.1f us"%(
+            percentile( latencies, 0.5 ) * 1e6, percentile( latencies, 0.99 ) * 1e6, latencies[-1] * 1e6 )
+        t0 = time.time()
+        del proxies
+        far_side.flush_releases()
+        print "  destruction: %.2f us per proxy"%( (time.time() - t0) / count * 1e6 )
+        far_side.stop_server()
+    finally:
+        process.wait()
+
+if __name__ == "__main__":
+    main()
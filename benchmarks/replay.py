@@ -0,0 +1,175 @@
+"""Replays the wire log (see python_remote.WireRecorder), recorded by the clients or by the server, against a local server.
+Requests of every recorded stream (connection) are sent by a separate client, in the order of the log,
+with the original pacing or as fast as possible. Remote IDs are known only from the responses, so requests are sent
+one by one, and the IDs of the recorded responses are mapped to the IDs, returned by the local server.
+    python replay.py traffic.log                 #as fast as possible
+    python replay.py traffic.log --pace 1        #original timing (--pace 2: twice faster)
+Modules, imported by the recorded requests, must be importable by the server: see --path.
+Usage: python replay.py [options] log (see --help)
+"""
+import sys
+import os
+import time
+import json
+import optparse
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+from python_remote import FarSide, RemoteObjectWrapper, set_codec, msg_name, read_wire_log, read_wire_header, \
+    WIRE_REQUEST, RESP_SUCCESS, MSG_GET_ATTRIBUTE, MSG_GET_GLOBALS, MSG_CALL, MSG_SET_ATTRIBUTE, MSG_IMPORT_MODULE, \
+    MSG_RELEASE_OBJECT, MSG_GET_ATTR_LIST, MSG_STOP_SERVER, MSG_GET_ITEM, MSG_CALL_MANY, MSG_RELEASE_MANY, MSG_GET_PATH, \
+    MSG_ITERATE, MSG_CALL_METHOD, MSG_PREPARE, MSG_INVOKE, MSG_MARK_PURE, MSG_NEGOTIATE, MSG_BYE
+from call_latency import percentile
+from suite import server_url, start_server
+
+#Position of the remote ID in the request of the message type
+REQUEST_ID_FIELDS = { MSG_GET_ATTRIBUTE: 1, MSG_CALL: 1, MSG_SET_ATTRIBUTE: 1, MSG_RELEASE_OBJECT: 1, MSG_GET_ATTR_LIST: 1,
+                      MSG_GET_ITEM: 1, MSG_CALL_MANY: 1, MSG_GET_PATH: 1, MSG_ITERATE: 1, MSG_CALL_METHOD: 1,
+                      MSG_PREPARE: 1, MSG_INVOKE: 1, MSG_MARK_PURE: 1 }
+#Requests, that are not replayed: they would stop the server or change the connection
+SKIPPED = frozenset( [MSG_STOP_SERVER, MSG_BYE, MSG_NEGOTIATE] )
+
+def load_log( file_name ):
+    """Returns list of the requests (time, stream, msg_id, message, released) and map (stream, msg_id) -> recorded response"""
+    requests = []
+    responses = {}
+    for timestamp, stream, direction, envelope in read_wire_log( file_name ):
+        if direction == WIRE_REQUEST:
+            released = envelope[2] if len( envelope ) > 2 else ()
+            requests.append( (timestamp, stream, envelope[0], envelope[1], released) )
+        else:
+            responses[ (stream, envelope[0]) ] = envelope[1]
+    requests.sort( key=lambda request: request[0] )
+    return requests, responses
+
+class IdMap:
+    """Maps remote IDs of the recorded session to the IDs of the replayed one"""
+    def __init__( self ):
+        self.ids = {}
+        self.unmapped = 0 #Recorded IDs, that were never returned by the replayed responses
+
+    def get( self, remote_id ):
+        try:
+            return self.ids[ remote_id ]
+        except (KeyError, TypeError):
+            if remote_id is not None:
+                self.unmapped += 1
+            return remote_id
+
+    def remap( self, value ):
+        """Returns copy of the recorded value with the replayed IDs in the wrappers"""
+        if isinstance( value, RemoteObjectWrapper ):
+            return RemoteObjectWrapper( self.get( value.remote_id ) )
+        value_type = type( value )
+        if value_type is tuple or value_type is list:
+            return value_type( map( self.remap, value ) )
+        if value_type is dict:
+            return dict( [ (self.remap( key ), self.remap( item )) for key, item in value.iteritems() ] )
+        return value
+
+    def remap_request( self, message ):
+        message = list( self.remap( message ) )
+        code = message[0]
+        if code in REQUEST_ID_FIELDS:
+            field = REQUEST_ID_FIELDS[ code ]
+            message[ field ] = self.get( message[ field ] )
+        elif code == MSG_RELEASE_MANY:
+            message[1] = map( self.get, message[1] )
+        return tuple( message )
+
+    def learn( self, code, recorded, replayed ):
+        """Maps IDs of the recorded response to the IDs at the same places of the replayed one"""
+        if code == MSG_GET_GLOBALS:
+            self.ids[ recorded ] = replayed
+        elif code in (MSG_IMPORT_MODULE, MSG_PREPARE):
+            if recorded[0] == RESP_SUCCESS and replayed[0] == RESP_SUCCESS:
+                self.ids[ recorded[1] ] = replayed[1]
+        else:
+            self.learn_wrappers( recorded, replayed )
+
+    def learn_wrappers( self, recorded, replayed ):
+        if isinstance( recorded, RemoteObjectWrapper ):
+            if isinstance( replayed, RemoteObjectWrapper ):
+                self.ids[ recorded.remote_id ] = replayed.remote_id
+        elif type( recorded ) in (tuple, list) and type( replayed ) in (tuple, list) and len( recorded ) == len( replayed ):
+            for recorded_item, replayed_item in zip( recorded, replayed ):
+                self.learn_wrappers( recorded_item, replayed_item )
+
+def replay( requests, responses, url, pace ):
+    """Sends the requests to the server; returns dict of the results"""
+    ids = IdMap()
+    clients = {}
+    latencies = {} #Map message name -> latencies
+    mismatches = 0 #Responses with the other code, than recorded
+    timer = time.time
+    first = requests[0][0] if requests else 0.0
+    start = timer()
+    for timestamp, stream, msg_id, message, released in requests:
+        if message is None or message[0] in SKIPPED:
+            continue
+        if pace:
+            delay = start + (timestamp - first) / pace - timer()
+            if delay > 0:
+                time.sleep( delay )
+        far_side = clients.get( stream )
+        if far_side is None:
+            far_side = clients[ stream ] = FarSide( url )
+        far_side.release_queue.extend( map( ids.get, released ) )
+        t0 = timer()
+        response = far_side._send( ids.remap_request( message ) ).wait()
+        latencies.setdefault( msg_name( message[0] ), [] ).append( timer() - t0 )
+        recorded = responses.get( (stream, msg_id) )
+        if recorded is not None:
+            ids.learn( message[0], recorded, response )
+            if type( recorded ) is tuple and type( response ) is tuple and recorded[:1] != response[:1]:
+                mismatches += 1
+    elapsed = timer() - start
+    for far_side in clients.values():
+        far_side.close()
+    count = sum( map( len, latencies.values() ) )
+    messages = {}
+    for name, values in latencies.items():
+        values.sort()
+        messages[ name ] = dict( count=len( values ), p50_us=percentile( values, 0.5 ) * 1e6,
+                                 p99_us=percentile( values, 0.99 ) * 1e6, max_us=values[-1] * 1e6 )
+    return dict( requests=count, streams=len( clients ), elapsed=elapsed,
+                 throughput_ops=count / elapsed if elapsed > 0 else None,
+                 mismatches=mismatches, unmapped_ids=ids.unmapped, messages=messages )
+
+def main():
+    parser = optparse.OptionParser( usage="python replay.py [options] log" )
+    parser.add_option( "--pace", type="float", default=0.0,
+                       help="speed relative to the recording: 1 - original timing, 0 - as fast as possible [%default]" )
+    parser.add_option( "-m", "--mode", default="multithread", help="server mode: single (one stream only), multithread or event_loop [%default]" )
+    parser.add_option( "-t", "--transport", default="tcp", help="tcp, unix or shm [%default]" )
+    parser.add_option( "-p", "--path", action="append", default=[], help="directory with the modules of the application, for the server" )
+    parser.add_option( "-o", "--output", help="write JSON report to the file" )
+    options, args = parser.parse_args()
+    if len( args ) != 1:
+        parser.error( "log file is required" )
+    with open( args[0], "rb" ) as log:
+        codec = read_wire_header( log )
+    set_codec( codec )
+    requests, responses = load_log( args[0] )
+    if options.mode == "single" and len( set( [ request[1] for request in requests ] ) ) > 1:
+        parser.error( "single-threaded server serves one client at a time, but the log has several streams" )
+    if options.path:
+        os.environ[ "PYTHONPATH" ] = os.pathsep.join( options.path + filter( None, [ os.environ.get( "PYTHONPATH" ) ] ) )
+    control, process = start_server( server_url( options.transport, "replay%d"%os.getpid() ), options.mode, codec )
+    url = control.url()
+    control.close() #Single-threaded server serves one connection at a time
+    try:
+        report = replay( requests, responses, url, options.pace )
+        FarSide( url ).stop_server()
+    finally:
+        process.wait()
+    report.update( log=args[0], codec=codec, pace=options.pace, server_mode=options.mode, transport=options.transport )
+    print "%d requests of %d streams in %.3fs: %.0f/s, %d mismatched responses, %d unmapped IDs"%(
+        report["requests"], report["streams"], report["elapsed"], report["throughput_ops"] or 0,
+        report["mismatches"], report["unmapped_ids"] )
+    for name, stats in sorted( report["messages"].items() ):
+        print "%-16s %7d %9.1fus %9.1fus %9.1fus"%(name, stats["count"], stats["p50_us"], stats["p99_us"], stats["max_us"])
+    if options.output:
+        with open( options.output, "w" ) as output:
+            json.dump( report, output, indent=1, sort_keys=True )
+
+if __name__ == "__main__":
+    main()
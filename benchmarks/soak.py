@@ -0,0 +1,238 @@
+"""Soak test: many clients run a mix of calls against the local server for a long time.
+Every interval reports throughput, latency, resident memory of the server and the number of its registered objects,
+and fails (exit code 1), if memory or registry grows across the steady state (after the warm-up).
+Clients may drop the connection without releasing their objects (--reconnect): the server must forget them.
+    python soak.py -c 8 -d 3600 --mix call=5,get=3,set=1,object=1,leak=1 --reconnect 1000 -o soak.json
+Usage: python soak.py [options] (see --help)
+"""
+import sys
+import os
+import time
+import json
+import random
+import bisect
+import threading
+import Queue
+import multiprocessing
+import optparse
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+from python_remote import FarSide
+from call_latency import percentile
+from suite import server_url, start_server
+
+MIX = "call=5,get=3,set=1,object=1" #"leak" requires --reconnect, that frees the leaked objects
+OPERATIONS = ("call", "get", "set", "object", "leak") #See make_operations
+
+def make_operations( far_side, held ):
+    """Returns map operation name -> function, that makes one request. Objects of "leak" are held till reconnect"""
+    bench = far_side.import_module( "bench_server" )
+    target = bench.target
+    noop = bench.noop
+    new_object = bench.new_object
+    def set_value():
+        target.value = 1
+    return dict( call=lambda: noop(),
+                 get=lambda: target.value,
+                 set=set_value,
+                 object=lambda: new_object(), #Released by the next request
+                 leak=lambda: held.append( new_object() ) )
+
+def parse_mix( mix ):
+    """Returns list of (operation, weight) from "name=weight,..." """
+    result = []
+    for item in mix.split( "," ):
+        name, weight = item.split( "=" )
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError, "Unknown operation: %s"%name
+        result.append( (name, float( weight )) )
+    return result
+
+def worker( url, codec, mix, seed, reconnect, stop, results, report_interval ):
+    """Makes requests, chosen randomly by the weights of the mix, until stop is set.
+    Puts (latencies, errors) to the results every report_interval seconds"""
+    python_remote.set_codec( codec )
+    rng = random.Random( seed )
+    names = [ name for name, weight in mix ]
+    bounds = []
+    total = 0.0
+    for name, weight in mix:
+        total += weight
+        bounds.append( total )
+    held = []
+    far_side = FarSide( url )
+    operations = make_operations( far_side, held )
+    timer = time.time
+    latencies = []
+    errors = 0
+    done = 0
+    reported = timer()
+    while not stop.is_set():
+        operation = operations[ names[ bisect.bisect( bounds, rng.random() * total ) ] ]
+        t0 = timer()
+        try:
+            operation()
+        except Exception:
+            errors += 1
+        latencies.append( timer() - t0 )
+        done += 1
+        if reconnect and done % reconnect == 0:
+            far_side._disconnect() #Abruptly: held objects are not released by the client
+            del held[:]
+            far_side = FarSide( url )
+            operations = make_operations( far_side, held )
+        if timer() - reported >= report_interval:
+            results.put( (latencies, errors) )
+            latencies = []
+            errors = 0
+            reported = timer()
+    results.put( (latencies, errors) )
+    far_side.close()
+
+def drain( results ):
+    """Returns latencies and errors, reported by the workers since the last call"""
+    latencies = []
+    errors = 0
+    while True:
+        try:
+            batch, batch_errors = results.get_nowait()
+        except Queue.Empty:
+            return latencies, errors
+        latencies.extend( batch )
+        errors += batch_errors
+
+def slope( points ):
+    """Least squares slope of the (time, value) points"""
+    count = len( points )
+    mean_t = sum( [ t for t, v in points ] ) / count
+    mean_v = sum( [ v for t, v in points ] ) / count
+    variance = sum( [ (t - mean_t) ** 2 for t, v in points ] )
+    if variance == 0:
+        return 0.0
+    return sum( [ (t - mean_t) * (v - mean_v) for t, v in points ] ) / variance
+
+def trend( samples, key, tolerance, slack ):
+    """Growth of the value across the samples (by the linear fit), and whether it is more than allowed:
+    tolerance of the mean, but not less than slack - the usual fluctuation of the value"""
+    points = [ (sample[ "time" ], sample[ key ]) for sample in samples ]
+    growth = slope( points ) * (points[-1][0] - points[0][0])
+    mean = sum( [ v for t, v in points ] ) / float( len( points ) )
+    allowed = max( tolerance * mean, slack )
+    return dict( growth=growth, mean=mean, allowed=allowed, failed=growth > allowed )
+
+def run( options, url ):
+    """Runs the clients for the duration, returns list of the samples"""
+    mix = parse_mix( options.mix )
+    if options.threads:
+        stop, results = threading.Event(), Queue.Queue()
+        spawn = lambda args: threading.Thread( target=worker, args=args )
+    else:
+        stop, results = multiprocessing.Event(), multiprocessing.Queue()
+        spawn = lambda args: multiprocessing.Process( target=worker, args=args )
+    report_interval = min( 0.5, options.interval / 2 )
+    workers = [ spawn( (url, options.codec, mix, options.seed + index, options.reconnect, stop, results, report_interval) )
+                for index in xrange( options.clients ) ]
+    for process in workers:
+        process.daemon = True
+        process.start()
+    control = FarSide( url )
+    state = control.import_module( "bench_server" ).server_state
+    samples = []
+    start = last = time.time()
+    try:
+        while last - start < options.duration:
+            time.sleep( max( 0.0, last + options.interval - time.time() ) )
+            latencies, errors = drain( results )
+            now = time.time()
+            rss, objects = state()
+            latencies.sort()
+            sample = dict( time=now - start, ops=len( latencies ), errors=errors,
+                           throughput_ops=len( latencies ) / (now - last),
+                           p50_us=percentile( latencies, 0.5 ) * 1e6 if latencies else None,
+                           p99_us=percentile( latencies, 0.99 ) * 1e6 if latencies else None,
+                           rss=rss, objects=objects )
+            samples.append( sample )
+            last = now
+            if not options.quiet:
+                print "%7.1fs %9.0f/s %9.1fus %9.1fus %8.1fMB %8d objects%s"%(
+                    sample[ "time" ], sample[ "throughput_ops" ], sample[ "p50_us" ] or 0, sample[ "p99_us" ] or 0,
+                    rss / 1048576.0, objects, " %d errors"%errors if errors else "" )
+    finally:
+        stop.set()
+        deadline = time.time() + 10
+        for process in workers:
+            while process.is_alive() and time.time() < deadline:
+                drain( results ) #Full queue would block the exit of the process
+                process.join( 0.1 )
+        control.close()
+    return samples
+
+def main():
+    parser = optparse.OptionParser( usage="python soak.py [options]" )
+    parser.add_option( "-c", "--clients", type="int", default=4, help="number of the clients [%default]" )
+    parser.add_option( "--threads", action="store_true", help="clients are threads of this process, not processes" )
+    parser.add_option( "-d", "--duration", type="float", default=60, help="seconds [%default]" )
+    parser.add_option( "-i", "--interval", type="float", default=1.0, help="seconds between the samples [%default]" )
+    parser.add_option( "-w", "--warmup", type="float", default=10, help="seconds, excluded from the trend [%default]" )
+    parser.add_option( "--mix", default=MIX, help="operations with the weights: call, get, set, object, leak [%default]" )
+    parser.add_option( "--reconnect", type="int", default=0,
+                       help="every client drops the connection without releasing objects after so many requests (0: never)" )
+    parser.add_option( "-m", "--mode", default="multithread", help="server mode: multithread or event_loop [%default]" )
+    parser.add_option( "-t", "--transport", default="tcp", help="tcp or unix [%default]" )
+    parser.add_option( "--codec", default="cPickle", help="[%default]" )
+    parser.add_option( "--rss-tolerance", type="float", default=0.05,
+                       help="allowed growth of the server memory across the steady state, fraction of the mean [%default]" )
+    parser.add_option( "--rss-slack", type="int", default=1048576, help="allowed growth of the memory anyway, bytes [%default]" )
+    parser.add_option( "--objects-tolerance", type="float", default=0.1,
+                       help="allowed growth of the registered objects, fraction of the mean [%default]" )
+    parser.add_option( "--objects-slack", type="int", default=100,
+                       help="allowed growth of the objects anyway; raise it with --reconnect, as every client holds "
+                            "up to so many leaked objects [%default]" )
+    parser.add_option( "--seed", type="int", default=1, help="seed of the random choice of the operations [%default]" )
+    parser.add_option( "-o", "--output", help="write JSON report to the file" )
+    parser.add_option( "-q", "--quiet", action="store_true", help="do not print the samples" )
+    options, args = parser.parse_args()
+    if options.mode == "single":
+        parser.error( "single-threaded server serves one client at a time" )
+    try:
+        mix = parse_mix( options.mix )
+    except ValueError, err:
+        parser.error( "wrong --mix: %s"%err )
+    if not options.reconnect and [ weight for name, weight in mix if name == "leak" and weight > 0 ]:
+        parser.error( "leaked objects are freed only by --reconnect: without it, growth check fails by construction" )
+    control, process = start_server( server_url( options.transport, "soak%d"%os.getpid() ), options.mode, options.codec )
+    url = control.url()
+    control.close()
+    try:
+        samples = run( options, url )
+        FarSide( url ).stop_server()
+    finally:
+        process.wait()
+    steady = [ sample for sample in samples if sample[ "time" ] >= options.warmup ]
+    report = dict( clients=options.clients, threads=bool( options.threads ), duration=options.duration, mix=options.mix,
+                   reconnect=options.reconnect, server_mode=options.mode, transport=options.transport, codec=options.codec,
+                   samples=samples, steady_samples=len( steady ) )
+    failed = False
+    if len( steady ) < 3:
+        print "Too few samples after the warm-up to check the trends"
+    else:
+        report[ "rss_trend" ] = trend( steady, "rss", options.rss_tolerance, options.rss_slack )
+        report[ "objects_trend" ] = trend( steady, "objects", options.objects_tolerance, options.objects_slack )
+        for name in ("rss", "objects"):
+            result = report[ name + "_trend" ]
+            failed = failed or result[ "failed" ]
+            print "%-7s growth %12.0f (allowed %.0f, mean %.0f)%s"%(name, result[ "growth" ], result[ "allowed" ], result[ "mean" ],
+                                                                   "  <- FAILED" if result[ "failed" ] else "")
+        throughputs = sorted( [ sample[ "throughput_ops" ] for sample in steady ] )
+        print "throughput %.0f/s (median), p99 latency %.1fus (worst sample)"%(
+            percentile( throughputs, 0.5 ), max( [ sample[ "p99_us" ] or 0 for sample in steady ] ) )
+    report[ "failed" ] = failed
+    if options.output:
+        with open( options.output, "w" ) as output:
+            json.dump( report, output, indent=1, sort_keys=True )
+    if failed:
+        sys.exit( 1 )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Benchmark suite: latency and throughput of every basic message, for every codec, transport and payload size.
+Starts bench_server.py in a subprocess for every codec and transport, and writes results as JSON,
+so that the revisions can be compared:
+    python suite.py -o before.json
+    python suite.py -o after.json --compare before.json
+Usage: python suite.py [options] (see --help)
+"""
+import sys
+import os
+import time
+import json
+import socket
+import platform
+import tempfile
+import subprocess
+import optparse
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+from python_remote import MSG_RELEASE_OBJECT
+from call_latency import free_port, percentile, git_revision
+
+CODECS = [ "cPickle", "pickle", "simple_pickle" ]
+TRANSPORTS = [ "tcp", "unix", "shm" ]
+PAYLOAD_SIZES = [ 10, 1000, 100000 ] #Elements of the tuple, passed as the argument or the attribute value
+WINDOW = 256 #Requests in flight, when throughput is measured
+
+def server_url( transport, name ):
+    if transport == "tcp":
+        return "tcp://%s:%d"%(socket.gethostname(), free_port())
+    if transport == "unix":
+        return "unix://%s"%os.path.join( tempfile.gettempdir(), "%s.sock"%name )
+    return "shm://%s"%name
+
+def start_server( url, mode, codec ):
+    """Starts benchmark server in a subprocess; returns connected client and the process"""
+    python_remote.set_codec( codec )
+    script = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "bench_server.py" )
+    process = subprocess.Popen( [sys.executable, script, url, mode, codec] )
+    deadline = time.time() + 10
+    while True:
+        try:
+            return python_remote.FarSide( url ), process
+        except (socket.error, OSError):
+            if time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep( 0.05 )
+
+def operations( far_side ):
+    """Returns list of (operation, payload size, function, that sends the request and returns RemoteFuture)"""
+    bench = far_side.import_module( "bench_server" )
+    target = bench.target
+    noop = bench.noop
+    result = [
+        ("get_attribute", 0, lambda: far_side.get_attribute_async( target, "value" )),
+        ("call_noop", 0, lambda: noop._async_()),
+        ("call_scalars", 3, lambda: noop._async_( 1, 2.5, "name" )),
+        ("import_module", 0, lambda: far_side.import_module_async( "bench_server" )),
+        ]
+    for size in PAYLOAD_SIZES:
+        data = tuple( range( size ) )
+        result.append( ("call_tuple", size, lambda data=data: noop._async_( data )) )
+        result.append( ("set_attribute", size, lambda data=data: far_side.set_attribute_async( target, "value", data )) )
+    result.append( ("release_object", 0, None) ) #Needs a new object for every request, see measure_release
+    return result
+
+def summary( latencies, elapsed, count ):
+    """Returns dict with the latency distribution in microseconds and the throughput"""
+    latencies.sort()
+    return dict( count=count,
+                 latency_us=dict( [ (name, percentile( latencies, fraction ) * 1e6)
+                                    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)) ] +
+                                  [ ("min", latencies[0] * 1e6), ("max", latencies[-1] * 1e6),
+                                    ("mean", sum( latencies ) / len( latencies ) * 1e6) ] ),
+                 throughput_ops=count / elapsed if elapsed > 0 else None )
+
+def measure( send, count ):
+    """Latency of the sequential requests, and throughput with WINDOW requests in flight"""
+    timer = time.time
+    for i in xrange( min( count, 100 ) ): #Warm up
+        send().result()
+    latencies = []
+    for i in xrange( count ):
+        t0 = timer()
+        send().result()
+        latencies.append( timer() - t0 )
+    t0 = timer()
+    futures = []
+    for i in xrange( count ):
+        futures.append( send() )
+        if len( futures ) >= WINDOW:
+            for future in futures:
+                future.result()
+            futures = []
+    for future in futures:
+        future.result()
+    return summary( latencies, timer() - t0, count )
+
+def measure_release( far_side, count ):
+    """MSG_RELEASE_OBJECT of the objects, created beforehand. Client releases are normally batched by MSG_RELEASE_MANY,
+    so the message is sent directly, and the proxies are detached"""
+    bench = far_side.import_module( "bench_server" )
+    def released_ids( count ):
+        ids = []
+        for proxy in [ bench.new_object() for i in xrange( count ) ]:
+            ids.append( proxy._remote_id_ )
+            object.__setattr__( proxy, "_remote_id_", None ) #Detached: the proxy does not release the object itself
+        return ids
+    timer = time.time
+    latencies = []
+    for remote_id in released_ids( count ):
+        t0 = timer()
+        far_side._send( (MSG_RELEASE_OBJECT, remote_id) ).result()
+        latencies.append( timer() - t0 )
+    ids = released_ids( count )
+    t0 = timer()
+    futures = [ far_side._send( (MSG_RELEASE_OBJECT, remote_id) ) for remote_id in ids ]
+    for future in futures:
+        future.result()
+    return summary( latencies, timer() - t0, count )
+
+def scaled_count( count, payload ):
+    """Fewer repetitions for the big payloads"""
+    if payload <= 1000:
+        return count
+    return max( 20, count * 1000 // payload )
+
+def run( options ):
+    results = []
+    for codec in options.codecs:
+        for transport in options.transports:
+            url = server_url( transport, "bench%d"%os.getpid() )
+            far_side, process = start_server( url, options.mode, codec )
+            try:
+                for operation, payload, send in operations( far_side ):
+                    count = scaled_count( options.count, payload )
+                    if send is None:
+                        result = measure_release( far_side, count )
+                    else:
+                        result = measure( send, count )
+                    result.update( operation=operation, codec=codec, transport=transport, payload=payload )
+                    results.append( result )
+                    if not options.quiet:
+                        print "%-14s %-14s %-5s %7d %9.1fus %9.1fus %10.0f/s"%(
+                            operation, codec, transport, payload, result["latency_us"]["p50"],
+                            result["latency_us"]["p99"], result["throughput_ops"] )
+                far_side.stop_server()
+            finally:
+                process.wait()
+    python_remote.set_codec( "cPickle" )
+    return dict( revision=git_revision(), python=sys.version.split()[0], platform=platform.platform(),
+                 host=socket.gethostname(), time=time.strftime( "%Y-%m-%dT%H:%M:%S" ), server_mode=options.mode,
+                 results=results )
+
+def result_key( result ):
+    return (result["operation"], result["codec"], result["transport"], result["payload"])
+
+def compare( report, baseline, tolerance ):
+    """Prints changes of the median latency and throughput against the baseline. Returns number of the regressions"""
+    old_results = dict( [ (result_key( result ), result) for result in baseline["results"] ] )
+    print "Compared with revision %s:"%baseline.get( "revision" )
+    print "%-14s %-14s %-5s %7s %10s %10s"%("operation", "codec", "trans", "payload", "p50", "throughput")
+    regressions = 0
+    for result in report["results"]:
+        old = old_results.get( result_key( result ) )
+        if old is None:
+            continue
+        latency = result["latency_us"]["p50"] / old["latency_us"]["p50"] - 1
+        throughput = result["throughput_ops"] / old["throughput_ops"] - 1
+        slower = latency > tolerance or throughput < -tolerance
+        regressions += slower
+        print "%-14s %-14s %-5s %7d %+9.1f%% %+9.1f%%%s"%( result_key( result ) + (latency * 100, throughput * 100,
+                                                           "  <- regression" if slower else "") )
+    return regressions
+
+def main():
+    parser = optparse.OptionParser( usage="python suite.py [options]" )
+    parser.add_option( "-n", "--count", type="int", default=2000, help="requests per measurement (fewer for big payloads)" )
+    parser.add_option( "-c", "--codecs", default=",".join( CODECS ), help="comma-separated codecs [%default]" )
+    parser.add_option( "-t", "--transports", default=",".join( TRANSPORTS ), help="comma-separated transports [%default]" )
+    parser.add_option( "-m", "--mode", default="single", help="server mode: single, multithread or event_loop [%default]" )
+    parser.add_option( "-o", "--output", help="write JSON report to the file (stdout if not given)" )
+    parser.add_option( "--compare", metavar="FILE", help="compare with the JSON report of the other revision" )
+    parser.add_option( "--tolerance", type="float", default=0.1, help="relative change, reported as regression [%default]" )
+    parser.add_option( "-q", "--quiet", action="store_true", help="do not print results while measuring" )
+    options, args = parser.parse_args()
+    options.codecs = options.codecs.split( "," )
+    options.transports = options.transports.split( "," )
+    if options.mode == "event_loop" and "shm" in options.transports:
+        options.transports.remove( "shm" ) #Event loop server needs sockets
+    report = run( options )
+    if options.output:
+        with open( options.output, "w" ) as output:
+            json.dump( report, output, indent=1, sort_keys=True )
+    else:
+        print json.dumps( report, indent=1, sort_keys=True )
+    if options.compare:
+        with open( options.compare ) as baseline:
+            if compare( report, json.load( baseline ), options.tolerance ):
+                sys.exit( 1 )
+
+if __name__ == "__main__":
+    main()
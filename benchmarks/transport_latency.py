@@ -0,0 +1,63 @@
+"""Latency of the no-op MSG_CALL over TCP loopback, unix domain socket and shared memory.
+Usage: python transport_latency.py [number-of-calls [server-mode]]
+Server mode is single or multithread (event loop server does not support shared memory).
+"""
+import sys
+import os
+import time
+import socket
+import tempfile
+import subprocess
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+from call_latency import free_port, percentile, measure
+
+def start_server( url, mode ):
+    """Starts benchmark server, listening the URL, in a subprocess; returns connected client and the process"""
+    script = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "bench_server.py" )
+    process = subprocess.Popen( [sys.executable, script, url, mode] )
+    deadline = time.time() + 10
+    while True:
+        try:
+            return python_remote.FarSide( url ), process
+        except (socket.error, OSError):
+            if time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep( 0.05 )
+
+def main():
+    count = int( sys.argv[1] ) if len( sys.argv ) > 1 else 20000
+    mode = sys.argv[2] if len( sys.argv ) > 2 else "single"
+    name = "bench%d"%os.getpid()
+    urls = [ ("tcp", "tcp://%s:%d"%(socket.gethostname(), free_port())),
+             ("unix", "unix://%s"%os.path.join( tempfile.gettempdir(), "%s.sock"%name )),
+             ("shm", "shm://%s"%name) ]
+    print "No-op MSG_CALL, %d calls, server mode: %s"%(count, mode)
+    if not python_remote.SHM_SPIN_TIME:
+        print "Single CPU: shared memory does not spin, every wakeup goes through the unix socket"
+    print "%-6s %9s %9s %9s %12s %12s"%("", "p50", "p90", "p99", "pipelined", "64K echo")
+    for transport, url in urls:
+        far_side, process = start_server( url, mode )
+        try:
+            bench_server = far_side.import_module( "bench_server" )
+            noop = bench_server.noop
+            measure( noop, min( count, 1000 ) ) #Warm up
+            latencies = measure( noop, count )
+            t0 = time.time()
+            for i in xrange( count // 1000 ):
+                for future in [ noop._async_() for j in xrange( 1000 ) ]:
+                    future.result()
+            pipelined = (time.time() - t0) / (count // 1000 * 1000)
+            identity = bench_server.identity
+            data = "x" * 65536
+            echo = measure( lambda: identity( data ), max( count // 20, 1 ) )
+            print "%-6s %7.1fus %7.1fus %7.1fus %10.1fus %10.1fus"%(
+                transport, percentile( latencies, 0.5 ) * 1e6, percentile( latencies, 0.9 ) * 1e6,
+                percentile( latencies, 0.99 ) * 1e6, pipelined * 1e6, percentile( echo, 0.5 ) * 1e6 )
+            far_side.stop_server()
+        finally:
+            process.wait()
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,8 @@ try:
     print float(rmath.pi)
     #Use "map" function from the remote side to map remose "sin" over list of values
     print rbi.map( rmath.sin, [1,2] )
+    #Call remote "sin" for many arguments in one request
+    print rmath.sin._map_( [(1,), (2,)] )
 
     rmath = None
 except KeyError, err:
@@ -1,19 +1,50 @@
+from __future__ import with_statement
 import socket
 import threading
 import weakref
 import logging
 import sys
+import itertools
+import time
+import Queue
+import struct
+import select
+import errno
+import asyncore
+import cStringIO
+import collections
+import array
+import mmap
+import types
+import os
+import stat
+import tempfile
+import zlib
+import bz2
+import cProfile
+import pstats
+try:
+    import lzma
+except ImportError:
+    lzma = None #Python 2 has lzma only as the third-party backport
 
-import cPickle as pickle #Use faster realization of the pickle algorithm.
-#import simple_pickle as pickle
+import cPickle as pickle #Use faster realization of the pickle algorithm. Other codecs can be selected by set_codec()
 _protocol = pickle.HIGHEST_PROTOCOL #Use the highest available pickle protocol.
-#import pickle #These are failsafe options
-#_protocol = 0
 
 dump = pickle.dump
 load = pickle.load
+dumps = pickle.dumps
+loads = pickle.loads
+Pickler = pickle.Pickler #Used for the messages with out-of-band buffers. None, if the codec does not support them.
+Unpickler = pickle.Unpickler
+codec_name = "cPickle" #Selected by set_codec
 
 SIMPLE_TYPES = (int, bool, str, long, float, unicode)
+MISSING = object() #Marks absent value
+SCALAR_TYPES = frozenset( [int, bool, long, float, unicode, type(None)] ) #Exact types, that are passed as is
+CACHEABLE_TYPES = (types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.ModuleType,
+                   type, types.ClassType) #Attributes of these types can be cached by the client
+BUFFER_TYPES = (bytearray, array.array, buffer, memoryview, mmap.mmap) #Transferred as out-of-band buffers
 
 class UnknownObjectError( Exception ):
     """Error, raised when client requested an object, that is not known at the server side"""
@@ -24,82 +55,337 @@ class ProtocolException( Exception ):
     Usually caused either by the errors in the code, or by network errors"""
     pass
 
+class TooManyObjectsError( Exception ):
+    """Raised, when the connection would hold more remote objects (or memory), than the server allows"""
+    pass
+
+class UntranslatableException( Exception ):
+    """Replaces remote exception, whose class can not be restored by the codec. Arguments: class name and exception arguments"""
+    pass
+
+def set_codec( name ):
+    """Selects serialization of the messages: "cPickle" (default), "pickle" or "simple_pickle".
+    Client and server must use the same codec.
+    simple_pickle only transfers standard types (and exceptions), but never creates arbitrary objects from the received data.
+    """
+    global dump, load, dumps, loads, _protocol, Pickler, Unpickler, codec_name
+    if name == "cPickle":
+        import cPickle as module
+        protocol = module.HIGHEST_PROTOCOL
+    elif name == "pickle":
+        import pickle as module
+        protocol = module.HIGHEST_PROTOCOL
+    elif name == "simple_pickle":
+        import simple_pickle as module
+        protocol = None
+    else:
+        raise ValueError, "Unknown codec: %s"%name
+    dump, load, dumps, loads, _protocol = module.dump, module.load, module.dumps, module.loads, protocol
+    #simple_pickle writes buffers inline
+    Pickler = getattr( module, "Pickler", None )
+    Unpickler = getattr( module, "Unpickler", None )
+    codec_name = name
+
 ################################################################################
 #  Server-side classes
 ################################################################################
 class PythonServer:
     """Server"""
-    def __init__( self, port, are_lists_local=False, multithread = False ):
+    def __init__( self, port, are_lists_local=False, multithread = False, event_loop = False, are_buffers_local = False ):
         """Create python server on the specified port
+        port: TCP port on the host name, or URL: tcp://host:port, unix:///path/of/socket, or shm://name (shared memory;
+        not supported by the event loop server).
         are_lists_local: When True, lists will be transferred to the client. Otherwise, they will be 'externalized'. 
         True is safe only if lists are not owned by the server-side.
+        are_buffers_local: When True, bytearrays, arrays and other buffers are copied to the client as out-of-band frames,
+        like the big strings. Otherwise, they are 'externalized'. Like are_lists_local, changes are not visible to the server.
+        Both flags are shortcuts for set_policy(), which selects the marshalling policy of any type.
+        multithread: When True, many clients are served simultaneously. Connections are read by the separate threads,
+        but requests are executed by the thread, that calls process_pending() (see start()).
+        event_loop: When True, many clients are served simultaneously by one thread, using non-blocking sockets.
+        Footprint of the long-running server can be bounded by:
+          lease_time - connections, that sent nothing for so many seconds, are closed and their objects released
+             (multithreaded and event loop servers). Clients renew the lease by any request, or by FarSide.renew_lease().
+             After the first renew_lease(), blocking clients renew it automatically, while idle.
+          objects.max_objects, objects.max_memory - limits of the objects (and their shallow size), held by one connection.
         """
         self.port = port
-        self.objects = dict() #Map id->remoted object
-        self.will_wrap_lists = are_lists_local
+        self.objects = ObjectRegistry() #Map remote ID -> remoted object, with the references of the connections
+        self.lease_time = None #Seconds. None: connections are never expired
+        self.current_connection = None #Connection, whose request is executed now
+        self.policies = dict() #Map type -> marshalling policy of the returned values (see set_policy)
+        for value_type in (list, dict, set, frozenset):
+            self.policies[ value_type ] = BY_REFERENCE
+        for value_type in BUFFER_TYPES:
+            self.policies[ value_type ] = BY_VALUE if are_buffers_local else BY_REFERENCE
+        if are_lists_local:
+            self.policies[ list ] = BY_VALUE
+        self.constant_attributes = set() #Names of the simple attributes of the modules and classes, that never change (cached by the clients)
+        self.max_value_items = 100000 #Maximal number of elements of the containers, copied by value into one response
+        self.pure_functions = dict() #Map id(function) -> (function, LRUCache of its results)
+        self.pure_cache_size = 1024 #Default number of the results, cached for one pure function
+        self.allow_pure_requests = True #Clients may mark functions as pure
+        self.compression_codecs = [ "zlib", "bz2", "lzma" ] #Codecs, that clients may select for the big frames. Empty: no compression
+        self.compression_threshold = 1024 #Smaller frames are never compressed, even if client asks so
+        self.compressions = weakref.WeakKeyDictionary() #Map connection -> Compression of its frames
+        self.metrics = Metrics() #Counters and latencies of the requests per message type (see stats). None: not collected
+        self.allow_profiling = True #Clients may profile the server (see start_profiling)
+        self.profiler = None #cProfile.Profile, enabled around the profiled requests
+        self.profiled_connection = None #Connection, whose requests are profiled. None: all of them
+        self.profiled_objects = dict() #Map name of the request target -> [requests, seconds], while profiling
+        self.profile_started = None
+        self.recorder = None #WireRecorder of the messages of the new connections (see start_recording)
+        self.unwrap_time = self.wrap_time = 0.0 #Spent by the current request on its arguments and results
+        self.attr_generation = 0 #Incremented, when attribute is set by a client. Clients drop cached attributes then.
         self.stop_requested = False
         self.multithread = multithread
+        self.event_loop = event_loop
+        self.requests = Queue.Queue() #Requests, received by the connection threads: (function, args)
+        self.connections = [] #Active connection threads of the multithreaded server
+        self.accept_timeout = 0.5 #How often acceptor thread checks, whether stop is requested
         self.logger = logging.getLogger( "py-remote.server" )
 
-    def start( self ):
-        #create an INET, STREAMing socket
-        serversocket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
+    def start( self, blocking=True ):
+        """Start serving clients.
+        Single-threaded server serves clients one by one, until stop is requested.
+        Multithreaded server starts acceptor thread; then, if blocking is True, executes requests until stop is requested.
+        If blocking is False, it returns immediately, and the host application must call process_pending() periodically.
+        Event loop server serves all clients by the calling thread, until stop is requested.
+        """
+        url = self.port
+        if not isinstance( url, basestring ):
+            url = "tcp://%s:%d"%(socket.gethostname(), self.port) #Public host and a well-known port
+        if self.event_loop and url.startswith( "shm:" ):
+            raise ValueError, "Shared memory transport is not supported by the event loop server"
+        serversocket = listen( url )
         self.serversocket = serversocket
-        #bind the socket to a public host,
-        # and a well-known port
-        serversocket.bind( (socket.gethostname(), 
-                            self.port) )
-        #become a server socket
-        serversocket.listen(5)
+
+        if self.event_loop:
+            EventLoop( self, serversocket, self.logger ).run()
+            return
+
+        if self.multithread:
+            acceptor = threading.Thread( target = self._accept_connections )
+            acceptor.setDaemon( True )
+            acceptor.start()
+            if blocking:
+                while not self.stop_requested:
+                    self.process_pending()
+                self.stop()
+                acceptor.join() #Closes the listening socket (and removes the file of the unix socket)
+                for connection in list( self.connections ):
+                    connection.join( self.accept_timeout )
+            return
 
         while not self.stop_requested:
             #accept connections from outside
             (clientsocket, address) = serversocket.accept()
             self.logger.info( "Accepted connection from: %s"%str( address ) )
-            #now do something with the clientsocket
-            #in this case, we'll pretend this is a threaded server
             ct = ServerThread( self, clientsocket, address, self.logger ) #TODO: use child logger. (not available in python 25)
-            if self.multithread:
-                st.start()
+            ct.run()
+            ct = None
+        serversocket.close()
+
+    def _accept_connections( self ):
+        """Acceptor thread of the multithreaded server: starts reading thread for every connection"""
+        serversocket = self.serversocket
+        serversocket.settimeout( self.accept_timeout )
+        while not self.stop_requested:
+            self.expire_leases( list( self.connections ) )
+            try:
+                (clientsocket, address) = serversocket.accept()
+            except socket.timeout:
+                continue
+            clientsocket.settimeout( None )
+            self.logger.info( "Accepted connection from: %s"%str( address ) )
+            ct = ServerThread( self, clientsocket, address, self.logger, queued=True )
+            ct.setDaemon( True )
+            self.connections.append( ct )
+            ct.start()
+        serversocket.close()
+
+    def stop( self ):
+        """Stops multithreaded server and closes all connections"""
+        self.stop_requested = True
+        self.requests.put( (lambda: None, ()) ) #Wakes up process_pending, that waits for the requests
+        for connection in list( self.connections ):
+            try:
+                connection.socket.shutdown( socket.SHUT_RDWR ) #Connection thread will exit
+            except socket.error:
+                pass
+
+    def expire_leases( self, connections ):
+        """Closes connections, whose lease is expired. Their objects are released, when they are closed"""
+        if self.lease_time is None:
+            return
+        now = time.time()
+        for connection in connections:
+            if connection.lease_expires is None: #Connected, before the lease time was set
+                connection.renew_lease()
+            elif connection.lease_expires < now:
+                self.logger.warning( "Lease of the client %s expired, closing connection"%str( connection.address ) )
+                connection.lease_expires = float( "inf" )
+                connection.expire()
+
+    def process_pending( self, timeout=None ):
+        """Executes requests, received by the connection threads of the multithreaded server.
+        Must be called by the thread, where remote calls must be executed (usually the main thread of the host application).
+        Waits for the first request up to timeout seconds (forever, if timeout is None), then executes it 
+        and all other requests, available without waiting. Returns number of the executed requests.
+        Note: waiting with timeout is implemented by polling in Python 2, so timeout=None gives the lowest latency.
+        """
+        requests = self.requests
+        try:
+            if timeout is None:
+                item = requests.get()
+            elif timeout > 0:
+                item = requests.get( True, timeout )
             else:
-                ct.run()
-                ct = None
+                item = requests.get_nowait()
+        except Queue.Empty:
+            return 0
+        count = 0
+        while True:
+            function, args = item
+            function( *args )
+            count += 1
+            try:
+                item = requests.get_nowait()
+            except Queue.Empty:
+                return count
+
+    def get_handlers( self ):
+        """Returns map message code -> handler method"""
+        return {
+            MSG_GET_GLOBALS: self.on_get_globals,
+            MSG_GET_ATTRIBUTE: self.on_get_obj_attr,
+            MSG_CALL: self.on_call,
+            MSG_SET_ATTRIBUTE: self.on_set_attr,
+            MSG_IMPORT_MODULE: self.on_import_module,
+            MSG_RELEASE_OBJECT: self.on_release_object,
+            MSG_RELEASE_MANY: self.on_release_many,
+            MSG_GET_ATTR_LIST: self.on_get_attr_list,
+            MSG_STOP_SERVER: self.on_stop_server,
+            MSG_BATCH: self.on_batch,
+            MSG_CALL_MANY: self.on_call_many,
+            MSG_GET_ITEM: self.on_get_item,
+            MSG_GET_PATH: self.on_get_path,
+            MSG_RENEW_LEASE: self.on_renew_lease,
+            MSG_ITERATE: self.on_iterate,
+            MSG_CALL_METHOD: self.on_call_method,
+            MSG_PREPARE: self.on_prepare,
+            MSG_INVOKE: self.on_invoke,
+            MSG_MARK_PURE: self.on_mark_pure,
+            MSG_NEGOTIATE: self.on_negotiate,
+            MSG_GET_STATS: self.on_get_stats,
+            MSG_PROFILE_START: self.on_profile_start,
+            MSG_PROFILE_STOP: self.on_profile_stop }
 
     def register_object( self, obj ):
-        """Stores reference to the object in the internal map and returns object ID, that would be used as remote ID by the client"""
-        obj_id = id( obj )
-        self.objects[ obj_id ] = obj
-        return obj_id
+        """Stores reference to the object in the internal map and returns object ID, that would be used as remote ID by the client.
+        Current connection gets one more reference to the object."""
+        return self.objects.add( obj, self.current_connection )
+
+    def forget_connection( self, connection ):
+        """Releases all objects, held by the closed connection"""
+        self.objects.forget( connection )
+        if self.profiler is not None and self.profiled_connection is connection:
+            self.logger.info( "Profiling of the connection %s is dropped: connection closed"%(connection.address,) )
+            self.profiler = self.profiled_connection = None
+        if connection.compression is not None:
+            self.logger.info( "Compression of the connection %s: %s"%(connection.address, connection.compression.stats()) )
 
-    def wrap_returned( self, value ):
-        """Called by the server, to prepare returned value for transfer"""
+    def set_policy( self, value_type, policy ):
+        """Sets, how the returned values of the exact type are transferred to the client:
+          BY_VALUE - copied (changes, made by the client, are not visible to the server),
+          BY_REFERENCE - remoted,
+          integer N - copied, if they have not more than N elements (bytes for the strings and buffers), remoted otherwise.
+        Scalars, strings and tuples are always copied. Values of the types without policy are remoted.
+        Values of the other types, than lists, dicts, sets and buffers, are copied as is: client must be able to load them.
+        In any case, no more than max_value_items elements are copied into one response, the rest is remoted.
+        """
+        if policy not in (BY_VALUE, BY_REFERENCE) and not (type( policy ) is int and policy >= 0):
+            raise ValueError, "Unknown marshalling policy: %r"%(policy,)
+        self.policies[ value_type ] = policy
+
+    def wrap_returned( self, value, policy=None ):
+        """Called by the server, to prepare returned value for transfer
+        policy: if given, overrides policies of all types, that have one (see set_policy). Requested by the client per call.
+        """
+        if type( value ) in SCALAR_TYPES: #The most common case: no need to build the closure
+            return value
+        start = time.time()
+        try:
+            return self._wrap_returned( value, policy )
+        finally:
+            self.wrap_time += time.time() - start
+
+    def _wrap_returned( self, value, policy ):
+        policies = self.policies
+        budget = [ self.max_value_items ] #Elements, that still can be copied
         def do_wrap( value ):
-            if value == None or \
-                    isinstance( value, SIMPLE_TYPES ):
+            value_type = type( value )
+            if value_type in SCALAR_TYPES:
                 return value
-            elif isinstance( value, tuple ):
-                return tuple(map( do_wrap, value) )
-            elif self.will_wrap_lists and isinstance( value, list ):
-                #It is generally unsafe, because far-side modifications of the list 
-                #will not be visible on the near-side. However, it can speed-up many applications significantly
-                return map( do_wrap, value )
-            else:
+            if value_type is str:
+                return OutOfBandBuffer( value ) if len( value ) >= OUT_OF_BAND_MIN_SIZE else value
+            if value_type is tuple:
+                return tuple( map( do_wrap, value ) )
+            value_policy = policies.get( value_type )
+            if value_policy is None:
+                if value is None or isinstance( value, SIMPLE_TYPES ):
+                    return value
+                if isinstance( value, tuple ):
+                    return tuple( map( do_wrap, value ) )
+                value_policy = BY_REFERENCE
+            elif policy is not None:
+                value_policy = policy
+            if value_policy == BY_REFERENCE:
                 #impossible to transfer: transfer as external object
                 return RemoteObjectWrapper( self.register_object( value ) )
+            try:
+                size = len( value )
+            except TypeError:
+                size = 1
+            if value_policy != BY_VALUE and size > value_policy:
+                return RemoteObjectWrapper( self.register_object( value ) )
+            if isinstance( value, BUFFER_TYPES ):
+                return OutOfBandBuffer( value )
+            if size > budget[0]: #Too big to be copied by accident
+                return RemoteObjectWrapper( self.register_object( value ) )
+            budget[0] -= size
+            #Copying is generally unsafe, because far-side modifications of the value
+            #will not be visible on the near-side. However, it can speed-up many applications significantly
+            if value_type is list:
+                return map( do_wrap, value )
+            if value_type is dict:
+                return dict( [ (do_wrap( key ), do_wrap( item )) for key, item in value.iteritems() ] )
+            if value_type is set or value_type is frozenset:
+                return value_type( map( do_wrap, value ) )
+            return value
         return do_wrap(value)
 
-    def unwrap_argument( self, value ):
+    def unwrap_argument( self, value, promised=None ):
         """Wrap values before calling remote method
         Called by the server, to unwrap arguments, passed from the client
+        promised: map slot->value of the already executed operations of the MSG_BATCH, used to resolve PromiseRef's
         """
-        
-        #EMpty tuple is a very common case: check it first to improve performance
-        if value == () or value == None \
-                or isinstance( value, (int, bool, str, long, float, unicode) ):
-            return value 
+        value_type = type( value )
+        if value_type in SCALAR_TYPES or value_type is str:
+            return value #Nothing to unwrap: not timed
+        start = time.time()
+        try:
+            return self._unwrap_argument( value, promised )
+        finally:
+            self.unwrap_time += time.time() - start
+
+    def _unwrap_argument( self, value, promised ):
+        value_type = type( value )
+        if value_type in SCALAR_TYPES or value_type is str:
+            return value
+        unwrap = lambda item: self._unwrap_argument( item, promised )
         if isinstance( value, tuple ):
-            return tuple( map( self.unwrap_argument, value ) )
+            return tuple( map( unwrap, value ) ) if value else value
 
         if isinstance( value, RemoteObjectWrapper ):
             try:
@@ -108,14 +394,22 @@ class PythonServer:
                 self.logger.error( "Can't unwrap argument: object %s not registered"%err )
                 raise UnknownObjectError, err
 
+        if isinstance( value, PromiseRef ):
+            try:
+                return promised[ value.slot ]
+            except (KeyError, TypeError):
+                raise UnknownObjectError, value
+
+        if isinstance( value, SIMPLE_TYPES ): #Subclasses of the simple types
+            return value
         #Unsafe conversions
         #self.logger.warning( "Warning: Argument can not be converted safely" )
         if isinstance( value, list ):
-            return map( self.unwrap_argument, value )
+            return map( unwrap, value )
         if isinstance( value, set ):
-            return set( map( self.unwrap_argument, value ) )
+            return set( map( unwrap, value ) )
         if isinstance( value, dict ):
-            return dict( map( self.unwrap_argument, value.items() ) )
+            return dict( map( unwrap, value.items() ) )
         #TODO: process object attributes too?
         return value
 
@@ -124,27 +418,238 @@ class PythonServer:
         obj_id = self.register_object( globals() )
         return obj_id
 
+    def attribute_flags( self, obj, attr, name ):
+        """Returns flags of the attribute value, sent with it to the client. 
+        Functions, methods, classes and modules are cacheable. Simple values may change, so they are cacheable only
+        as attributes of the modules and classes with UPPER_CASE names, or names listed in constant_attributes.
+        Changes, made by the server-side code, are not tracked: override this method, if such attributes change.
+        Pure functions (see mark_pure) are reported, so that the client caches their results too."""
+        flags = 0
+        if isinstance( attr, CACHEABLE_TYPES ):
+            flags = ATTR_CACHEABLE
+        elif (attr is None or isinstance( attr, SIMPLE_TYPES )) and \
+                isinstance( obj, (types.ModuleType, type, types.ClassType) ) and \
+                (name in self.constant_attributes or name.isupper()):
+            flags = ATTR_CACHEABLE
+        if self.pure_functions and id( attr ) in self.pure_functions:
+            flags |= ATTR_PURE
+        return flags
+
+    def mark_pure( self, function, cache_size=None ):
+        """Marks function as pure: its results depend only on the arguments, and it has no side effects.
+        Results of the calls with scalar, string and tuple arguments are cached (cache_size last ones, pure_cache_size by default).
+        Clients, that get the function as attribute after this, cache its results too. cache_size=0 unmarks the function."""
+        if cache_size == 0:
+            self.pure_functions.pop( id( function ), None )
+            return
+        name = getattr( function, "__name__", None ) or repr( function )
+        self.pure_functions[ id( function ) ] = (function, LRUCache( cache_size or self.pure_cache_size, name ))
+
+    def pure_stats( self ):
+        """Returns map function name -> counters of its result cache (see LRUCache.stats)"""
+        return dict( [ (cache.name, cache.stats()) for function, cache in self.pure_functions.itervalues() ] )
+
+    def compression_stats( self ):
+        """Returns list of the compression counters of the connected clients (see Compression.stats), with their addresses"""
+        return [ dict( compression.stats(), address=connection.address )
+                 for connection, compression in self.compressions.items() ]
+
+    def stats( self ):
+        """Returns metrics of the requests, executed since start or reset, per message name (see Metrics.snapshot)"""
+        if self.metrics is None:
+            return {}
+        return self.metrics.snapshot()
+
+    def on_get_stats( self, msg ):
+        """Returns metrics of the server (see stats). Metrics are reset, if the client asks so"""
+        stats = self.stats()
+        if msg[1] and self.metrics is not None:
+            self.metrics.reset()
+        return (RESP_SUCCESS, stats)
+
+    def start_recording( self, recorder ):
+        """Writes messages of the connections, accepted from now on, to the WireRecorder (or the log file of the given name).
+        Every connection is a separate stream of the log. Returns the recorder"""
+        if isinstance( recorder, basestring ):
+            recorder = WireRecorder( recorder )
+        self.recorder = recorder
+        return recorder
+
+    def stop_recording( self ):
+        """Stops recording of the new connections and closes the log. Already recorded connections stop writing to it"""
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def start_profiling( self, connection=None ):
+        """Starts cProfile around the execution of the requests of the connection (all connections, if None).
+        Results are returned by stop_profiling. Raises ValueError, if profiling is already started"""
+        if self.profiler is not None:
+            raise ValueError, "Profiling is already started"
+        self.profiled_objects = dict()
+        self.profiled_connection = connection
+        self.profile_started = time.time()
+        self.profiler = cProfile.Profile()
+
+    def stop_profiling( self ):
+        """Stops profiling, returns dict:
+          functions - profile in the format of pstats.Stats.stats: {(file, line, function): (primitive calls, calls,
+             own time, cumulative time, {caller: (...)})}; see profile_stats,
+          objects - {name of the request target: (requests, seconds)}: remote object of the request, or the message name,
+          scope, time - scope and duration of the profiling.
+        Raises ValueError, if profiling is not started"""
+        profiler = self.profiler
+        if profiler is None:
+            raise ValueError, "Profiling is not started"
+        scope = PROFILE_SERVER if self.profiled_connection is None else PROFILE_CONNECTION
+        self.profiler = self.profiled_connection = None
+        profiler.create_stats()
+        objects = dict( [ (name, tuple( counters )) for name, counters in self.profiled_objects.iteritems() ] )
+        self.profiled_objects = dict()
+        return dict( functions=profiler.stats, objects=objects, scope=scope, time=time.time() - self.profile_started )
+
+    def execute_profiled( self, handler, msg ):
+        """Executes handler of the request with the profiler enabled, and counts its time for the target object"""
+        profiler, profiled_objects = self.profiler, self.profiled_objects
+        start = time.time()
+        profiler.enable()
+        try:
+            return handler( msg )
+        finally:
+            profiler.disable()
+            name = self.target_name( msg )
+            counters = profiled_objects.get( name )
+            if counters is None:
+                counters = profiled_objects[ name ] = [ 0, 0.0 ]
+            counters[0] += 1
+            counters[1] += time.time() - start
+
+    def target_name( self, msg ):
+        """Returns name of the remote object, that the request is addressed to, or the name of the message"""
+        if len( msg ) > 1 and type( msg[1] ) in (int, long):
+            try:
+                return object_name( self.objects[ msg[1] ] )
+            except KeyError:
+                pass
+        return msg_name( msg[0] )
+
+    def on_profile_start( self, msg ):
+        """Client starts profiling of its own requests or of the whole server"""
+        #MSG_PROFILE_START
+        scope = msg[1]
+        if not self.allow_profiling:
+            return (RESP_EXCEPT, ValueError( "Server does not allow profiling" ))
+        if scope not in (PROFILE_CONNECTION, PROFILE_SERVER):
+            return (RESP_EXCEPT, ValueError( "Unknown profiling scope: %r"%(scope,) ))
+        if self.profiler is not None:
+            return (RESP_EXCEPT, ValueError( "Profiling is already started" ))
+        self.start_profiling( self.current_connection if scope == PROFILE_CONNECTION else None )
+        return (RESP_SUCCESS, None)
+
+    def on_profile_stop( self, msg ):
+        """Stops profiling and returns its results (see stop_profiling)"""
+        #MSG_PROFILE_STOP
+        if self.profiler is None:
+            return (RESP_EXCEPT, ValueError( "Profiling is not started" ))
+        return (RESP_SUCCESS, self.stop_profiling())
+
+    def on_negotiate( self, msg ):
+        """Selects the first codec of the client, that server allows. Threshold is raised to the minimum of the server"""
+        codecs, threshold = msg[1], msg[2]
+        for codec in codecs:
+            if codec in self.compression_codecs and codec in COMPRESSION_CODECS:
+                threshold = max( threshold, self.compression_threshold )
+                compression = Compression( codec, threshold )
+                connection = self.current_connection
+                connection.enable_compression( compression )
+                self.compressions[ connection ] = compression
+                return (RESP_SUCCESS, (codec, threshold))
+        return (RESP_SUCCESS, (None, None))
+
+    def call_pure( self, function, args ):
+        """Calls pure function, using its result cache"""
+        cache = self.pure_functions[ id( function ) ][1]
+        key = pure_key( args )
+        if key is None:
+            return function( *args )
+        value = cache.get( key, MISSING )
+        if value is MISSING:
+            value = function( *args )
+            if is_immutable_value( value ): #Mutable results could be changed by the callers
+                cache.put( key, value )
+        return value
+
+    def on_mark_pure( self, msg ):
+        """Client marks function as pure"""
+        #MSG_MARK_PURE
+        msg_code, obj_id, cache_size = msg
+        try:
+            obj = self.objects[ obj_id ]
+        except KeyError:
+            return (RESP_NOT_REGISTERED, obj_id)
+        if not self.allow_pure_requests:
+            return (RESP_EXCEPT, ValueError( "Server does not allow to mark functions as pure" ))
+        self.mark_pure( obj, cache_size )
+        return (RESP_SUCCESS, None)
+
     def on_get_obj_attr( self, msg ):
-        msg_id, obj_id, attr_name = msg
+        msg_code, obj_id, attr_name = msg
         try:
             obj = self.objects[ obj_id ]
             try:
                 attr = getattr( obj, attr_name )
                 #print "#succ get attr:", attr_name, attr
-                return (RESP_SUCCESS, self.wrap_returned( attr ) )
+                return (RESP_SUCCESS, self.wrap_returned( attr ), self.attribute_flags( obj, attr, attr_name ) )
             except AttributeError:
                 return (RESP_NO_SUCH_ATTR,)
         except KeyError, key: #Object not found
             return (RESP_NOT_REGISTERED, obj_id)
 
+    def on_get_path( self, msg ):
+        """Walks the dotted path of attributes and returns only the last one: intermediate objects are not registered.
+        If object is not given, path starts with the module name. Submodules are imported, if needed."""
+        #MSG_GET_PATH
+        msg_code, obj_id, path = msg
+        names = path.split( "." )
+        if obj_id is None:
+            try:
+                obj = __import__( names[0] )
+            except Exception, err:
+                return (RESP_EXCEPT, err)
+            names = names[1:]
+        else:
+            try:
+                obj = self.objects[ obj_id ]
+            except KeyError:
+                return (RESP_NOT_REGISTERED, obj_id)
+        flags = ATTR_CACHEABLE #Path is cacheable only if every step is
+        for name in names:
+            try:
+                attr = getattr( obj, name )
+            except AttributeError:
+                if not isinstance( obj, types.ModuleType ):
+                    return (RESP_NO_SUCH_ATTR, name)
+                try:
+                    __import__( obj.__name__ + "." + name ) #Submodule, that is not imported yet
+                    attr = getattr( obj, name )
+                except (ImportError, AttributeError):
+                    return (RESP_NO_SUCH_ATTR, name)
+            flags &= self.attribute_flags( obj, attr, name )
+            obj = attr
+        return (RESP_SUCCESS, self.wrap_returned( obj ), flags)
+
     def on_call( self, msg ):
         """Called object as function"""
-        msg_id, obj_id, args = msg
+        msg_code, obj_id, args = msg[:3]
+        policy = msg[3] if len( msg ) > 3 else None
         args = self.unwrap_argument( args )
         try:
             obj = self.objects[ obj_id ]
             try:
-                res = self.wrap_returned( obj( *args ) )
+                if self.pure_functions and id( obj ) in self.pure_functions:
+                    res = self.wrap_returned( self.call_pure( obj, args ), policy )
+                else:
+                    res = self.wrap_returned( obj( *args ), policy )
                 return (RESP_SUCCESS, res)
             except AttributeError, err:
                 return (RESP_NO_SUCH_ATTR, "__call__" )
@@ -155,14 +660,37 @@ class PythonServer:
             self.logger.error( "Error! No object %s"%obj_id )
             return (RESP_NOT_REGISTERED, obj_id)
 
+    def on_call_many( self, msg ):
+        """Calls object as function for every argument tuple of the list. 
+        Exceptions are reported for every item separately, and do not stop the whole batch."""
+        #MSG_CALL_MANY
+        msg_code, obj_id, arg_tuples = msg
+        try:
+            obj = self.objects[ obj_id ]
+        except KeyError:
+            self.logger.error( "Error! No object %s"%obj_id )
+            return (RESP_NOT_REGISTERED, obj_id)
+        unwrap_argument = self.unwrap_argument
+        wrap_returned = self.wrap_returned
+        results = []
+        for args in arg_tuples:
+            try:
+                results.append( (RESP_SUCCESS, wrap_returned( obj( *unwrap_argument( args ) ) ) ) )
+            except UnknownObjectError, err:
+                results.append( (RESP_NOT_REGISTERED, err.args[0]) )
+            except Exception, err:
+                results.append( (RESP_EXCEPT, err) )
+        return (RESP_SUCCESS, results)
+
     def on_set_attr( self, msg ):
         """Attempt to set attribute"""
-        msg_id, obj_id, attr_name, attr_val = msg
+        msg_code, obj_id, attr_name, attr_val = msg
         attr_val = self.unwrap_argument( attr_val )
         try:
             obj = self.objects[ obj_id ]
             try:
                 setattr( obj, attr_name, attr_val )
+                self.attr_generation += 1
                 return (RESP_SUCCESS, )
             except Exception, err:
                 self.logger.error( "Faield to set attribute %s to %s"%(attr_name, attr_val ) )
@@ -172,7 +700,7 @@ class PythonServer:
 
     def on_import_module( self, msg ):
         #MSG_IMPORT_MODULE
-        msg_id, mod_name = msg
+        msg_code, mod_name = msg
         try:
             module = __import__( mod_name )
             return (RESP_SUCCESS, self.register_object( module ) )
@@ -185,113 +713,1722 @@ class PythonServer:
         #>(msg, obj_id )
         #<(resp-true)
         #<(resp-false)
-        msg_id, obj_id = msg
+        msg_code, obj_id = msg
+        if self.release_objects( [obj_id] ):
+            return (RESP_NOT_REGISTERED, obj_id)
+        return (RESP_SUCCESS, )
+
+    def on_release_many( self, msg ):
+        """Client says that the objects are no more needed. Returns IDs of the objects, that were not registered"""
+        #MSG_RELEASE_MANY
+        msg_code, obj_ids = msg
+        return (RESP_SUCCESS, self.release_objects( obj_ids ) )
+
+    def release_objects( self, obj_ids ):
+        """Current connection releases one reference to every object (ID can be repeated to release many references).
+        Objects, not needed by any connection, are removed from the internal map. Returns list of the IDs, that were not registered"""
+        release = self.objects.release
+        connection = self.current_connection
+        return [ obj_id for obj_id in obj_ids if not release( obj_id, connection ) ]
+
+    def on_renew_lease( self, msg ):
+        """Lease is renewed by every request, so nothing to do here. Returns the lease time"""
+        #MSG_RENEW_LEASE
+        return (RESP_SUCCESS, self.lease_time)
+
+    def on_get_item( self, msg ):
+        """Returns obj[key]"""
+        msg_code, obj_id, key = msg
+        try:
+            obj = self.objects[ obj_id ]
+            key = self.unwrap_argument( key )
+            try:
+                return (RESP_SUCCESS, self.wrap_returned( obj[ key ] ) )
+            except Exception, err:
+                return (RESP_EXCEPT, err)
+        except KeyError:
+            return (RESP_NOT_REGISTERED, obj_id)
+
+    def on_call_method( self, msg ):
+        """Calls method of the object by one request, without remoting the method itself"""
+        #MSG_CALL_METHOD
+        msg_code, obj_id, name, args = msg
         try:
-            del self.objects[ obj_id ]
-            #self.logger.debug( "Released object %d"%(obj_id)
-            return (RESP_SUCCESS, )
+            obj = self.objects[ obj_id ]
         except KeyError:
             return (RESP_NOT_REGISTERED, obj_id)
+        try:
+            method = getattr( obj, name )
+        except AttributeError:
+            return (RESP_NO_SUCH_ATTR, name)
+        try:
+            return (RESP_SUCCESS, self.wrap_returned( method( *self.unwrap_argument( args ) ) ) )
+        except Exception, err:
+            return (RESP_EXCEPT, err)
+
+    def on_prepare( self, msg ):
+        """Creates stub of the prepared call, and registers it as remote object"""
+        #MSG_PREPARE
+        msg_code, obj_id, arg_format, kwargs = msg
+        try:
+            obj = self.objects[ obj_id ]
+        except KeyError:
+            return (RESP_NOT_REGISTERED, obj_id)
+        try:
+            stub = CallStub( obj, arg_format, self.unwrap_argument( kwargs ) )
+        except Exception, err:
+            return (RESP_EXCEPT, err)
+        return (RESP_SUCCESS, RemoteObjectWrapper( self.register_object( stub ) ))
+
+    def on_invoke( self, msg ):
+        """Calls the prepared stub with the packed arguments"""
+        #MSG_INVOKE
+        msg_code, stub_id, data = msg
+        try:
+            stub = self.objects[ stub_id ]
+        except KeyError:
+            return (RESP_NOT_REGISTERED, stub_id)
+        try:
+            return (RESP_SUCCESS, self.wrap_returned( stub( data ) ))
+        except Exception, err:
+            return (RESP_EXCEPT, err)
+
+    def on_iterate( self, msg ):
+        """Returns the next items of the iterator.
+        If start is True, iterator of the object is created first, and registered, if it may have more items."""
+        #MSG_ITERATE
+        msg_code, obj_id, count, start = msg
+        try:
+            obj = self.objects[ obj_id ]
+        except KeyError:
+            return (RESP_NOT_REGISTERED, obj_id)
+        try:
+            iterator = iter( obj ) if start else obj
+        except Exception, err:
+            return (RESP_EXCEPT, err)
+        items = []
+        error = None #Raised by the iterator after the items: reported after them
+        try:
+            for item in itertools.islice( iterator, count ):
+                items.append( item )
+        except Exception, err:
+            error = err
+        more = error is None and len( items ) == count
+        if more and start:
+            more = RemoteObjectWrapper( self.register_object( iterator ) )
+        wrap_returned = self.wrap_returned
+        return (RESP_SUCCESS, [ wrap_returned( item ) for item in items ], more, error)
+
+    def on_batch( self, msg ):
+        """Executes a chain of deferred operations in one go.
+        Operations can use results of the previous operations (as PromiseRef) for the target and arguments.
+        Only the results of the wanted operations are wrapped and returned.
+        """
+        #MSG_BATCH
+        msg_code, ops, wanted = msg
+        promised = dict() #slot -> value of the succeeded operation
+        failed = dict() #slot -> response tuple of the failed operation
+        for slot, op_code, target, operand in ops:
+            try:
+                obj = self.unwrap_argument( target, promised )
+                if op_code == MSG_GET_ATTRIBUTE:
+                    try:
+                        promised[ slot ] = getattr( obj, operand )
+                    except AttributeError:
+                        failed[ slot ] = (RESP_NO_SUCH_ATTR, )
+                elif op_code == MSG_CALL:
+                    promised[ slot ] = obj( *self.unwrap_argument( operand, promised ) )
+                elif op_code == MSG_GET_ITEM:
+                    promised[ slot ] = obj[ self.unwrap_argument( operand, promised ) ]
+                else:
+                    raise ValueError( "Operation %s can not be deferred"%msg_name( op_code ) )
+            except UnknownObjectError, err:
+                ref = err.args[0]
+                if isinstance( ref, PromiseRef ) and ref.slot in failed:
+                    failed[ slot ] = failed[ ref.slot ] #Failure of the argument propagates to the dependent operations
+                else:
+                    failed[ slot ] = (RESP_NOT_REGISTERED, ref)
+            except Exception, err:
+                failed[ slot ] = (RESP_EXCEPT, err)
+        results = []
+        for slot in wanted:
+            if slot in promised:
+                results.append( (slot, (RESP_SUCCESS, self.wrap_returned( promised[ slot ] ) ) ) )
+            else:
+                results.append( (slot, failed[ slot ]) )
+        return (RESP_SUCCESS, results)
+
+    def on_stop_server( self, msg ):
+        """Client requested server stop"""
+        #MSG_STOP_SERVER
+        self.stop_requested = True
+        return (RESP_SUCCESS, )
 
     def on_get_attr_list( self, msg ):
         #MSG_GET_ATTR_LIST
-        msg_id, obj_id = msg
+        msg_code, obj_id = msg
         try:
             obj = self.objects[ obj_id ]
             return (RESP_SUCCESS, dir( obj ) )
         except KeyError:
             return (RESP_NOT_REGISTERED, obj_id)
 
-class ServerThread( threading.Thread ):
+class CallStub( object ):
+    """Prepared call: function with the bound keyword arguments, and the struct of its positional arguments.
+    Called with the packed arguments."""
+    __slots__ = ("function", "unpack", "kwargs")
+
+    def __init__( self, function, arg_format, kwargs ):
+        self.function = function
+        self.unpack = struct.Struct( arg_format ).unpack
+        self.kwargs = kwargs
+
+    def __call__( self, data ):
+        if self.kwargs:
+            return self.function( *self.unpack( data ), **self.kwargs )
+        return self.function( *self.unpack( data ) )
+
+class ObjectRegistry:
+    """Objects, exposed to the clients, with the reference counts of every connection.
+    Remote ID is the slot number, tagged with the generation of the slot: when the slot is reused, 
+    old IDs become unknown, instead of referencing the new object.
+    Also counts objects and their memory (shallow size), held by every connection, and enforces limits of them.
+    """
+    SLOT_BITS = 32
+    SLOT_MASK = (1 << SLOT_BITS) - 1
+
+    def __init__( self ):
+        self.slots = [] #Slot is the list [object, generation, {connection: count of references}]. Free slot has None holders
+        self.free = [] #Numbers of the free slots
+        self.slot_by_identity = dict() #Map id(object) -> slot number, used to give one ID to the same object
+        self.held = dict() #Map connection -> set of the slot numbers, it holds
+        self.memory = dict() #Map connection -> total size of the held objects
+        self.max_objects = None #Maximal number of objects, held by one connection. None: no limit
+        self.max_memory = None #Maximal total size of the objects, held by one connection (bytes). None: no limit
+
+    def __len__( self ):
+        return len( self.slot_by_identity )
+
+    def __contains__( self, remote_id ):
+        try:
+            self[ remote_id ]
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__( self, remote_id ):
+        try:
+            obj, generation, holders = self.slots[ remote_id & self.SLOT_MASK ]
+        except (IndexError, TypeError):
+            raise KeyError, remote_id
+        if generation != remote_id >> self.SLOT_BITS or holders is None:
+            raise KeyError, remote_id
+        return obj
+
+    def add( self, obj, connection ):
+        """Adds reference of the connection to the object, returns remote ID of the object"""
+        slot = self.slot_by_identity.get( id( obj ) )
+        if slot is None:
+            self._check_limits( connection, obj )
+            if self.free:
+                slot = self.free.pop()
+                entry = self.slots[ slot ]
+                entry[0] = obj
+                entry[2] = dict()
+            else:
+                slot = len( self.slots )
+                entry = [ obj, 0, dict() ]
+                self.slots.append( entry )
+            self.slot_by_identity[ id( obj ) ] = slot
+        else:
+            entry = self.slots[ slot ]
+        holders = entry[2]
+        if connection in holders:
+            holders[ connection ] += 1
+        else:
+            if len( holders ): #New object is already checked
+                self._check_limits( connection, obj )
+            holders[ connection ] = 1
+            self.held.setdefault( connection, set() ).add( slot )
+            self.memory[ connection ] = self.memory.get( connection, 0 ) + sys.getsizeof( obj, 0 )
+        return slot | (entry[1] << self.SLOT_BITS)
+
+    def _check_limits( self, connection, obj ):
+        if self.max_objects is not None and len( self.held.get( connection, () ) ) >= self.max_objects:
+            raise TooManyObjectsError, "Connection holds %d remote objects already"%self.max_objects
+        if self.max_memory is not None and \
+                self.memory.get( connection, 0 ) + sys.getsizeof( obj, 0 ) > self.max_memory:
+            raise TooManyObjectsError, "Connection holds too much memory in the remote objects"
+
+    def release( self, remote_id, connection ):
+        """Removes one reference of the connection to the object. Returns False, if the object or the reference is unknown"""
+        try:
+            slot = remote_id & self.SLOT_MASK
+            obj, generation, holders = self.slots[ slot ]
+        except (IndexError, TypeError):
+            return False
+        if generation != remote_id >> self.SLOT_BITS or holders is None or connection not in holders:
+            return False
+        count = holders[ connection ]
+        if count > 1:
+            holders[ connection ] = count - 1
+        else:
+            self._drop( slot, connection )
+        return True
+
+    def forget( self, connection ):
+        """Removes all references of the connection"""
+        for slot in self.held.get( connection, set() ).copy():
+            self._drop( slot, connection )
+        self.held.pop( connection, None )
+        self.memory.pop( connection, None )
+
+    def _drop( self, slot, connection ):
+        """Removes all references of the connection to the object in the slot. Frees the slot, if nobody holds it"""
+        entry = self.slots[ slot ]
+        obj, holders = entry[0], entry[2]
+        del holders[ connection ]
+        self.held[ connection ].discard( slot )
+        self.memory[ connection ] -= sys.getsizeof( obj, 0 )
+        if not holders:
+            del self.slot_by_identity[ id( obj ) ]
+            entry[0] = None
+            entry[1] += 1 #Old IDs of the slot become invalid
+            entry[2] = None
+            self.free.append( slot )
+
+    def usage( self, connection ):
+        """Returns number of the objects, held by the connection, and their total size"""
+        return len( self.held.get( connection, () ) ), self.memory.get( connection, 0 )
+
+class ClientConnection:
+    """Server side of the connection with one client: executes requests and sends responses.
+    Subclasses define, how messages are read and written.
+    """
     def __init__( self, python_server, socket, address, logger ):
-        threading.Thread.__init__( self )
         self.socket = socket
         self.python_server = python_server
         self.address = address
         self.logger = logger
-        self.handlers = {
-            MSG_GET_GLOBALS: python_server.on_get_globals,
-            MSG_GET_ATTRIBUTE: python_server.on_get_obj_attr,
-            MSG_CALL: python_server.on_call,
-            MSG_SET_ATTRIBUTE: python_server.on_set_attr,
-            MSG_IMPORT_MODULE: python_server.on_import_module,
-            MSG_RELEASE_OBJECT: python_server.on_release_object,
-            MSG_GET_ATTR_LIST: python_server.on_get_attr_list }
+        self.handlers = python_server.get_handlers()
+        self.attr_generation = 0 #Generation of the attributes, last reported to the client
+        self.compression = None #Compression of the big frames, agreed with the client
+        self.encode_time = 0.0 #Time of encoding and size of the last response
+        self.encoded_size = 0
+        recorder = python_server.recorder
+        self.tap = recorder.new_stream( server_side=True ) if recorder is not None else None #WireStream, if recorded
+        self.lease_expires = None
+        self.renew_lease()
+
+    def renew_lease( self ):
+        lease_time = self.python_server.lease_time
+        if lease_time is not None:
+            self.lease_expires = time.time() + lease_time
+
+    def expire( self ):
+        """Called, when the lease is expired: connection must be closed"""
+        try:
+            self.socket.shutdown( socket.SHUT_RDWR ) #Reading thread will exit and close the connection
+        except socket.error:
+            pass
+
+    def enable_compression( self, compression ):
+        """Big frames, sent to the client, are compressed from now on"""
+        self.compression = compression
+
+    def process_frame( self, frame, size=0, decode_time=0.0 ):
+        """Processes received frame. Returns False, if the connection must be closed
+        size, decode_time: size of the serialized frame and the time of its decoding, for the metrics"""
+        if self.python_server.lease_time is not None:
+            self.renew_lease()
+        #Every request is enveloped with the ID, that is echoed back with the response
+        msg_id, msg = frame[0], frame[1]
+        #Client could piggyback IDs of the released objects
+        released = frame[2] if len( frame ) > 2 else None
+        assert (isinstance( msg, tuple ) )
+        msg_code = msg[0]
+
+        if msg_code == MSG_BYE:
+            if released:
+                self.dispatch( None, None, released )
+            self.logger.info( "Close request received" )
+            return False
+
+        self.dispatch( msg_id, msg, released, size, decode_time )
+        return True
+
+    def dispatch( self, msg_id, msg, released, size=0, decode_time=0.0 ):
+        """Executes the request. Overridden by the connections, that execute requests in the other thread"""
+        self.execute( msg_id, msg, released, size, decode_time )
+
+    def execute( self, msg_id, msg, released, size=0, decode_time=0.0 ):
+        """Executes request and sends response. Message may be None, if only released objects are reported"""
+        python_server = self.python_server
+        python_server.current_connection = self
+        start = time.time()
+        python_server.unwrap_time = python_server.wrap_time = 0.0
+        if released:
+            python_server.release_objects( released )
+        if msg is None:
+            return
+        try:
+            handler = self.handlers[ msg[0] ]
+        except KeyError, key:
+            self.respond( msg_id, (RESP_EXCEPT, ValueError( "Unknown message:%s"%key ) ) )
+            self.logger.error( "Unknown message: %s"%key )
+            return
+        try:
+            if python_server.profiler is not None and python_server.profiled_connection in (None, self):
+                resp = python_server.execute_profiled( handler, msg )
+            else:
+                resp = handler( msg )
+        except Exception, err:
+            self.logger.error( "Failed to process message %s: %s"%(msg_name( msg[0] ), err) )
+            resp = (RESP_EXCEPT, err)
+        handled = time.time() - start
+        self.encode_time = 0.0
+        self.respond( msg_id, resp )
+        metrics = python_server.metrics
+        if metrics is not None:
+            unwrap_time, wrap_time = python_server.unwrap_time, python_server.wrap_time
+            metrics.record( msg[0], decode_time + handled + self.encode_time, size, self.encoded_size,
+                            (decode_time, unwrap_time, handled - unwrap_time - wrap_time, wrap_time, self.encode_time) )
+
+    def encode_response( self, msg_id, message ):
+        """Serializes the response (see encode_message). Its size and encoding time are kept for the metrics"""
+        start = time.time()
+        data, buffers = encode_message( self.envelope( msg_id, message ) )
+        self.encode_time = time.time() - start
+        self.encoded_size = len( data ) + sum( map( len, buffers ) ) if buffers else len( data )
+        return data, buffers
+
+    def respond( self, msg_id, message ):
+        raise NotImplementedError
+
+    def envelope( self, msg_id, message ):
+        """Returns frame of the response. If attributes were set since the last response, new generation is reported with it"""
+        generation = self.python_server.attr_generation
+        if generation != self.attr_generation:
+            self.attr_generation = generation
+            return (msg_id, message, generation)
+        return (msg_id, message)
+
+class ServerThread( ClientConnection, threading.Thread ):
+    """Connection with one client, read by the blocking socket.
+    In the single-threaded server, run() is called directly, and requests are executed immediately.
+    In the multithreaded server, run() only reads requests and puts them to the queue of the server.
+    """
+    def __init__( self, python_server, socket, address, logger, queued=False ):
+        threading.Thread.__init__( self )
+        ClientConnection.__init__( self, python_server, socket, address, logger )
+        self.queued = queued
+        self.channel = MessageChannel( socket )
+        self.channel.enable_recording( self.tap )
+        self.write_lock = threading.Lock()
+
+    def run( self ):
+        """Main loop: receive messages and respond to them"""
+        logger = self.logger
+        channel = self.channel
+        try:
+            while True:
+                frame = channel.receive()
+                if not self.process_frame( frame, channel.last_size, channel.last_decode_time ):
+                    break
+                if self.python_server.stop_requested and not self.queued:
+                    break
+        except EOFError:
+            logger.info( "Client closed connection" )
+        except Exception, err:
+            logger.error( "Exception (%s) occurred while communicating with client: %s"%(type(err), err) )
+
+        self.close()
+
+    def enable_compression( self, compression ):
+        ClientConnection.enable_compression( self, compression )
+        self.channel.enable_compression( compression )
+
+    def dispatch( self, msg_id, msg, released, size=0, decode_time=0.0 ):
+        """Executes request immediately, or puts it to the queue of the multithreaded server"""
+        if self.queued:
+            self.python_server.requests.put( (self.execute, (msg_id, msg, released, size, decode_time)) )
+        else:
+            self.execute( msg_id, msg, released, size, decode_time )
+
+    def respond( self, msg_id, message ):
+        with self.write_lock:
+            if self.channel is None:
+                return #Connection is already closed.
+            try:
+                data, buffers = self.encode_response( msg_id, message )
+                self.channel.send_encoded( data, buffers )
+            except Exception, err:
+                self.logger.error( "Failed to send response: %s"%err )
+
+    def close( self ):
+        with self.write_lock:
+            try:
+                self.channel.close()
+            except Exception,err:
+                self.logger.error( "Error closing socket:%s"%err )
+            self.channel = None
+        python_server = self.python_server
+        if self.queued:
+            python_server.connections.remove( self )
+            python_server.requests.put( (python_server.forget_connection, (self,)) )
+        else:
+            python_server.forget_connection( self )
+
+class EventLoopConnection( ClientConnection ):
+    """Connection with one client, served by the EventLoop: non-blocking socket with the read and write buffers"""
+    def __init__( self, event_loop, socket, address, logger ):
+        ClientConnection.__init__( self, event_loop.python_server, socket, address, logger )
+        self.event_loop = event_loop
+        self.reader = FrameReader()
+        self.reader.tap = self.tap
+        self.out_buffer = OutputBuffer() #Encoded frames, not yet sent
+        self.closed = False
+
+    def on_readable( self ):
+        """Reads available data and processes all complete frames"""
+        try:
+            messages = self.reader.receive( self.socket )
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.logger.error( "Exception (%s) occurred while communicating with client: %s"%(type(err), err) )
+            self.close()
+            return
+        except EOFError:
+            self.logger.info( "Client closed connection" )
+            self.close()
+            return
+        except Exception, err:
+            self.logger.error( "Exception (%s) occurred while communicating with client: %s"%(type(err), err) )
+            self.close()
+            return
+        try:
+            for frame, size, decode_time in messages:
+                if not self.process_frame( frame, size, decode_time ) or self.python_server.stop_requested:
+                    self.close()
+                    return
+        except Exception, err:
+            self.logger.error( "Exception (%s) occurred while communicating with client: %s"%(type(err), err) )
+            self.close()
+
+    def on_writable( self ):
+        """Sends as much of the buffered data, as possible"""
+        try:
+            sent_all = self.out_buffer.send( self.socket.send )
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.logger.error( "Failed to send response: %s"%err )
+            self.close()
+            return
+        if sent_all:
+            self.event_loop.set_writing( self, False )
+
+    def respond( self, msg_id, message ):
+        if self.closed:
+            return
+        was_empty = not self.out_buffer
+        try:
+            data, buffers = self.encode_response( msg_id, message )
+            if self.tap is not None:
+                self.tap.sent( data, buffers )
+            self.out_buffer.extend( make_frames( data, buffers, self.compression ) )
+        except Exception, err:
+            self.logger.error( "Failed to encode response: %s"%err )
+            return
+        if was_empty:
+            self.on_writable() #Try to send immediately, usually it succeeds
+            if self.out_buffer:
+                self.event_loop.set_writing( self, True )
+
+    def expire( self ):
+        self.close()
+
+    def enable_compression( self, compression ):
+        ClientConnection.enable_compression( self, compression )
+        self.reader.compression = compression
+
+    def flush( self ):
+        """Sends all buffered data, blocking if needed. Used before close"""
+        if self.out_buffer and not self.closed:
+            try:
+                self.socket.setblocking( 1 )
+                self.out_buffer.send_blocking( self.socket )
+            except socket.error, err:
+                self.logger.error( "Failed to send response: %s"%err )
+            self.out_buffer = OutputBuffer()
+
+    def close( self ):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self.event_loop.remove( self )
+        try:
+            self.socket.close()
+        except Exception,err:
+            self.logger.error( "Error closing socket:%s"%err )
+        self.python_server.forget_connection( self )
+
+class EventLoop:
+    """Serves all clients in one thread, using non-blocking sockets and poll (or select, where poll is not available).
+    Requests are executed immediately by the same thread.
+    """
+    def __init__( self, python_server, serversocket, logger ):
+        self.python_server = python_server
+        self.serversocket = serversocket
+        self.logger = logger
+        self.connections = dict() #Map file descriptor -> EventLoopConnection
+        self.writing = set() #Descriptors, waiting for writing
+        self.poll_timeout = 0.5 #How often stop request is checked, seconds
+        if hasattr( select, "poll" ):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+
+    def run( self ):
+        serversocket = self.serversocket
+        serversocket.setblocking( 0 )
+        self._register( serversocket.fileno(), False )
+        python_server = self.python_server
+        next_lease_check = time.time()
+        try:
+            while not python_server.stop_requested:
+                if python_server.lease_time is not None and time.time() >= next_lease_check:
+                    python_server.expire_leases( self.connections.values() )
+                    next_lease_check = time.time() + self.poll_timeout
+                for fd, readable, writable in self._poll():
+                    if fd == serversocket.fileno():
+                        self._accept()
+                        continue
+                    connection = self.connections.get( fd )
+                    if connection is None:
+                        continue #Closed while processing other events
+                    if writable:
+                        connection.on_writable()
+                    if readable and not connection.closed:
+                        connection.on_readable()
+                    if python_server.stop_requested:
+                        break
+        finally:
+            for connection in self.connections.values():
+                connection.close()
+            serversocket.close()
+
+    def _accept( self ):
+        try:
+            (clientsocket, address) = self.serversocket.accept()
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        self.logger.info( "Accepted connection from: %s"%str( address ) )
+        clientsocket.setblocking( 0 )
+        set_nodelay( clientsocket )
+        connection = EventLoopConnection( self, clientsocket, address, self.logger )
+        fd = clientsocket.fileno()
+        connection.fd = fd
+        self.connections[ fd ] = connection
+        self._register( fd, False )
+
+    def set_writing( self, connection, writing ):
+        """Enables or disables waiting for the connection to become writable"""
+        fd = connection.fd
+        if writing:
+            self.writing.add( fd )
+        else:
+            self.writing.discard( fd )
+        if self.poller is not None:
+            self.poller.modify( fd, self._poll_mask( writing ) )
+
+    def remove( self, connection ):
+        fd = connection.fd
+        del self.connections[ fd ]
+        self.writing.discard( fd )
+        if self.poller is not None:
+            self.poller.unregister( fd )
+
+    def _poll_mask( self, writing ):
+        if writing:
+            return select.POLLIN | select.POLLOUT
+        return select.POLLIN
+
+    def _register( self, fd, writing ):
+        if self.poller is not None:
+            self.poller.register( fd, self._poll_mask( writing ) )
+
+    def _poll( self ):
+        """Waits for events, returns list of (fd, readable, writable)"""
+        try:
+            if self.poller is not None:
+                error_mask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+                return [ (fd, bool( event & (select.POLLIN | error_mask) ), bool( event & select.POLLOUT ) )
+                         for fd, event in self.poller.poll( self.poll_timeout * 1000 ) ]
+            readable_fds = self.connections.keys() + [ self.serversocket.fileno() ]
+            readable, writable, exceptional = select.select( readable_fds, list( self.writing ), [], self.poll_timeout )
+            readable = set( readable )
+            writable = set( writable )
+            return [ (fd, fd in readable, fd in writable ) for fd in readable | writable ]
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+
+class MessageChannel:
+    """Blocking socket connection, that transfers messages as frames.
+    Data is received into the reusable buffer, as much as available, so small frames usually need one recv_into call.
+    Out-of-band buffers are sent from their memory, and received into the new bytearrays of the exact size.
+    """
+    def __init__( self, sock, buffer_size=65536 ):
+        self.socket = sock
+        set_nodelay( sock )
+        self.buffer = bytearray( buffer_size )
+        self.view = memoryview( self.buffer )
+        self.start = 0 #Begin of the not yet decoded data in the buffer
+        self.end = 0 #End of the received data in the buffer
+        self.compression = None #Compression of the big frames (see Compression); received frames are decompressed anyway
+        self.last_size = 0 #Size of the last received message
+        self.last_decode_time = 0.0
+        self.tap = None #WireStream, that records the messages
+
+    def enable_compression( self, compression ):
+        self.compression = compression
+
+    def enable_recording( self, tap ):
+        """Messages are recorded by the WireStream from now on (None: not recorded)"""
+        self.tap = tap
+
+    def send( self, message ):
+        self.send_encoded( *encode_message( message ) )
+
+    def send_encoded( self, data, buffers ):
+        """Sends message, encoded by encode_message"""
+        if self.tap is not None:
+            self.tap.sent( data, buffers )
+        sendall = self.socket.sendall
+        for frame in make_frames( data, buffers, self.compression ):
+            sendall( frame )
+
+    def receive( self ):
+        """Receives the next message, together with the out-of-band buffers, sent before it.
+        Its size (with the buffers) and the time of decoding are kept in last_size and last_decode_time."""
+        buffers = None
+        received = 0 #Size of the buffers
+        decode_time = 0.0
+        while True:
+            start = self.start
+            available = self.end - start
+            if available < FRAME_HEADER_SIZE:
+                self._fill( FRAME_HEADER_SIZE )
+                start = self.start
+                available = self.end - start
+            size, = FRAME_HEADER.unpack_from( self.buffer, start )
+            if size & FRAME_BUFFER_FLAG:
+                if buffers is None:
+                    buffers = []
+                data = self._receive_raw( size & FRAME_SIZE_MASK )
+                received += len( data )
+                if size & FRAME_COMPRESSED_FLAG:
+                    decode_start = time.time()
+                    data = bytearray( decompress_frame( data, self.compression ) )
+                    decode_time += time.time() - decode_start
+                buffers.append( data )
+                continue
+            compressed = size & FRAME_COMPRESSED_FLAG
+            size &= FRAME_SIZE_MASK
+            frame_size = FRAME_HEADER_SIZE + size
+            if available < frame_size and frame_size > len( self.buffer ):
+                data = self._receive_raw( size )
+            else:
+                if available < frame_size:
+                    self._fill( frame_size )
+                    start = self.start
+                self.start = start + frame_size
+                if self.start == self.end:
+                    self.start = self.end = 0
+                data = self.view[ start + FRAME_HEADER_SIZE : start + frame_size ].tobytes()
+            self.last_size = received + size
+            decode_start = time.time()
+            if compressed:
+                data = decompress_frame( data, self.compression )
+            if self.tap is not None:
+                self.tap.received( data, buffers or () )
+            if buffers or type( data ) is not str:
+                message = decode_buffer( buffer( data ), buffers )
+            else:
+                message = loads( data )
+            self.last_decode_time = decode_time + time.time() - decode_start
+            return message
+
+    def _fill( self, needed ):
+        """Receives data, until at least needed bytes are available after the start"""
+        if self.start + needed > len( self.buffer ):
+            #Move incomplete frame to the beginning of the buffer
+            available = self.end - self.start
+            self.buffer[ 0:available ] = self.view[ self.start:self.end ]
+            self.start, self.end = 0, available
+        view = self.view
+        recv_into = self.socket.recv_into
+        while self.end - self.start < needed:
+            received = recv_into( view[ self.end: ] )
+            if not received:
+                raise EOFError, "Connection closed"
+            self.end += received
+
+    def _receive_raw( self, size ):
+        """Receives data of the frame, whose header is at the start, into the separate bytearray of the exact size"""
+        data = bytearray( size )
+        view = memoryview( data )
+        begin = self.start + FRAME_HEADER_SIZE
+        available = min( self.end - begin, size )
+        view[ 0:available ] = self.view[ begin:begin+available ]
+        self.start = begin + available
+        if self.start == self.end:
+            self.start = self.end = 0
+        recv_into = self.socket.recv_into
+        while available < size:
+            received = recv_into( view[ available: ] )
+            if not received:
+                raise EOFError, "Connection closed"
+            available += received
+        return data
+
+    def close( self ):
+        self.socket.close()
+
+def set_nodelay( sock ):
+    """Disables Nagle algorithm: small frames are sent immediately"""
+    try:
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+    except (socket.error, AttributeError):
+        pass #Not a TCP socket
+
+def decode_buffer( data, buffers=None ):
+    """Deserializes message from the buffer object without copying it to string.
+    buffers: received out-of-band buffers, referenced by the message"""
+    if not buffers or Unpickler is None:
+        return load( cStringIO.StringIO( data ) )
+    unpickler = Unpickler( cStringIO.StringIO( data ) )
+    unpickler.persistent_load = lambda (index, kind): restore_buffer( kind, buffers[ index ] )
+    return unpickler.load()
+
+def encode_message( message ):
+    """Serializes message. Returns the data and the list of the out-of-band buffers (buffer objects), referenced by it"""
+    try:
+        return dumps( message, _protocol ), ()
+    except OutOfBandRequired:
+        pass
+    #Message contains OutOfBandBuffer's: pickle references to them instead of the data
+    buffers = []
+    def persistent_id( obj ):
+        if type( obj ) is OutOfBandBuffer:
+            buffers.append( obj.view )
+            return (len( buffers ) - 1, obj.kind)
+        return None
+    out = cStringIO.StringIO()
+    pickler = Pickler( out, _protocol )
+    pickler.persistent_id = persistent_id
+    pickler.dump( message )
+    return out.getvalue(), buffers
+
+def make_frames( data, buffers, compression=None ):
+    """Returns list of the data to send for the message, encoded by encode_message: headers and payloads of the frames.
+    Small message is joined with its header, to be sent by one call. Big frames are compressed, if compression is given"""
+    frames = []
+    for view in buffers:
+        flags = FRAME_BUFFER_FLAG
+        if compression is not None and len( view ) >= compression.threshold:
+            payload = compression.compress( view )
+            if payload is not None:
+                view = payload
+                flags |= FRAME_COMPRESSED_FLAG
+        if len( view ) > FRAME_SIZE_MASK: #Length would spill into the flags
+            raise ValueError, "Buffer is too big: %d bytes"%len( view )
+        frames.append( FRAME_HEADER.pack( len( view ) | flags ) )
+        frames.append( view )
+    flags = 0
+    if compression is not None and len( data ) >= compression.threshold:
+        payload = compression.compress( data )
+        if payload is not None:
+            data = payload
+            flags = FRAME_COMPRESSED_FLAG
+    if len( data ) > FRAME_SIZE_MASK:
+        raise ValueError, "Message is too big: %d bytes"%len( data )
+    if len( data ) <= SMALL_FRAME_SIZE:
+        frames.append( FRAME_HEADER.pack( len( data ) | flags ) + data )
+    else:
+        #Python 2 has no sendmsg: big frame is sent separately from the header, to avoid copying it
+        frames.append( FRAME_HEADER.pack( len( data ) | flags ) )
+        frames.append( data )
+    return frames
+
+def restore_buffer( kind, data ):
+    """Converts received out-of-band buffer (bytearray) to the type, described by the kind"""
+    if kind == "bytearray" or kind == "bytes":
+        return data
+    if kind == "str":
+        return str( data )
+    if isinstance( kind, tuple ) and kind[0] == "array":
+        typecode, byteorder = kind[1:]
+        value = array.array( typecode )
+        value.fromstring( buffer( data ) )
+        if byteorder != sys.byteorder:
+            value.byteswap()
+        return value
+    raise ProtocolException, "Unknown kind of the buffer: %s"%(kind,)
+
+class Compression:
+    """Compression of the big frames, sent by one side of the connection, and its statistics.
+    Compressed frame has FRAME_COMPRESSED_FLAG in the header, and its data starts with the one-byte ID of the codec,
+    so the receiver decompresses it without any state. Frames, that do not shrink, are sent as is.
+    """
+    def __init__( self, codec, threshold ):
+        self.codec = codec
+        self.threshold = threshold #Smaller frames are not compressed
+        self.codec_id, self.compressor, decompressor = COMPRESSION_CODECS[ codec ]
+        self.frames_compressed = 0
+        self.frames_incompressible = 0 #Big frames, that were sent as is
+        self.raw_bytes = 0 #Size of the compressed frames before the compression
+        self.compressed_bytes = 0
+        self.compress_time = 0.0 #Seconds, spent by the compressor
+        self.frames_decompressed = 0
+        self.decompressed_bytes = 0 #Size of the received frames after decompression
+        self.decompress_time = 0.0
+
+    def compress( self, data ):
+        """Returns compressed data of the frame, or None if it does not shrink"""
+        if type( data ) is not str:
+            data = data.tobytes() if isinstance( data, memoryview ) else str( data )
+        start = time.time()
+        payload = self.codec_id + self.compressor( data )
+        self.compress_time += time.time() - start
+        if len( payload ) >= len( data ):
+            self.frames_incompressible += 1
+            return None
+        self.frames_compressed += 1
+        self.raw_bytes += len( data )
+        self.compressed_bytes += len( payload )
+        return payload
+
+    def stats( self ):
+        """Returns dict with the counters. Ratio is the compressed size of the compressed frames to their original size"""
+        return dict( codec=self.codec, threshold=self.threshold,
+                     frames_compressed=self.frames_compressed, frames_incompressible=self.frames_incompressible,
+                     raw_bytes=self.raw_bytes, compressed_bytes=self.compressed_bytes,
+                     ratio=float( self.compressed_bytes ) / self.raw_bytes if self.raw_bytes else 1.0,
+                     compress_time=self.compress_time, frames_decompressed=self.frames_decompressed,
+                     decompressed_bytes=self.decompressed_bytes, decompress_time=self.decompress_time )
+
+def decompress_frame( payload, compression=None ):
+    """Returns original data (string) of the compressed frame. Time and size are counted by the compression, if given"""
+    if type( payload ) is not str:
+        payload = payload.tobytes() if isinstance( payload, memoryview ) else str( payload )
+    try:
+        decompressor = COMPRESSION_DECOMPRESSORS[ payload[0] ]
+    except (KeyError, IndexError):
+        raise ProtocolException, "Unknown compression of the frame: %r"%payload[:1]
+    start = time.time()
+    data = decompressor( payload[1:] )
+    if compression is not None:
+        compression.decompress_time += time.time() - start
+        compression.frames_decompressed += 1
+        compression.decompressed_bytes += len( data )
+    return data
+
+class FrameReader:
+    """Incremental parser of the frames, received by the non-blocking socket.
+    Out-of-band buffers are received directly into the bytearrays of the exact size"""
+    def __init__( self ):
+        self.chunks = [] #Received data of the incomplete frames
+        self.size = 0 #Total size of the received chunks
+        self.needed = FRAME_HEADER.size #Chunks are not joined, until so many bytes are received
+        self.buffers = [] #Out-of-band buffers of the next message
+        self.compressed_buffers = [] #Indexes of the compressed buffers of the next message
+        self.raw = None #Not yet received part of the last out-of-band buffer (memoryview)
+        self.compression = None #Compression of the connection: counts decompressed frames
+        self.tap = None #WireStream, that records the messages
+
+    def receive( self, sock ):
+        """Receives available data from the non-blocking socket, returns list of the messages from the complete frames,
+        as (message, size, decoding time). Raises EOFError, if connection is closed"""
+        raw = self.raw
+        if raw is not None:
+            received = sock.recv_into( raw )
+            if not received:
+                raise EOFError, "Connection closed"
+            self.raw = raw[ received: ] if received < len( raw ) else None
+            return []
+        data = sock.recv( 65536 )
+        if not data:
+            raise EOFError, "Connection closed"
+        return self.feed( data )
+
+    def feed( self, data ):
+        """Adds received data, returns list of (message, size, decoding time) from the complete frames"""
+        self.chunks.append( data )
+        self.size += len( data )
+        if self.size < self.needed:
+            return [] #Big frame is being received: avoid joining chunks many times
+        buf = "".join( self.chunks )
+        header_size = FRAME_HEADER.size
+        offset = 0
+        needed = header_size
+        messages = []
+        while len( buf ) - offset >= header_size:
+            size, = FRAME_HEADER.unpack_from( buf, offset )
+            begin = offset + header_size
+            compressed = size & FRAME_COMPRESSED_FLAG
+            if size & FRAME_BUFFER_FLAG:
+                #Out-of-band buffer: the rest of it is received by receive() directly into the bytearray
+                size &= FRAME_SIZE_MASK
+                if compressed:
+                    self.compressed_buffers.append( len( self.buffers ) ) #Decompressed, when it is complete
+                data = bytearray( size )
+                available = min( len( buf ) - begin, size )
+                data[ 0:available ] = buffer( buf, begin, available )
+                self.buffers.append( data )
+                offset = begin + available
+                if available < size:
+                    self.raw = memoryview( data )[ available: ]
+                    break
+                continue
+            size &= FRAME_SIZE_MASK
+            end = begin + size
+            if end > len( buf ):
+                needed = header_size + size #Incomplete frame
+                break
+            decode_start = time.time()
+            if compressed:
+                data = decompress_frame( buffer( buf, begin, size ), self.compression )
+            elif self.buffers:
+                data = buffer( buf, begin, size )
+            else:
+                data = buf[ begin : end ]
+            buffers = self.buffers
+            if buffers:
+                for index in self.compressed_buffers:
+                    buffers[ index ] = bytearray( decompress_frame( buffers[ index ], self.compression ) )
+                self.buffers = []
+                self.compressed_buffers = []
+            if self.tap is not None:
+                self.tap.received( data, buffers )
+            if buffers:
+                size += sum( map( len, buffers ) )
+                message = decode_buffer( data, buffers )
+            else:
+                message = loads( data )
+            messages.append( (message, size, time.time() - decode_start) )
+            offset = end
+        rest = buf[ offset: ]
+        self.chunks = [ rest ]
+        self.size = len( rest )
+        self.needed = needed
+        return messages
+
+class OutputBuffer:
+    """Data of the non-blocking socket, not yet sent.
+    Small frames are joined and sent by one call; big buffers are sent from their memory, without copying.
+    """
+    def __init__( self ):
+        self.chunks = collections.deque()
+
+    def __nonzero__( self ):
+        return bool( self.chunks )
+
+    def extend( self, chunks ):
+        self.chunks.extend( chunks )
+
+    def send( self, send ):
+        """Sends data by the given function (socket.send), until it accepts less, than given. Returns True, if everything is sent"""
+        chunks = self.chunks
+        while chunks:
+            chunk = chunks.popleft()
+            if type( chunk ) is str and len( chunk ) < SMALL_FRAME_SIZE and chunks:
+                parts = [ chunk ]
+                size = len( chunk )
+                while chunks and type( chunks[0] ) is str and size + len( chunks[0] ) <= 65536:
+                    part = chunks.popleft()
+                    parts.append( part )
+                    size += len( part )
+                chunk = "".join( parts )
+            try:
+                sent = send( chunk )
+            except Exception:
+                chunks.appendleft( chunk )
+                raise
+            if sent < len( chunk ):
+                chunks.appendleft( buffer( chunk, sent ) )
+                return False
+        return True
+
+    def send_blocking( self, sock ):
+        """Sends all data by the blocking socket"""
+        while self.chunks:
+            sock.sendall( self.chunks.popleft() )
+
+class OutOfBandRequired( Exception ):
+    """Raised when OutOfBandBuffer is serialized without the support of the out-of-band buffers. Handled by encode_message"""
+    pass
+
+class OutOfBandBuffer( object ):
+    """Marks the buffer value in the message: its data is sent as the separate raw frame before the message,
+    directly from the memory of the value, without serialization"""
+    __slots__ = ("view", "kind")
+    def __init__( self, value ):
+        if isinstance( value, str ):
+            self.kind = "str"
+        elif isinstance( value, bytearray ):
+            self.kind = "bytearray"
+        elif isinstance( value, array.array ):
+            self.kind = ("array", value.typecode, sys.byteorder)
+        else:
+            self.kind = "bytes" #Other buffers are received as bytearrays
+        if isinstance( value, memoryview ):
+            self.view = value
+        else:
+            self.view = buffer( value )
+        if len( self.view ) > FRAME_SIZE_MASK:
+            raise ValueError, "Buffer is too big: %d bytes"%len( self.view )
+
+    def __reduce_ex__( self, protocol ):
+        raise OutOfBandRequired
+
+    def __repr__( self ):
+        return "BUFFER(%s, %d)"%(self.kind, len( self.view ))
+
+class RemoteObjectWrapper:
+    """Wrapper, used to transfer information about the remote objects via connection. Simply wraps the remote ID"""
+    def __init__( self, remote_id ):
+        self.remote_id = remote_id
+    def __str__( self ):
+        return "REMOTE(%d)"%self.remote_id
+    def __repr__( self ):
+        return "REMOTE(%s)"%self.remote_id
+
+class PromiseRef:
+    """Wrapper, used to reference result of the other operation in the same MSG_BATCH. Simply wraps the slot number"""
+    def __init__( self, slot ):
+        self.slot = slot
+    def __repr__( self ):
+        return "PROMISE(%s)"%self.slot
+
+class LRUCache:
+    """Results of the pure function: keeps the max_size recently used ones, and counts hits, misses and evictions"""
+    def __init__( self, max_size, name ):
+        self.max_size = max_size
+        self.name = name
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get( self, key, default=None ):
+        items = self.items
+        value = items.pop( key, MISSING )
+        if value is MISSING:
+            self.misses += 1
+            return default
+        items[ key ] = value #Most recently used goes to the end
+        self.hits += 1
+        return value
+
+    def put( self, key, value ):
+        items = self.items
+        items[ key ] = value
+        if len( items ) > self.max_size:
+            items.popitem( last=False )
+            self.evictions += 1
+
+    def stats( self ):
+        """Returns dict with the counters and the current size"""
+        return dict( hits=self.hits, misses=self.misses, evictions=self.evictions, size=len( self.items ) )
+
+def object_name( obj ):
+    """Returns readable name of the remoted object: module.function, module.Class.method, or the type of the instance"""
+    if isinstance( obj, CallStub ):
+        obj = obj.function
+    name = getattr( obj, "__name__", None )
+    if not isinstance( name, basestring ):
+        return "<%s object>"%type( obj ).__name__
+    owner = getattr( obj, "im_class", None ) or getattr( obj, "__self__", None )
+    if owner is not None and not isinstance( owner, types.ModuleType ):
+        owner_name = getattr( owner, "__name__", None )
+        if not isinstance( owner_name, basestring ):
+            owner_name = type( owner ).__name__
+        name = "%s.%s"%(owner_name, name)
+    module = getattr( obj, "__module__", None )
+    if isinstance( module, basestring ):
+        return "%s.%s"%(module, name)
+    return name
+
+class ReceivedProfile:
+    """Profile, received from the server, in the form that pstats.Stats loads"""
+    def __init__( self, stats ):
+        self.stats = stats
+
+    def create_stats( self ):
+        pass
+
+def profile_stats( profile, stream=None ):
+    """Returns pstats.Stats of the profile, returned by stop_profiling, for sorting and printing:
+        profile_stats( far_side.stop_profiling() ).sort_stats( "cumulative" ).print_stats( 20 )"""
+    return pstats.Stats( ReceivedProfile( profile[ "functions" ] ), stream=stream )
+
+def is_immutable_value( value ):
+    """True for the scalars, strings and tuples of them: such values can be shared by the callers"""
+    value_type = type( value )
+    if value_type in SCALAR_TYPES or value_type is str:
+        return True
+    if value_type is tuple:
+        for item in value:
+            if not is_immutable_value( item ):
+                return False
+        return True
+    return False
+
+def pure_key( args ):
+    """Returns key of the pure function cache for the arguments, or None if they can't be cached.
+    Types are the part of the key, because 1, 1.0 and True are equal."""
+    if not is_immutable_value( args ):
+        return None
+    return tuple( [ (type( arg ), arg) for arg in args ] )
+
+HISTOGRAM_BUCKETS = 32 #Bucket N counts latencies below 2**N microseconds (and not below 2**(N-1)); the last one counts the rest
+PHASES = ("decode", "unwrap", "execute", "wrap", "encode") #Parts of the request time on the server
+
+class MessageStats:
+    """Counters of one message type: requests, bytes, total time and the histogram of latencies"""
+    def __init__( self ):
+        self.count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.time = 0.0
+        self.histogram = [ 0 ] * HISTOGRAM_BUCKETS
+        self.phases = [ 0.0 ] * len( PHASES ) #Total time of every phase, if they are recorded
+
+    def percentile( self, fraction ):
+        """Returns upper bound of the histogram bucket of the given fraction of the requests, in microseconds"""
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate( self.histogram ):
+            seen += count
+            if seen >= rank and count:
+                return 1 << bucket
+        return 1 << (HISTOGRAM_BUCKETS - 1)
+
+    def snapshot( self ):
+        count = self.count
+        result = dict( count=count, bytes_in=self.bytes_in, bytes_out=self.bytes_out, time=self.time,
+                       mean_us=self.time / count * 1e6 if count else 0.0,
+                       p50_us=self.percentile( 0.5 ), p90_us=self.percentile( 0.9 ), p99_us=self.percentile( 0.99 ),
+                       histogram=[ (1 << bucket, n) for bucket, n in enumerate( self.histogram ) if n ] )
+        if any( self.phases ):
+            result[ "phases" ] = dict( zip( PHASES, self.phases ) )
+        return result
+
+class Metrics:
+    """Counts requests of every message type: bytes in and out, latency histogram, and (on the server) time of the phases.
+    Recording is a few additions, so the metrics may be always on. Requests are recorded by one thread at a time.
+    """
+    def __init__( self ):
+        self.messages = dict() #Map message code -> MessageStats
+        self.started = time.time()
+
+    def record( self, code, latency, bytes_in, bytes_out, phases=None ):
+        """Records one request. latency is in seconds; phases are the times in the order of PHASES"""
+        stats = self.messages.get( code )
+        if stats is None:
+            stats = self.messages[ code ] = MessageStats()
+        stats.count += 1
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+        stats.time += latency
+        bucket = int( latency * 1e6 ).bit_length()
+        stats.histogram[ bucket if bucket < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS - 1 ] += 1
+        if phases is not None:
+            totals = stats.phases
+            for index, phase_time in enumerate( phases ):
+                totals[ index ] += phase_time
+
+    def snapshot( self ):
+        """Returns dict: message name -> dict of count, bytes_in, bytes_out, time (seconds), mean_us, p50_us, p90_us, p99_us,
+        histogram ([(upper bound in microseconds, count), ...] of the non-empty buckets) and phases (seconds per PHASES name).
+        Percentiles are the upper bounds of the histogram buckets, so they are accurate to the factor of 2.
+        Key "uptime" is the time since the start or reset."""
+        result = dict( [ (msg_name( code ), stats.snapshot()) for code, stats in self.messages.items() ] )
+        result[ "uptime" ] = time.time() - self.started
+        return result
+
+    def reset( self ):
+        self.messages = dict()
+        self.started = time.time()
+
+class WireRecorder:
+    """Append-only log of the messages, passed by the connections, for the analysis and the replay (see read_wire_log).
+    Messages are recorded uncompressed, as encoded by the codec, with the time and the direction.
+    Every connection is a separate stream of the log (see new_stream); one recorder may be shared by many connections and threads.
+    """
+    def __init__( self, file_name ):
+        self.file_name = file_name
+        self.file = open( file_name, "ab" )
+        self.lock = threading.Lock()
+        self.streams = itertools.count()
+        self.records = 0
+        self.file.seek( 0, 2 )
+        if self.file.tell() == 0:
+            self.file.write( WIRE_LOG_MAGIC + chr( len( codec_name ) ) + codec_name )
+        else:
+            with open( file_name, "rb" ) as log:
+                codec = read_wire_header( log )
+            if codec != codec_name:
+                self.file.close()
+                raise ValueError, "Log %s is written with the codec %s, not %s"%(file_name, codec, codec_name)
+
+    def new_stream( self, server_side ):
+        """Returns WireStream for one connection: requests are received by the server side and sent by the client"""
+        return WireStream( self, self.streams.next(), server_side )
+
+    def record( self, stream, direction, data, buffers ):
+        header = WIRE_RECORD.pack( time.time(), stream, direction, len( buffers ), len( data ) )
+        with self.lock:
+            log = self.file
+            if log is None:
+                return #Closed: streams of the other connections may still be attached
+            log.write( header )
+            for view in buffers:
+                log.write( WIRE_BUFFER_SIZE.pack( len( view ) ) )
+            for view in buffers:
+                log.write( view )
+            log.write( data )
+            self.records += 1
+
+    def close( self ):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class WireStream:
+    """Records messages of one connection to the WireRecorder"""
+    def __init__( self, recorder, stream, server_side ):
+        self.record = recorder.record
+        self.stream = stream
+        self.sent_direction = WIRE_RESPONSE if server_side else WIRE_REQUEST
+        self.received_direction = WIRE_REQUEST if server_side else WIRE_RESPONSE
+
+    def sent( self, data, buffers ):
+        self.record( self.stream, self.sent_direction, data, buffers )
+
+    def received( self, data, buffers ):
+        self.record( self.stream, self.received_direction, data, buffers )
+
+def read_wire_header( log ):
+    """Reads header of the wire log from the file, returns name of the codec"""
+    magic = log.read( len( WIRE_LOG_MAGIC ) + 1 )
+    if len( magic ) <= len( WIRE_LOG_MAGIC ) or not magic.startswith( WIRE_LOG_MAGIC ):
+        raise ValueError, "Not a wire log"
+    return log.read( ord( magic[-1] ) )
+
+def read_wire_log( file_name ):
+    """Yields records of the wire log: (time, stream, direction, envelope), where envelope is the decoded
+    (msg_id, message[, released]) or (msg_id, response[, generation]). The codec of the log must be selected by set_codec"""
+    with open( file_name, "rb" ) as log:
+        codec = read_wire_header( log )
+        if codec != codec_name:
+            raise ValueError, "Log %s is written with the codec %s, select it by set_codec"%(file_name, codec)
+        while True:
+            header = log.read( WIRE_RECORD.size )
+            if len( header ) < WIRE_RECORD.size:
+                return #Truncated record is the end of the log, that was not closed
+            timestamp, stream, direction, buffer_count, size = WIRE_RECORD.unpack( header )
+            sizes = log.read( WIRE_BUFFER_SIZE.size * buffer_count )
+            if len( sizes ) < WIRE_BUFFER_SIZE.size * buffer_count:
+                return
+            buffers = [ bytearray( log.read( WIRE_BUFFER_SIZE.unpack_from( sizes, index * WIRE_BUFFER_SIZE.size )[0] ) )
+                        for index in xrange( buffer_count ) ]
+            data = log.read( size )
+            if len( data ) < size:
+                return
+            yield timestamp, stream, direction, decode_buffer( data, buffers )
+
+################################################################################
+# Transports
+################################################################################
+#Connections are addressed by URLs: tcp://host:port, unix:///path/of/socket, shm://name.
+#Shared memory transport is for the processes of the same host: data goes through two ring buffers in the mapped file,
+#and the unix socket is used only to establish the connection and to wake up the waiting side.
+SHM_RING_SIZE = 1 << 20 #Capacity of one direction of the shared memory connection, bytes
+SHM_HEADER = struct.Struct( "<QQII" ) #Ring header: head (written bytes), tail (read bytes), reader waits, writer waits
+SHM_HEADER_SIZE = 64
+SHM_WAIT_TIMEOUT = 0.05 #Waiting side rechecks the ring so often, in case the wakeup was missed
+try:
+    SHM_SPIN_TIME = 20e-6 if os.sysconf( "SC_NPROCESSORS_ONLN" ) > 1 else 0.0 #Reader polls the ring so long, before sleeping
+except (ValueError, OSError, AttributeError):
+    SHM_SPIN_TIME = 0.0
+
+def parse_url( url ):
+    """Returns (scheme, address) of the connection URL. Address is (host, port) for tcp, path for unix, name for shm"""
+    scheme, sep, rest = url.partition( "://" )
+    if not sep or scheme not in ("tcp", "unix", "shm"):
+        raise ValueError, "Unsupported URL: %s (tcp://host:port, unix:///path or shm://name expected)"%url
+    if scheme == "tcp":
+        host, sep, port = rest.rpartition( ":" )
+        if not sep or not port.isdigit():
+            raise ValueError, "Port expected in the URL: %s"%url
+        return scheme, (host or socket.gethostname(), int( port ))
+    if not rest:
+        raise ValueError, "Path expected in the URL: %s"%url
+    return scheme, rest
+
+def listen( url, backlog=5 ):
+    """Returns listening socket (or socket-like object) for the URL"""
+    scheme, address = parse_url( url )
+    if scheme == "tcp":
+        listener = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    elif scheme == "unix":
+        listener = UnixListener( address )
+    else:
+        listener = ShmListener( address )
+        address = listener.path
+    listener.bind( address )
+    listener.listen( backlog )
+    return listener
+
+def connect_url( url ):
+    """Returns socket (or socket-like object), connected to the URL"""
+    scheme, address = parse_url( url )
+    if scheme == "tcp":
+        sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    else:
+        sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    if scheme == "shm":
+        sock.connect( shm_socket_path( address ) )
+        return ShmSocket.connect( sock )
+    sock.connect( address )
+    return sock
+
+def shm_socket_path( name ):
+    """Unix socket, where the shared memory server accepts connections"""
+    return os.path.join( tempfile.gettempdir(), "python_remote-%s.sock"%name )
+
+class UnixListener( socket.socket ):
+    """Listening unix socket, that removes its file, when closed"""
+    def __init__( self, path ):
+        socket.socket.__init__( self, socket.AF_UNIX, socket.SOCK_STREAM )
+        self.path = path
+
+    def bind( self, path ):
+        try:
+            if stat.S_ISSOCK( os.stat( path ).st_mode ):
+                os.unlink( path ) #Left by the server, that was not stopped properly
+        except OSError:
+            pass
+        socket.socket.bind( self, path )
+
+    def close( self ):
+        socket.socket.close( self )
+        try:
+            os.unlink( self.path )
+        except OSError:
+            pass
+
+class ShmListener( UnixListener ):
+    """Accepts connections by the unix socket, and creates shared memory for every one.
+    Shared memory is faster only on the multi-core hosts, where the waiting side spins (see SHM_SPIN_TIME).
+    On one CPU spinning is disabled, every wakeup goes through the unix socket, and latency is worse than of the plain
+    unix socket or even TCP: use "unix://" there."""
+    def __init__( self, name ):
+        UnixListener.__init__( self, shm_socket_path( name ) )
+        self.name = name
+        self.counter = 0
+
+    def accept( self ):
+        sock, address = socket.socket.accept( self )
+        self.counter += 1
+        return ShmSocket.accept( sock, "python_remote-%s-%d-%d"%(self.name, os.getpid(), self.counter) ), address
+
+class ShmSocket:
+    """Connection by the shared memory: implements the part of the socket interface, used by MessageChannel.
+    Every direction is a ring buffer: writer copies data to it and advances the head, reader copies data from it 
+    and advances the tail. Side, that found the ring empty (or full), sets its wait flag and sleeps on the unix socket, 
+    until the other side sends a wakeup byte. Only blocking mode is supported.
+    """
+    def __init__( self, sock, memory, in_offset, out_offset, capacity ):
+        sock.setblocking( 0 ) #Reading and writing threads may wait on it together: one of them gets the wakeup byte
+        self.sock = sock #Unix socket: wakeups and end of the connection
+        self.memory = memory
+        self.in_offset = in_offset #Header of the ring, read by this side
+        self.out_offset = out_offset #Header of the ring, written by this side
+        self.capacity = capacity
+        self.peer_closed = False
+
+    @staticmethod
+    def accept( sock, file_name, capacity=SHM_RING_SIZE ):
+        """Server side: creates the shared file, passes its path to the client, and removes it, when client has mapped it"""
+        directory = "/dev/shm" if os.path.isdir( "/dev/shm" ) else tempfile.gettempdir()
+        path = os.path.join( directory, file_name )
+        size = 2 * (SHM_HEADER_SIZE + capacity)
+        fd = os.open( path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0600 )
+        try:
+            os.ftruncate( fd, size )
+            memory = mmap.mmap( fd, size )
+            sock.sendall( "%s %d\n"%(path, capacity) )
+            if sock.recv( 1 ) != "k":
+                raise EOFError, "Client failed to map shared memory"
+        finally:
+            os.close( fd )
+            os.unlink( path )
+        return ShmSocket( sock, memory, 0, SHM_HEADER_SIZE + capacity, capacity )
+
+    @staticmethod
+    def connect( sock ):
+        """Client side: maps the file, created by the server"""
+        line = ""
+        while not line.endswith( "\n" ):
+            data = sock.recv( 4096 )
+            if not data:
+                raise EOFError, "Server closed connection"
+            line += data
+        path, capacity = line.split()
+        capacity = int( capacity )
+        fd = os.open( path, os.O_RDWR )
+        try:
+            memory = mmap.mmap( fd, 2 * (SHM_HEADER_SIZE + capacity) )
+        finally:
+            os.close( fd )
+        sock.sendall( "k" )
+        return ShmSocket( sock, memory, SHM_HEADER_SIZE + capacity, 0, capacity )
+
+    def _header( self, offset ):
+        return SHM_HEADER.unpack_from( self.memory, offset )
+
+    def _set_flag( self, offset, index, value ):
+        struct.pack_into( "<I", self.memory, offset + 16 + 4 * index, value )
+
+    def recv_into( self, view, nbytes=0 ):
+        offset = self.in_offset
+        size = nbytes or len( view )
+        spin_until = None
+        while True:
+            head, tail, reader_waits, writer_waits = self._header( offset )
+            if head != tail:
+                count = min( head - tail, size )
+                self._copy_from( offset, tail, view, count )
+                struct.pack_into( "<Q", self.memory, offset + 8, tail + count )
+                if self._header( offset )[3]: #Writer waits for the space
+                    self._wake()
+                return count
+            if self.peer_closed:
+                return 0
+            if SHM_SPIN_TIME:
+                now = time.time()
+                if spin_until is None:
+                    spin_until = now + SHM_SPIN_TIME
+                if now < spin_until:
+                    continue
+            self._set_flag( offset, 0, 1 )
+            if self._header( offset )[0] == tail: #Checked again: writer might not see the flag
+                self._wait()
+            self._set_flag( offset, 0, 0 )
+
+    def send( self, data ):
+        offset = self.out_offset
+        capacity = self.capacity
+        while True:
+            if self.peer_closed:
+                raise socket.error, (errno.EPIPE, "Connection closed")
+            head, tail, reader_waits, writer_waits = self._header( offset )
+            free = capacity - (head - tail)
+            if free:
+                count = min( free, len( data ) )
+                self._copy_to( offset, head, data, count )
+                struct.pack_into( "<Q", self.memory, offset, head + count )
+                if self._header( offset )[2]: #Reader waits for the data
+                    self._wake()
+                return count
+            self._set_flag( offset, 1, 1 )
+            if self._header( offset )[1] == tail:
+                self._wait()
+            self._set_flag( offset, 1, 0 )
+
+    def sendall( self, data ):
+        sent = 0
+        size = len( data )
+        while sent < size:
+            sent += self.send( data[ sent: ] if sent else data )
+
+    def _copy_to( self, offset, head, data, count ):
+        """Copies count bytes of the data to the ring, at the position head"""
+        chunk = data[ :count ]
+        if type( chunk ) is not str:
+            chunk = chunk.tobytes() if isinstance( chunk, memoryview ) else str( chunk )
+        capacity = self.capacity
+        start = offset + SHM_HEADER_SIZE
+        position = head % capacity
+        first = min( count, capacity - position )
+        self.memory[ start + position : start + position + first ] = chunk[ :first ]
+        if first < count: #Wraps around
+            self.memory[ start : start + count - first ] = chunk[ first: ]
 
-    def run( self ):
-        """Main loop: receive messages and respond to them"""
-        fl = self.socket.makefile("rwb")
-        logger = self.logger
-        def respond( message ):
-            dump( message, fl, _protocol )
-            fl.flush()
+    def _copy_from( self, offset, tail, view, count ):
+        """Copies count bytes from the ring, at the position tail, to the view"""
+        capacity = self.capacity
+        start = offset + SHM_HEADER_SIZE
+        position = tail % capacity
+        first = min( count, capacity - position )
+        view[ :first ] = self.memory[ start + position : start + position + first ]
+        if first < count:
+            view[ first:count ] = self.memory[ start : start + count - first ]
 
+    def _wake( self ):
         try:
-            while True:
-                msg = load( fl )
-                assert (isinstance( msg, tuple ) )
-                msg_code = msg[0]
+            self.sock.send( "w" )
+        except socket.error, err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): #Full: other side is woken anyway
+                self.peer_closed = True
 
-                if msg_code == MSG_BYE:
-                    logger.info( "Close request received" )
-                    break
+    def _wait( self ):
+        """Sleeps until the wakeup byte arrives (or timeout). Notices, when the other side closes the connection"""
+        try:
+            readable = select.select( [ self.sock ], [], [], SHM_WAIT_TIMEOUT )[0]
+            if readable and not self.sock.recv( 4096 ):
+                self.peer_closed = True
+        except (socket.error, select.error), err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.peer_closed = True
 
-                if msg_code == MSG_STOP_SERVER:
-                    respond( (RESP_SUCCESS, ) )
-                    fl.close()
-                    self.socket.close()
-                    self.python_server.stop_requested = True
-                    break
+    def fileno( self ):
+        return self.sock.fileno()
 
-                try:
-                    respond( self.handlers[ msg[0] ]( msg ) )
-                except KeyError, key:
-                    respond( (RESP_EXCEPT, ValueError( "Unknown message:%s"%key ) ) )
-                    logger.error( "Unknown message: %s"%key )
-        except Exception, err:
-            logger.error( "Exception (%s) occurred while communicating with client: %s"%(type(err), err) )
+    def settimeout( self, timeout ):
+        if timeout is not None:
+            raise ValueError, "Shared memory connection supports only blocking mode"
 
-        try:
-            fl.close()
-            self.socket.close()
-        except Exception,err:
-            logger.error( "Error closing socket file:%s"%err )
+    def setblocking( self, flag ):
+        if not flag:
+            raise ValueError, "Shared memory connection supports only blocking mode"
 
-        self.socket = None
-        self.python_server = None
+    def shutdown( self, how ):
+        self.sock.shutdown( how ) #Other side gets the end of file, and own waiting reader wakes up
 
-class RemoteObjectWrapper:
-    """Wrapper, used to transfer information about the remote objects via connection. Simply wraps the remote ID"""
-    def __init__( self, remote_id ):
-        self.remote_id = remote_id
-    def __str__( self ):
-        return "REMOTE(%d)"%self.remote_id
-    def __repr__( self ):
-        return "REMOTE(%s)"%self.remote_id
+    def close( self ):
+        self.peer_closed = True
+        self.sock.close() #Memory is unmapped by the garbage collector: other thread may still read it
 
 ################################################################################
 #  Client objects
 ################################################################################
+class Housekeeper:
+    """Background thread, that flushes delayed releases and renews leases of the idle blocking clients
+    (see FarSide.release_delay and FarSide.lease_time).
+    One thread serves all clients of the process; it is started by the first of them."""
+    def __init__( self ):
+        self.clients = weakref.WeakKeyDictionary() #Connected clients (FarSide)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None #Process, that runs the thread: after fork, child starts own thread for own clients
+        self.interval = 0.5 #Longest sleep between the checks, seconds
+
+    def add( self, far_side ):
+        with self.lock:
+            if self.pid != os.getpid(): #Clients of the parent process are not served by the child
+                self.clients = weakref.WeakKeyDictionary()
+                self.pid = os.getpid()
+                self.thread = None
+            self.clients[ far_side ] = True
+            if self.thread is None:
+                self.thread = threading.Thread( target=self.run, name="python_remote housekeeper" )
+                self.thread.daemon = True
+                self.thread.start()
+
+    def discard( self, far_side ):
+        with self.lock:
+            self.clients.pop( far_side, None )
+
+    def run( self ):
+        while True:
+            with self.lock:
+                clients = self.clients.keys()
+            wake_time = time.time() + self.interval
+            for far_side in clients:
+                try:
+                    deadline = far_side._housekeep()
+                except Exception: #Connection is broken or closed: error is reported by the next request of the client
+                    deadline = None
+                if deadline is not None and deadline < wake_time:
+                    wake_time = deadline
+            clients = far_side = None #Do not keep clients alive while sleeping
+            time.sleep( max( 0.0, wake_time - time.time() ) )
+
+housekeeper = Housekeeper()
+
 class FarSide:
     """Client"""
-    def __init__(self, host, port, cache_all_attributes=False, connect=True ):
-        """Create client for access to the server-side objects"""
+    def __init__(self, host, port=None, cache_all_attributes=False, connect=True, compression=None ):
+        """Create client for access to the server-side objects
+        If port is None, host is the URL of the server: tcp://host:port, unix:///path/of/socket or shm://name
+        compression: codec ("zlib", "bz2", "lzma") or list of them, in the order of preference. If server allows one of them,
+        frames bigger than compression_threshold are compressed in both directions (see compression_stats())."""
         self.host = host
         self.port = port
-        self.objects = weakref.WeakValueDictionary() #Maps remoteID->local wrapper.
-        self.file = None
+        self.objects = ProxyTable() #Maps remoteID->local wrapper.
+        self.channel = None
         self.socket = None
-        self.msg_counter = 0
+        self.msg_counter = 0 #Also used as the ID of the last sent request
+        self.pending = dict() #Maps request ID -> RemoteFuture, waiting for the response
+        self.max_pending = 256 #When more requests are in flight, responses are read before sending new ones
+        self.pending_bytes = 0 #Total size of the requests in flight
+        self.max_pending_bytes = 65536 #Bigger requests are sent only when there are no other requests in flight. None: no limit
+        self.send_lock = threading.RLock()
+        self.receive_lock = threading.RLock()
         self.cache_all_attributes = cache_all_attributes
+        self.proxy_class = ProxyObject #Class of the created proxies
+        self.deferred_ops = [] #Operations of the deferred batch, not yet sent to the server
+        self.deferred_promises = weakref.WeakValueDictionary() #Maps slot->RemotePromise for the operations of the batch
+        self.deferred_arguments = [] #Original targets and operands of the deferred operations
+        self.release_queue = [] #IDs of the released objects, not yet reported to the server
+        self.release_queue_time = None #When first ID was put to the queue
+        self.release_batch_size = 1024 #Queue is sent when it has so many IDs...
+        self.release_delay = 1.0 #...or when it is older than this (in seconds). In any case, it is sent before the next request.
+        self.lease_time = None #Lease time of the server, learned by renew_lease(). If known, idle connection is renewed automatically
+        self.last_send_time = time.time() #When the last request was sent
+        self.release_lock = threading.Lock() #Guards the queue. Nothing is allocated, while it is held: proxies, collected by gc, take it too
+        self.in_io = False #True while message is being written or read; released objects are only queued then
+        self.promise_counter = 0
+        self.cache_attributes = True #Remember attributes, that server marked as cacheable
+        self.iter_batch_size = 256 #Items, fetched by one request, when remote object is iterated
+        self.pure_caches = dict() #Map remote ID -> LRUCache of the results of the pure function
+        self.pure_cache_size = 1024 #Default number of the results, cached for one pure function
+        self.attr_generation = 0 #Generation of the server attributes; cached attributes of the other generations are stale
+        if isinstance( compression, basestring ):
+            compression = [ compression ]
+        self.compression_codecs = compression or [] #Codecs, offered to the server at connect
+        self.compression_threshold = 4096 #Frames of this size and bigger are compressed
+        self.compression = None #Compression, agreed with the server
+        self.metrics = Metrics() #Counters and round-trip latencies of the requests (see stats). None: not collected
+        self.recorder = None #WireRecorder of the messages (see start_recording)
         if connect: self.connect()
 
+    def url( self ):
+        """URL of the server"""
+        if self.port is None:
+            return self.host
+        return "tcp://%s:%d"%(self.host, self.port)
+
     def connect( self ):
-        #create an INET, STREAMing socket
-        if self.file != None: raise ValueError, "Already connected" 
-        self.socket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect( (self.host, self.port) )
-        self.file = self.socket.makefile("rwb")
+        if self.channel != None: raise ValueError, "Already connected" 
+        self.socket = connect_url( self.url() )
+        self.channel = MessageChannel( self.socket )
+        if self.recorder is not None:
+            self.channel.enable_recording( self.recorder.new_stream( server_side=False ) )
+        housekeeper.add( self )
+        if self.compression_codecs:
+            self.negotiate_compression().result()
 
     def get_msg_counter( self ):
         """Returns total number of the messages, passed between server and client"""
@@ -301,19 +2438,22 @@ class FarSide:
         """Disconnects all objects, associated with this FarSide"""
         for obj in self.objects.values():
             obj._release_remote_()
+        self.flush_releases()
         
     def close( self ):
-        if self.file:
+        if self.channel:
             self.disconnect_objects()
-            dump( (MSG_BYE, ), self.file, _protocol ) #Say bye to the server
+            while self.pending: #Read all responses, or else server may get connection reset before it reads everything
+                self._receive_one()
+            self.channel.send( (None, (MSG_BYE, )) ) #Say bye to the server
             self._disconnect()
         else:
             raise ValueError, "Client already closed connection!"
 
     def _disconnect(self):
-        self.file.close()
-        self.file = None
-        self.socket.close()
+        housekeeper.discard( self )
+        self.channel.close()
+        self.channel = None
         self.socket = None
         
     def stop_server( self ):
@@ -323,7 +2463,7 @@ class FarSide:
         self._disconnect()
         
     def __del__(self):
-        if self.file: #If not yet disconnected
+        if self.channel: #If not yet disconnected
             try:
                 self.disconnect_objects() #Mark all objects, associated with this connection as invalid.
                 self.close()
@@ -332,13 +2472,84 @@ class FarSide:
     
     def _message( self, message ):
         """Send a message and read response"""
-        self.msg_counter += 1
-        dump( message, self.file, _protocol )
-        self.file.flush()
-        resp = load( self.file )
-#        print "#>>", message
-#        print "#<<", resp
-        return resp
+        return self._send( message ).wait()
+
+    def _send( self, message, on_response=None ):
+        """Send a message without waiting for the response.
+        Returns RemoteFuture; on_response (if given) converts the response tuple to the result value.
+        """
+        released = self.release_queue
+        if released:
+            #Piggyback queued releases on the request
+            empty = []
+            with self.release_lock:
+                released, self.release_queue = self.release_queue, empty
+        while True:
+            while len( self.pending ) >= self.max_pending:
+                #Too many requests in flight: read some responses first, to avoid the deadlock on the full socket buffers
+                self._receive_one()
+            with self.send_lock:
+                msg_id = self.msg_counter + 1
+                if released:
+                    frame = (msg_id, message, released)
+                else:
+                    frame = (msg_id, message)
+                in_io, self.in_io = self.in_io, True
+                try:
+                    data, buffers = encode_message( frame )
+                    size = len( data ) + sum( map( len, buffers ) )
+                    #Big requests are not sent, while server may be blocked sending responses: it would not read them
+                    if not self.pending or self.max_pending_bytes is None or \
+                            self.pending_bytes + size <= self.max_pending_bytes:
+                        self.msg_counter = msg_id
+                        future = RemoteFuture( self, msg_id, on_response )
+                        future.size = size
+                        future.code = message[0]
+                        future.sent_time = self.last_send_time = time.time()
+                        self.pending[ msg_id ] = future
+                        self.pending_bytes += size
+                        self.channel.send_encoded( data, buffers )
+#                        print "#>>", msg_id, message
+                        return future
+                finally:
+                    self.in_io = in_io
+            self._receive_one()
+
+    def _receive_one( self ):
+        """Read one response from the server and pass it to the future, waiting for it"""
+        with self.receive_lock:
+            in_io, self.in_io = self.in_io, True
+            try:
+                frame = self.channel.receive()
+            finally:
+                self.in_io = in_io
+#            print "#<<", frame
+            self._on_frame( frame, self.channel.last_size )
+
+    def _on_frame( self, frame, size=0 ):
+        """Processes received frame: (msg_id, response) or (msg_id, response, attribute generation)
+        size: size of the serialized frame, for the metrics"""
+        if len( frame ) > 2:
+            self.attr_generation = frame[2] #Server attributes were changed: cached values are stale
+        self._on_response( frame[0], frame[1], size )
+
+    def _on_response( self, msg_id, resp, size=0 ):
+        """Passes received response to the future, waiting for it"""
+        try:
+            future = self.pending.pop( msg_id )
+        except KeyError:
+            raise ProtocolException, "Response to unknown request %s: %s"%(msg_id, str(resp))
+        self.pending_bytes -= future.size
+        if self.metrics is not None:
+            self.metrics.record( future.code, time.time() - future.sent_time, size, future.size )
+        future._set_response( resp )
+
+    def _wait_for( self, future ):
+        """Read responses until the given future is answered"""
+        while future.response is None:
+            with self.receive_lock:
+                if future.response is None: #Could be answered while we were waiting for the lock
+                    self._receive_one()
 
     def globals( self ):
         """Returns wrapped globals array"""
@@ -347,31 +2558,50 @@ class FarSide:
 
     def unwrap_returned( self, value ):
         """Called by the client to unwrap value, returned from the server"""
-        if value is None or isinstance( value, SIMPLE_TYPES ):
-            return value 
+        value_type = type( value )
+        if value_type in SCALAR_TYPES or value_type is str:
+            return value
         if isinstance( value, tuple ):
-            return tuple( map( self.unwrap_returned, value ) )
+            return tuple( map( self.unwrap_returned, value ) ) if value else value
+        if isinstance( value, SIMPLE_TYPES ): #Subclasses of the simple types
+            return value
         if isinstance( value, list ):
             #Unsafe, but optionally can be enabled at server
             return map( self.unwrap_returned, value )
         if isinstance( value, RemoteObjectWrapper ):
             return self.get_wrapper( value.remote_id )
-        raise ValueError, "Returned value can not be unwrapped:", value
+        if isinstance( value, dict ):
+            unwrap = self.unwrap_returned
+            return dict( [ (unwrap( key ), unwrap( item )) for key, item in value.iteritems() ] )
+        if isinstance( value, (set, frozenset) ):
+            return type( value )( map( self.unwrap_returned, value ) )
+        return value #Buffer or other value, that the server copied by value
 
-    def wrap_argument( self, value ):
+    def wrap_argument( self, value, deferred=False ):
         """Wrap values before calling remote method
         Called by the client, to prepare method arguments before call
+        deferred: if True, pending promises are wrapped as references to the batch operations. Otherwise they are forced.
         """
         def do_wrap( value ):
-            #Empty tuple is a very common case: check it first to improve performance
-            if isinstance( value, ProxyObject ): #ProxyObject check must go first - or else comparisions will cause clinch.
-                return RemoteObjectWrapper( value._remote_id_ )
-            # empty tuple is very common case, check for it separately
-            if ()==value or value is None \
-                    or isinstance( value, SIMPLE_TYPES ):
-                return value 
+            #Exact types of the common values are checked first, without calling comparisons of the proxies
+            value_type = type( value )
+            if value_type in SCALAR_TYPES:
+                return value
+            if isinstance( value, str ):
+                return OutOfBandBuffer( value ) if len( value ) >= OUT_OF_BAND_MIN_SIZE else value
             if isinstance( value, tuple ):
-                return tuple( map( do_wrap, value ) )
+                return tuple( map( do_wrap, value ) ) if value else value
+            #Values are never compared: comparison of the proxy would be a remote call
+            if isinstance( value, ProxyObject ):
+                return RemoteObjectWrapper( value._remote_id_ )
+            if isinstance( value, RemotePromise ):
+                if deferred and not value._done_() and value._batch_ is None:
+                    return PromiseRef( value._slot_ ) #Operation of the same batch
+                return do_wrap( value._force_() )
+            if isinstance( value, SIMPLE_TYPES ): #Subclasses of the simple types
+                return value
+            if isinstance( value, BUFFER_TYPES ):
+                return OutOfBandBuffer( value )
             #Unsafe conversions
             #print "Warning: Argument can not be converted safely"
             if isinstance( value, list ):
@@ -385,41 +2615,168 @@ class FarSide:
         return do_wrap(value)
 
     def release_object( self, obj_wrapper ):
-        """Releases a remote object"""
-        #MSG_RELEASE_OBJECT = 5
-        #>(msg, obj_id )
+        """Releases a remote object.
+        Release is not sent immediately, but queued and sent together with the other released IDs by one MSG_RELEASE_MANY."""
         assert( isinstance( obj_wrapper, ProxyObject ) )
-        resp = self._message( (MSG_RELEASE_OBJECT, obj_wrapper._remote_id_ ) )
-        if resp[0] == RESP_NOT_REGISTERED:
-            raise UnknownObjectError, resp[1]
+        if self.channel is None:
+            return #Connection is closed, server has already forgotten all objects
+        if self.pure_caches:
+            self.pure_caches.pop( obj_wrapper._remote_id_, None )
+        refs = obj_wrapper._refs_
+        remote_ids = [ obj_wrapper._remote_id_ ] * refs if refs > 1 else None
+        with self.release_lock:
+            queue = self.release_queue
+            if not queue:
+                self.release_queue_time = time.time()
+            if remote_ids is None:
+                queue.append( obj_wrapper._remote_id_ )
+            else:
+                queue.extend( remote_ids )
+        if not self.in_io and \
+                (len( queue ) >= self.release_batch_size or \
+                     time.time() - self.release_queue_time >= self.release_delay):
+            self.flush_releases()
+
+    def flush_releases( self ):
+        """Sends all queued releases to the server, without waiting for the response.
+        Releases of the idle client are flushed by the housekeeper thread, when release_delay expires"""
+        #MSG_RELEASE_MANY
+        #>(msg, [obj_id, ...] )
+        if not self.release_queue or self.channel is None:
+            return
+        empty = []
+        with self.release_lock:
+            queue, self.release_queue = self.release_queue, empty
+        if queue:
+            self._send( (MSG_RELEASE_MANY, queue) ) #Response is not interesting: released objects could not be used anyway.
+
+    def _housekeep( self ):
+        """Called by the housekeeper thread: flushes releases, that are queued longer than release_delay,
+        and renews the lease of the connection, that is idle for the half of lease_time.
+        Returns time of the next check, or None"""
+        if self.channel is None or self.in_io:
+            return None #Other thread does I/O now
+        now = time.time()
+        deadline = None
+        if self.release_queue:
+            deadline = self.release_queue_time + self.release_delay
+            if now >= deadline:
+                self.flush_releases()
+                deadline = None
+        if self.lease_time:
+            renew_time = self.last_send_time + self.lease_time / 2.0
+            if now >= renew_time:
+                self.renew_lease()
+                renew_time = now + self.lease_time / 2.0
+            if deadline is None or renew_time < deadline:
+                deadline = renew_time
+        return deadline
 
     def get_attribute( self, object_wrapper, attr_name ):
-        """Returns wrapped attribute of the object
+        """Returns wrapped attribute of the object.
+        Attributes, that the server marked as cacheable, are taken from the cache of the proxy without the request.
         """
+        cached, value = self._cached_attribute( object_wrapper, attr_name )
+        if cached:
+            return value
+        return self.get_attribute_async( object_wrapper, attr_name ).result()
+
+    def _cached_attribute( self, object_wrapper, key ):
+        """Returns (True, value), if the proxy has valid cached value of the attribute (or path), (False, None) otherwise"""
+        cache = object_wrapper._attr_cache_
+        if cache is not None and key in cache:
+            generation, value = cache[ key ]
+            if generation == self.attr_generation or generation is None: #None: cached by cache_all_attributes
+                return True, value
+        return False, None
+
+    def resolve( self, path ):
+        """Returns the object, given by the dotted path, starting with the module name (such as "os.path.join"), by one request.
+        Only the last object is registered at the server."""
+        return self.get_path_async( None, path ).result()
+
+    def get_path( self, object_wrapper, path ):
+        """Returns attribute of the object, given by the dotted path ("a.b.c"), by one request"""
+        cached, value = self._cached_attribute( object_wrapper, path )
+        if cached:
+            return value
+        return self.get_path_async( object_wrapper, path ).result()
+
+    def get_path_async( self, object_wrapper, path ):
+        """Same as get_path, but returns RemoteFuture. If object_wrapper is None, path starts with the module name"""
+        #MSG_GET_PATH
+        if object_wrapper is None:
+            remote_id = None
+            name = path
+        else:
+            assert( isinstance( object_wrapper, ProxyObject ) )
+            remote_id = object_wrapper._remote_id_
+            if remote_id == None:
+                raise AttributeError, path
+            name = object_wrapper._child_name_( path )
+        return self._send( (MSG_GET_PATH, remote_id, path),
+                           lambda resp: self._on_get_path_response( resp, path, object_wrapper, name ) )
+
+    def _on_get_path_response( self, resp, path, object_wrapper, name ):
+        if resp[0] == RESP_EXCEPT:
+            raise resp[1] #Module import failed
+        value = self._on_get_attr_response( resp, path, object_wrapper )
+        if isinstance( value, ProxyObject ):
+            object.__setattr__( value, "_name_", name )
+        return value
+
+    def get_attribute_async( self, object_wrapper, attr_name ):
+        """Same as get_attribute, but returns RemoteFuture instead of waiting for the value"""
         assert( isinstance( object_wrapper, ProxyObject ) )
         remote_id = object_wrapper._remote_id_
         if remote_id == None:
             raise AttributeError, attr_name
-        resp = self._message( (MSG_GET_ATTRIBUTE, 
-                               remote_id, 
-                               attr_name ) )
+        return self._send( (MSG_GET_ATTRIBUTE, 
+                            remote_id, 
+                            attr_name ),
+                           lambda resp: self._on_get_attr_response( resp, attr_name, object_wrapper ) )
+
+    def _on_get_attr_response( self, resp, attr_name, object_wrapper=None ):
+        """Converts response to the MSG_GET_ATTRIBUTE to the attribute value, and caches it in the proxy, if allowed"""
         try:
             resp_code = resp[0]
             if resp_code == RESP_SUCCESS:
-                return self.unwrap_returned( resp[1] ) #resp is a remote ID
+                value = self.unwrap_returned( resp[1] ) #resp is a remote ID
+                if len( resp ) > 2 and resp[2] & ATTR_PURE and isinstance( value, ProxyObject ) and \
+                        value._remote_id_ not in self.pure_caches:
+                    name = attr_name if object_wrapper is None else object_wrapper._remote_name_ + "." + attr_name
+                    self.pure_caches[ value._remote_id_ ] = LRUCache( self.pure_cache_size, name )
+                if len( resp ) > 2 and resp[2] & ATTR_CACHEABLE and \
+                        self.cache_attributes and object_wrapper is not None:
+                    cache = object_wrapper._attr_cache_
+                    if cache is None:
+                        cache = dict()
+                        object.__setattr__( object_wrapper, "_attr_cache_", cache )
+                    cache[ attr_name ] = (self.attr_generation, value)
+                return value
             if resp_code == RESP_NO_SUCH_ATTR: #Remote object do not have such ID
-                raise AttributeError, attr_name
+                raise AttributeError, resp[1] if len( resp ) > 1 else attr_name
             if resp_code == RESP_NOT_REGISTERED: #Remote object do not have such ID
                 raise UnknownObjectError, resp[1]
         except IndexError:
             raise ProtocolException, "Wrong response: %s"%str(resp)
 
     def set_attribute( self, remote_obj, attr_name, attr_value ):
+        self.set_attribute_async( remote_obj, attr_name, attr_value ).result()
+
+    def set_attribute_async( self, remote_obj, attr_name, attr_value ):
+        """Same as set_attribute, but returns RemoteFuture instead of waiting for the response"""
         assert( isinstance( remote_obj, ProxyObject ) )
-        resp = self._message( (MSG_SET_ATTRIBUTE,
-                               remote_obj._remote_id_,
-                               attr_name,
-                               self.wrap_argument( attr_value ) ) ) #TODO sanitize value
+        cache = remote_obj._attr_cache_
+        if cache is not None:
+            cache.pop( attr_name, None ) #Other proxies see the change, when the new generation is reported
+        return self._send( (MSG_SET_ATTRIBUTE,
+                            remote_obj._remote_id_,
+                            attr_name,
+                            self.wrap_argument( attr_value ) ), #TODO sanitize value
+                           self._on_set_attr_response )
+
+    def _on_set_attr_response( self, resp ):
         resp_code = resp[0]
         if resp_code == RESP_EXCEPT:
             raise resp[1]
@@ -427,20 +2784,40 @@ class FarSide:
             raise UnknownObjectError, resp[1]
         
     def get_wrapper( self, remote_id, remote_name=None ):
-        """Returns wrapper for the given remote ID
+        """Returns wrapper for the given remote ID. Called once for every reference, received from the server
         """
-        try:
-            return self.objects[ remote_id ]
-        except KeyError:
-            wrapper = ProxyObject( self, remote_id, remote_name )
-            self.objects[ remote_id ] = wrapper
+        wrapper = self.objects.get( remote_id )
+        if wrapper is None:
+            wrapper = self.proxy_class( self, remote_id, remote_name )
+            self.objects.add( wrapper )
             return wrapper
+        object.__setattr__( wrapper, "_refs_", wrapper._refs_ + 1 ) #Server counts references too: all of them are released together
+        return wrapper
+
+    def renew_lease( self ):
+        """Renews lease of the connection (and all its objects) at the server, without waiting for the response.
+        Any other request renews it too. Returns RemoteFuture of the lease time of the server.
+        Client remembers the lease time, and then the housekeeper thread renews the lease, when connection is idle
+        for the half of it: call renew_lease() once after connect, to keep the idle connection alive."""
+        #MSG_RENEW_LEASE
+        return self._send( (MSG_RENEW_LEASE, ), self._on_renew_response )
+
+    def _on_renew_response( self, resp ):
+        self.lease_time = resp[1]
+        return resp[1]
 
     def import_module( self, mod_name ):
         """Imports module at the remote side, and returns a proxy object for that module.
         """
+        return self.import_module_async( mod_name ).result()
+
+    def import_module_async( self, mod_name ):
+        """Same as import_module, but returns RemoteFuture instead of waiting for the module"""
         assert( isinstance( mod_name, str ) )
-        resp = self._message( (MSG_IMPORT_MODULE, mod_name) )
+        return self._send( (MSG_IMPORT_MODULE, mod_name),
+                           lambda resp: self._on_import_response( resp, mod_name ) )
+
+    def _on_import_response( self, resp, mod_name ):
         resp_code = resp[0]
         if resp_code == RESP_SUCCESS:
             module = self.get_wrapper( resp[1], mod_name )
@@ -462,14 +2839,268 @@ class FarSide:
         else:
             raise ProtocolException, "Unexpected response:%s"%(str(resp))
 
+    def defer( self, remote_obj ):
+        """Returns promise for the given proxy object. Attribute access, calls and indexing of the promise
+        are not sent immediately, but collected to the batch, that is executed by one request when some promise is forced.
+        """
+        assert( isinstance( remote_obj, ProxyObject ) )
+        return RemotePromise( self, None, None, value=remote_obj )
+
+    def _defer_operation( self, op_code, target, operand, on_response ):
+        """Adds operation to the deferred batch and returns promise for its result"""
+        self.promise_counter += 1
+        slot = self.promise_counter
+        if op_code != MSG_GET_ATTRIBUTE: #Operand is the attribute name, or argument(s)
+            wrapped_operand = self.wrap_argument( operand, True )
+        else:
+            wrapped_operand = operand
+        self.deferred_ops.append( (slot, op_code, self.wrap_argument( target, True ), wrapped_operand) )
+        self.deferred_arguments.append( (target, operand) ) #Keep proxies alive (not released) until the batch is executed
+        promise = RemotePromise( self, slot, on_response )
+        self.deferred_promises[ slot ] = promise
+        return promise
+
+    def flush_deferred( self ):
+        """Sends all deferred operations to the server as one MSG_BATCH. Returns future for the batch, or None if nothing was deferred.
+        Results are returned only for the promises, that are still alive."""
+        if not self.deferred_ops:
+            return None
+        ops, self.deferred_ops = self.deferred_ops, []
+        arguments, self.deferred_arguments = self.deferred_arguments, []
+        promises = dict( self.deferred_promises.items() )
+        self.deferred_promises = weakref.WeakValueDictionary()
+        future = self._send( (MSG_BATCH, ops, promises.keys()) )
+        for promise in promises.itervalues():
+            promise.__dict__[ "_batch_" ] = future
+        def on_batch_done( future ):
+            del arguments[:] #Now they can be released
+            if future.response[0] != RESP_SUCCESS:
+                for promise in promises.itervalues():
+                    promise._set_response_( future.response )
+                return
+            for slot, resp in future.response[1]:
+                #Unwrap immediately, so that returned remote objects get their proxies (and are released when not needed)
+                promises[ slot ]._set_response_( resp )
+        future.add_done_callback( on_batch_done )
+        return future
+
     def call_object( self, remote_obj, args ):
         """Calls remote object as function"""
-        assert( isinstance( remote_obj, ProxyObject) )
-        assert( remote_obj._remote_id_ in self.objects )
+        return self.call_async( remote_obj, args ).result()
+
+    def call_async( self, remote_obj, args, policy=None ):
+        """Calls remote object as function, without waiting for the result.
+        Returns RemoteFuture; its result() method returns the value, returned by the call (or raises exception).
+        Many calls can be in flight simultaneously.
+        policy: marshalling policy of the returned value (BY_VALUE, BY_REFERENCE or maximal number of the copied elements),
+        overriding the policies of the server (see PythonServer.set_policy).
+        """
+        on_response = self._on_call_response
+        if self.pure_caches:
+            cache = self.pure_caches.get( remote_obj._remote_id_ )
+            key = pure_key( args ) if cache is not None else None
+            if key is not None:
+                value = cache.get( key, MISSING )
+                if value is not MISSING: #Answered without the request
+                    future = RemoteFuture( self, None, lambda resp: value )
+                    future._set_response( (RESP_SUCCESS,) )
+                    return future
+                on_response = lambda resp: self._on_pure_call_response( resp, cache, key )
         args = self.wrap_argument( args )
-        resp = self._message( (MSG_CALL,
-                               remote_obj._remote_id_,
-                               args ) )
+        if policy is None:
+            message = (MSG_CALL, remote_obj._remote_id_, args)
+        else:
+            message = (MSG_CALL, remote_obj._remote_id_, args, policy)
+        return self._send( message, on_response )
+
+    def _on_pure_call_response( self, resp, cache, key ):
+        value = self._on_call_response( resp )
+        if is_immutable_value( value ):
+            cache.put( key, value )
+        return value
+
+    def mark_pure( self, remote_obj, cache_size=None, tell_server=True ):
+        """Marks remote function as pure: results of its calls with scalar, string and tuple arguments are cached 
+        (cache_size last ones, pure_cache_size by default) and repeated calls are answered without requests.
+        If tell_server is True, server is asked to cache the results too (see PythonServer.mark_pure).
+        Functions, that the server marked as pure, are marked, when they are got as attributes."""
+        #MSG_MARK_PURE
+        if cache_size == 0:
+            self.pure_caches.pop( remote_obj._remote_id_, None )
+        else:
+            self.pure_caches[ remote_obj._remote_id_ ] = LRUCache( cache_size or self.pure_cache_size, remote_obj._remote_name_ )
+        if tell_server:
+            self._send( (MSG_MARK_PURE, remote_obj._remote_id_, cache_size), self._on_call_response ).result()
+
+    def negotiate_compression( self ):
+        """Offers compression codecs to the server. Returns RemoteFuture of the agreed (codec, threshold); codec is None,
+        if server allows none of them. Frames are compressed, when the response is received."""
+        #MSG_NEGOTIATE
+        return self._send( (MSG_NEGOTIATE, list( self.compression_codecs ), self.compression_threshold),
+                           self._on_negotiate_response )
+
+    def _on_negotiate_response( self, resp ):
+        if resp[0] != RESP_SUCCESS:
+            return (None, None) #Server does not support compression
+        codec, threshold = resp[1]
+        if codec is not None:
+            self.compression = Compression( codec, threshold )
+            self.channel.enable_compression( self.compression )
+        return codec, threshold
+
+    def compression_stats( self ):
+        """Returns counters of the compression at the client (see Compression.stats), or None if frames are not compressed"""
+        if self.compression is None:
+            return None
+        return self.compression.stats()
+
+    def stats( self ):
+        """Returns metrics of the requests, sent by this client, per message name (see Metrics.snapshot).
+        Latency is the round trip: from sending the request till its response is received and decoded"""
+        if self.metrics is None:
+            return {}
+        return self.metrics.snapshot()
+
+    def get_server_stats( self, reset=False ):
+        """Returns metrics of the server (see PythonServer.stats); counters are cleared after reading, if reset is True"""
+        return self.get_server_stats_async( reset ).result()
+
+    def get_server_stats_async( self, reset=False ):
+        """Same as get_server_stats, but returns RemoteFuture instead of waiting for the metrics"""
+        #MSG_GET_STATS
+        return self._send( (MSG_GET_STATS, reset), self._on_stats_response )
+
+    def _on_stats_response( self, resp ):
+        if resp[0] == RESP_SUCCESS:
+            return resp[1]
+        elif resp[0] == RESP_EXCEPT:
+            raise resp[1]
+        raise ProtocolException, "Unexpected response:%s"%(str(resp))
+
+    def start_recording( self, recorder ):
+        """Writes messages of the connection to the WireRecorder (or the log file of the given name), till stop_recording.
+        Log can be replayed against a local server by benchmarks/replay.py. Returns the recorder"""
+        if isinstance( recorder, basestring ):
+            recorder = WireRecorder( recorder )
+        self.recorder = recorder
+        if self.channel is not None:
+            self.channel.enable_recording( recorder.new_stream( server_side=False ) )
+        return recorder
+
+    def stop_recording( self ):
+        """Stops recording and closes the log"""
+        if self.recorder is not None:
+            if self.channel is not None:
+                self.channel.enable_recording( None )
+            self.recorder.close()
+            self.recorder = None
+
+    def start_profiling( self, scope=None ):
+        """Starts profiling of the server: requests of this connection (PROFILE_CONNECTION, default) or of all clients (PROFILE_SERVER)"""
+        #MSG_PROFILE_START
+        self._send( (MSG_PROFILE_START, scope or PROFILE_CONNECTION), self._on_stats_response ).result()
+
+    def stop_profiling( self ):
+        """Stops profiling of the server and returns its results (see PythonServer.stop_profiling and profile_stats)"""
+        #MSG_PROFILE_STOP
+        return self._send( (MSG_PROFILE_STOP, ), self._on_stats_response ).result()
+
+    def pure_stats( self ):
+        """Returns map function name -> counters of its result cache at the client (see LRUCache.stats)"""
+        return dict( [ (cache.name, cache.stats()) for cache in self.pure_caches.itervalues() ] )
+
+    def call_method( self, remote_obj, name, args ):
+        """Calls method of the remote object by one request"""
+        return self.call_method_async( remote_obj, name, args ).result()
+
+    def call_method_async( self, remote_obj, name, args, on_response=None ):
+        """Same as call_method, but returns RemoteFuture instead of waiting for the result"""
+        #MSG_CALL_METHOD
+        return self._send( (MSG_CALL_METHOD, remote_obj._remote_id_, name, self.wrap_argument( args )),
+                           on_response or self._on_call_response )
+
+    def _on_special_response( self, resp ):
+        """Converts response to MSG_CALL_METHOD of the special method to the value, or MISSING if there is no such method"""
+        if resp[0] == RESP_NO_SUCH_ATTR:
+            return MISSING
+        return self._on_call_response( resp )
+
+    def prepare( self, remote_obj, arg_template, **kwargs ):
+        """Prepares calls of the remote object with the arguments of the same shape. Returns PreparedCall.
+        arg_template: struct format of the positional arguments (such as "iid"), or tuple of their types (int, long, float, bool).
+        kwargs: keyword arguments, passed to every call.
+        Invocation sends only ID of the server-side stub and the arguments, packed by struct: neither side wraps them."""
+        #MSG_PREPARE
+        arg_format = template_format( arg_template )
+        stub = self._send( (MSG_PREPARE, remote_obj._remote_id_, arg_format, self.wrap_argument( kwargs )),
+                           self._on_call_response ).result()
+        return PreparedCall( self, stub, arg_format )
+
+    def iterate( self, remote_obj, batch_size=None ):
+        """Returns iterator over the remote object, that fetches items by batches (of iter_batch_size by default)"""
+        return RemoteIterator( self, remote_obj, batch_size or self.iter_batch_size )
+
+    def _on_iterate_response( self, resp ):
+        """Converts response to MSG_ITERATE to (items, more, error). more is the proxy of the server-side iterator, True or False"""
+        if resp[0] != RESP_SUCCESS:
+            return self._on_call_response( resp ) #Raises the error
+        unwrap = self.unwrap_returned
+        return map( unwrap, resp[1] ), unwrap( resp[2] ), resp[3]
+
+    def call_many( self, remote_obj, arg_tuples, return_exceptions=False ):
+        """Calls remote object for every tuple of arguments in one request. Returns list of the results.
+        If return_exceptions is True, exceptions, raised by the failed calls are returned in place of their results,
+        otherwise first of them is raised.
+        """
+        return self.call_many_async( remote_obj, arg_tuples, return_exceptions ).result()
+
+    def call_many_async( self, remote_obj, arg_tuples, return_exceptions=False ):
+        """Same as call_many, but returns RemoteFuture instead of waiting for the results"""
+        assert( isinstance( remote_obj, ProxyObject) )
+        wrap_argument = self.wrap_argument
+        return self._send( (MSG_CALL_MANY,
+                            remote_obj._remote_id_,
+                            [ wrap_argument( tuple( args ) ) for args in arg_tuples ] ),
+                           lambda resp: self._on_call_many_response( resp, return_exceptions ) )
+
+    def imap_call( self, remote_obj, arg_tuples, chunk_size=1024, return_exceptions=False ):
+        """Generator: calls remote object for every tuple of arguments from the iterable, yielding results.
+        Arguments are sent by chunks of the given size, so that big (or infinite) iterables can be processed.
+        Next chunk is sent before the results of the current one are yielded, so that server does not wait for the client.
+        """
+        arg_tuples = iter( arg_tuples )
+        def send_next_chunk():
+            chunk = list( itertools.islice( arg_tuples, chunk_size ) )
+            if chunk:
+                return self.call_many_async( remote_obj, chunk, return_exceptions )
+            return None
+        future = send_next_chunk()
+        while future is not None:
+            next_future = send_next_chunk()
+            for value in future.result():
+                yield value
+            future = next_future
+
+    def _on_call_many_response( self, resp, return_exceptions ):
+        """Converts response to the MSG_CALL_MANY to the list of returned values"""
+        if resp[0] != RESP_SUCCESS:
+            return self._on_call_response( resp ) #Failed as a whole: raise the error
+        results = []
+        error = None
+        for item_resp in resp[1]:
+            #Every item is unwrapped, even after the failed one: returned objects get proxies, that release them
+            try:
+                results.append( self._on_call_response( item_resp ) )
+            except Exception, err:
+                if error is None:
+                    error = err
+                results.append( err )
+        if error is not None and not return_exceptions:
+            raise error
+        return results
+
+    def _on_call_response( self, resp ):
+        """Converts response to the MSG_CALL to the returned value"""
         try:
             resp_code = resp[0]
             if resp_code == RESP_SUCCESS:
@@ -479,29 +3110,149 @@ class FarSide:
             elif resp_code == RESP_EXCEPT:
                 raise resp[1]
             elif resp_code == RESP_NO_SUCH_ATTR:
-                raise AttributeError, "__call__"
+                raise AttributeError, resp[1] if len( resp ) > 1 else "__call__"
             else:
                 raise ValueError, "Unexpected response"
         except IndexError:
             raise ProtocolException, "Wrong answer: %s"%(str(resp))
 
-class ProxyObject:
-    def __init__(self, far_side, remote_id, name=None ):
-        """Wrapper, representing remote object"""
+class RemoteFuture:
+    """Result of the request, that is sent to the server, but probably not answered yet"""
+    def __init__( self, far_side, msg_id, on_response=None ):
+        self.far_side = far_side
+        self.msg_id = msg_id
+        self.on_response = on_response #Converts response tuple to the value
+        self.response = None
+        self.callbacks = []
+        self.size = 0 #Size of the sent request
+        self.code = None #Message code and send time of the request, for the metrics
+        self.sent_time = None
+        self.value = None #Converted when the response is received, so that returned objects are released, even if result is not read
+        self.error = None
+
+    def done( self ):
+        """True, if response is already received"""
+        return self.response is not None
+
+    def wait( self ):
+        """Waits for the response and returns raw response tuple"""
+        if self.response is None:
+            self.far_side._wait_for( self )
+        return self.response
+
+    def result( self ):
+        """Waits for the response and returns the result value, or raises remote exception"""
+        resp = self.wait()
+        if self.on_response is None:
+            return resp
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback( self, callback ):
+        """Callback is called with the future as argument, when the response is received"""
+        if self.response is None:
+            self.callbacks.append( callback )
+        else:
+            callback( self )
+
+    def _set_response( self, resp ):
+        if self.on_response is not None:
+            #Response is converted only once, because it may register proxies
+            try:
+                self.value = self.on_response( resp )
+            except Exception, err:
+                self.error = err
+        self.response = resp
+        callbacks, self.callbacks = self.callbacks, None
+        for callback in callbacks:
+            callback( self )
+
+class RemotePromise( object ):
+    """Lazy reference to the result of the deferred remote operation.
+    Attribute access, calls and indexing of the promise return new promises, that can also be used as arguments of the other calls.
+    Nothing is sent until some promise is forced, then the whole chain is executed by the server in one request.
+    """
+    def __init__( self, far_side, slot, on_response, value=None ):
         attrs = self.__dict__
-        attrs[ "far_side" ] = far_side
-        attrs[ "_remote_id_"] = remote_id
-        attrs[ "_remote_name_" ] = name or "<%s>"%(remote_id)
+        attrs[ "_far_side_" ] = far_side
+        attrs[ "_slot_" ] = slot #ID of the operation in the batch
+        attrs[ "_on_response_" ] = on_response #Converts response tuple of the operation to the value
+        attrs[ "_batch_" ] = None #Future of the MSG_BATCH, when batch is sent
+        attrs[ "_value_" ] = value
+        attrs[ "_error_" ] = None
+        attrs[ "_resolved_" ] = slot is None #Promise of the already known value
+
+    def __getattr__( self, name ):
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError, name #Special names are never deferred
+        far_side = self._far_side_
+        #Response handler must not reference self: only alive promises are returned by the server
+        return far_side._defer_operation( MSG_GET_ATTRIBUTE, self, name,
+                                          lambda resp: far_side._on_get_attr_response( resp, name ) )
+
+    def __setattr__( self, name, value ):
+        raise TypeError, "Attributes of the deferred value can not be set"
+
+    def __call__( self, *args ):
+        far_side = self._far_side_
+        return far_side._defer_operation( MSG_CALL, self, args, far_side._on_call_response )
+
+    def __getitem__( self, key ):
+        far_side = self._far_side_
+        return far_side._defer_operation( MSG_GET_ITEM, self, key, far_side._on_call_response )
+
+    def __repr__( self ):
+        if self._resolved_:
+            return "PROMISE(%s: %s)"%(self._slot_, saferepr( self._value_ ) )
+        return "PROMISE(%s)"%self._slot_
+
+    def _done_( self ):
+        """True, if value is known without sending anything to the server"""
+        return self._resolved_
+
+    def _force_( self ):
+        """Executes deferred operations (if not yet) and returns the value, or raises remote exception"""
+        if not self._resolved_:
+            if self._batch_ is None:
+                self._far_side_.flush_deferred()
+            self._batch_.wait()
+        if self._error_ is not None:
+            raise self._error_
+        return self._value_
+
+    def _set_response_( self, resp ):
+        try:
+            self.__dict__[ "_value_" ] = self._on_response_( resp )
+        except Exception, err:
+            self.__dict__[ "_error_" ] = err
+        self.__dict__[ "_resolved_" ] = True
+
+class ProxyObject( object ):
+    """Wrapper, representing remote object.
+    Proxies are compact: attributes are kept in the slots, and the dotted name is built only when it is requested."""
+    __slots__ = ("far_side", "_remote_id_", "_name_", "_attr_cache_", "_refs_", "__weakref__")
+
+    def __init__(self, far_side, remote_id, name=None ):
+        init = object.__setattr__ #Own __setattr__ sets remote attributes
+        init( self, "far_side", far_side )
+        init( self, "_remote_id_", remote_id )
+        init( self, "_name_", name ) #None, name string, or tuple (name of the parent, attribute name)
+        init( self, "_attr_cache_", None ) #Maps name -> (generation, value) of the cacheable attributes. Created on demand.
+        init( self, "_refs_", 1 ) #Number of the references to the object, received from the server
 
     def __getattr__(self, name ):
         #print "#Get:", self._remote_name_, name
-        attr = self.far_side.get_attribute( self, name )
-        #Caching of the special attributes to increase performance
-        #if name.startswith("__") and name.endswith("__"):
-        if self.far_side.cache_all_attributes:
-            self.__dict__[ name ] = attr
+        far_side = self.far_side
+        attr = far_side.get_attribute( self, name )
+        if far_side.cache_all_attributes:
+            cache = self._attr_cache_
+            if cache is None:
+                cache = dict()
+                object.__setattr__( self, "_attr_cache_", cache )
+            cache[ name ] = (None, attr) #Never becomes stale
         if isinstance( attr, ProxyObject ):
-            attr.__dict__[ "_remote_name_" ] = self._remote_name_ + "." + name
+            object.__setattr__( attr, "_name_", self._child_name_( name ) )
         return attr
 
     def __setattr__(self, name, value ):
@@ -518,6 +3269,73 @@ class ProxyObject:
         """For functions, performs call"""
         return self.far_side.call_object( self, args )
 
+    def __nonzero__(self):
+        value = self._call_special_( "__nonzero__", () )
+        if value is MISSING:
+            value = self._call_special_( "__len__", () )
+            return True if value is MISSING else value != 0
+        return value
+
+    def __iter__(self):
+        return self.far_side.iterate( self )
+
+    def _prepare_(self, arg_template, **kwargs):
+        """Returns PreparedCall of this object (see FarSide.prepare)"""
+        return self.far_side.prepare( self, arg_template, **kwargs )
+
+    def _iter_(self, batch_size=None):
+        """Iterator, that fetches items by batches of the given size"""
+        return self.far_side.iterate( self, batch_size )
+
+    def _call_special_(self, name, args):
+        """Calls special method of the remote object by one request. Returns MISSING, if the object does not have it"""
+        far_side = self.far_side
+        return far_side.call_method_async( self, name, args, far_side._on_special_response ).result()
+
+    @property
+    def _remote_name_(self):
+        """Dotted name of the object, for the messages"""
+        name = self._name_
+        if name is None:
+            return "<%s>"%(self._remote_id_)
+        parts = []
+        while type( name ) is tuple:
+            name, attr = name
+            parts.append( attr )
+        parts.append( name if isinstance( name, basestring ) else "<%s>"%(name) )
+        parts.reverse()
+        return ".".join( parts )
+
+    def _child_name_(self, attr):
+        """Name of the attribute, that is computed only when needed"""
+        name = self._name_
+        return (self._remote_id_ if name is None else name, attr)
+
+    def _async_(self, *args):
+        """Performs call without waiting for the result. Returns RemoteFuture"""
+        return self.far_side.call_async( self, args )
+
+    def _call_byvalue_(self, *args):
+        """Performs call, whose result is copied by value, even if the server remotes values of its type.
+        Server still remotes values, bigger than its max_value_items"""
+        return self.far_side.call_async( self, args, BY_VALUE ).result()
+
+    def _map_(self, arg_tuples, return_exceptions=False):
+        """Calls object for every tuple of arguments in one request. Returns list of the results"""
+        return self.far_side.call_many( self, arg_tuples, return_exceptions )
+
+    def _imap_(self, arg_tuples, chunk_size=1024, return_exceptions=False):
+        """Iterator over the results of the calls for every tuple of arguments, sent by chunks"""
+        return self.far_side.imap_call( self, arg_tuples, chunk_size, return_exceptions )
+
+    def _defer_(self):
+        """Returns RemotePromise for this object, whose operations are collected to the batch"""
+        return self.far_side.defer( self )
+
+    def _path_(self, path):
+        """Returns attribute, given by the dotted path ("a.b.c"), by one request"""
+        return self.far_side.get_path( self, path )
+
     def _disconnected_(self):
         return self._remote_id_ is None
 
@@ -525,13 +3343,401 @@ class ProxyObject:
         """Disconnect object from it's remote counterpart. Object becomes unusable after this."""
         #print "invalidate:", self._remote_name_
         self.far_side.release_object( self )
-        self.__dict__[ "_remote_id_" ] = None #Mark object as disconnected.
+        object.__setattr__( self, "_remote_id_", None ) #Mark object as disconnected.
+
+def _forward_special( name, default ):
+    """Returns method of the proxy, that calls special method of the remote object.
+    Special methods of the new-style classes are looked up in the class, not via __getattr__, so every one must be defined.
+    default is called, if the remote object does not have the method"""
+    def forwarder( self, *args ):
+        value = self._call_special_( name, args )
+        if value is MISSING:
+            if default is None:
+                raise AttributeError, name
+            return default( self, *args )
+        return value
+    forwarder.__name__ = name
+    return forwarder
+
+def _not_implemented( self, *args ):
+    return NotImplemented
+
+def _get_slice( self, start, stop ):
+    return self[ slice( start, stop ) ]
+
+def _set_slice( self, start, stop, value ):
+    self[ slice( start, stop ) ] = value
+
+def _del_slice( self, start, stop ):
+    del self[ slice( start, stop ) ]
+
+def _contains( self, item ):
+    for value in self:
+        if value == item:
+            return True
+    return False
+
+for _name, _default in [
+        ("__repr__", object.__repr__), ("__str__", lambda self: repr( self ) ), ("__hash__", object.__hash__),
+        ("__len__", None), ("__getitem__", None), ("__setitem__", None), ("__delitem__", None), ("__contains__", _contains),
+        ("__getslice__", _get_slice), ("__setslice__", _set_slice), ("__delslice__", _del_slice), ("next", None),
+        ("__int__", None), ("__long__", None), ("__float__", None), ("__complex__", None), ("__index__", None),
+        ("__oct__", None), ("__hex__", None), ("__neg__", None), ("__pos__", None), ("__abs__", None), ("__invert__", None),
+        ("__enter__", None), ("__exit__", None) ]:
+    setattr( ProxyObject, _name, _forward_special( _name, _default ) )
+for _name in ["eq", "ne", "lt", "le", "gt", "ge", "cmp"]:
+    setattr( ProxyObject, "__%s__"%_name, _forward_special( "__%s__"%_name, _not_implemented ) )
+for _name in ["add", "sub", "mul", "div", "truediv", "floordiv", "mod", "divmod", "pow", "lshift", "rshift", "and", "xor", "or"]:
+    for _prefix in ["", "r", "i"]:
+        setattr( ProxyObject, "__%s%s__"%(_prefix, _name), _forward_special( "__%s%s__"%(_prefix, _name), _not_implemented ) )
+del _name, _default, _prefix
+
+class PreparedCall( object ):
+    """Call of the remote object, prepared by FarSide.prepare(). Calling it sends only the ID of the server-side stub
+    and the arguments, packed by struct."""
+    __slots__ = ("far_side", "stub", "pack")
+
+    def __init__( self, far_side, stub, arg_format ):
+        self.far_side = far_side
+        self.stub = stub #Proxy of the stub: it is released with the PreparedCall
+        self.pack = struct.Struct( arg_format ).pack
+
+    def __call__( self, *args ):
+        return self._async_( *args ).result()
+
+    def _async_( self, *args ):
+        """Performs call without waiting for the result. Returns RemoteFuture"""
+        #MSG_INVOKE
+        far_side = self.far_side
+        return far_side._send( (MSG_INVOKE, self.stub._remote_id_, self.pack( *args )), far_side._on_call_response )
+
+TEMPLATE_CODES = { int: "q", long: "q", float: "d", bool: "?" } #struct codes of the argument types of the prepared calls
+
+def template_format( arg_template ):
+    """Returns struct format for the template of the prepared call: format string, or tuple of the argument types"""
+    if isinstance( arg_template, str ):
+        if arg_template[:1] in "<>!=@":
+            return arg_template
+        return "<" + arg_template #Standard sizes, no alignment
+    try:
+        return "<" + "".join( [ TEMPLATE_CODES[ arg_type ] for arg_type in arg_template ] )
+    except (KeyError, TypeError):
+        raise ValueError, "Template must be struct format or tuple of the types %s: %r"%(TEMPLATE_CODES.keys(), arg_template)
+
+class RemoteIterator( object ):
+    """Iterator over the remote object. Items are fetched by batches, and the next batch is requested,
+    before the items of the current one are consumed, so that the server prepares it meanwhile.
+    Only two batches are held at once, so remote generators are streamed with bounded memory."""
+    def __init__( self, far_side, remote_obj, batch_size ):
+        self.far_side = far_side
+        self.batch_size = batch_size
+        self.items = collections.deque()
+        self.iterator = None #Proxy of the server-side iterator
+        self.error = None #Raised after the items
+        #MSG_ITERATE
+        self.future = far_side._send( (MSG_ITERATE, remote_obj._remote_id_, batch_size, True), far_side._on_iterate_response )
+        self._receive_batch() #Non-iterable object raises TypeError now, like iter() does
+
+    def __iter__( self ):
+        return self
+
+    def next( self ):
+        items = self.items
+        while not items:
+            if self.future is None:
+                error, self.error = self.error, None
+                if error is not None:
+                    raise error
+                raise StopIteration
+            self._receive_batch()
+        return items.popleft()
+
+    def _receive_batch( self ):
+        """Waits for the requested batch, and requests the next one, if there are more items"""
+        future, self.future = self.future, None
+        batch, more, self.error = future.result()
+        self.items.extend( batch )
+        if more is not False: #Proxy of the iterator (it is not tested for truth: that is a remote call) or True
+            if self.iterator is None:
+                self.iterator = more
+            far_side = self.far_side
+            self.future = far_side._send( (MSG_ITERATE, self.iterator._remote_id_, self.batch_size, False),
+                                          far_side._on_iterate_response )
+
+class ProxyTable( object ):
+    """Weak map remote ID -> proxy.
+    Remote IDs are slot numbers of the server registry (tagged with the generation), so the proxies are kept in the list,
+    indexed by the slot, instead of the dictionary."""
+    __slots__ = ("refs",)
+
+    def __init__( self ):
+        self.refs = [] #Weak references to the proxies, or None
+
+    def get( self, remote_id ):
+        """Returns alive proxy of the remote ID, or None"""
+        try:
+            ref = self.refs[ remote_id & ObjectRegistry.SLOT_MASK ]
+        except IndexError:
+            return None
+        if ref is not None:
+            proxy = ref()
+            if proxy is not None and proxy._remote_id_ == remote_id: #Not the proxy of the old generation
+                return proxy
+        return None
+
+    def add( self, proxy ):
+        slot = proxy._remote_id_ & ObjectRegistry.SLOT_MASK
+        refs = self.refs
+        if slot >= len( refs ):
+            refs.extend( [None] * max( slot + 1 - len( refs ), len( refs ) ) )
+        refs[ slot ] = weakref.ref( proxy )
+
+    def values( self ):
+        """Returns list of the alive proxies"""
+        return [ proxy for proxy in [ ref() for ref in self.refs if ref is not None ] if proxy is not None ]
+
+    def __len__( self ):
+        return len( self.values() )
+
+################################################################################
+#  Asynchronous client
+################################################################################
+class AsyncFarSide( FarSide ):
+    """Client, that works inside the asyncore loop and never blocks.
+    Operations return futures (RemoteFuture) or promises (RemotePromise), and many coroutines can share one connection.
+    Coroutines are generators, that yield futures, promises, or lists of them, and receive their values:
+        def work( far_side ):
+            rmath = yield far_side.import_module( "math" )
+            x = yield rmath.sin( 1.0 )  #Both attribute access and call are sent by one request
+            raise CoroutineReturn( x )
+        future = far_side.spawn( work( far_side ) )
+    Python 2 has no asyncio, so the standard asyncore loop is used; run() or asyncore.loop() drives it.
+    """
+    def __init__( self, host, port=None, socket_map=None, connect=True, compression=None ):
+        """socket_map: asyncore map of the loop, that serves the connection (global asyncore map by default)"""
+        self.socket_map = socket_map
+        FarSide.__init__( self, host, port, connect=connect, compression=compression )
+        self.proxy_class = AsyncProxy
+        self.max_pending_bytes = None #Requests are buffered, sending never blocks
+
+    def connect( self ):
+        if self.channel != None: raise ValueError, "Already connected" 
+        url = self.url()
+        if url.startswith( "shm:" ):
+            raise ValueError, "Shared memory transport requires blocking client"
+        self.socket = connect_url( url )
+        set_nodelay( self.socket )
+        self.channel = AsyncMessageChannel( self, self.socket, self.socket_map )
+        if self.recorder is not None:
+            self.channel.enable_recording( self.recorder.new_stream( server_side=False ) )
+        if self.compression_codecs:
+            #Requests are not compressed, until the response is received
+            self.negotiate_compression().add_done_callback( RemoteFuture.result )
+
+    def _receive_one( self ):
+        """Serves the loop once. Used only, when result is waited synchronously"""
+        asyncore.loop( timeout=1.0, count=1, map=self.channel.socket_map )
+
+    def _wait_for( self, future ):
+        """Runs the loop until the given future is answered"""
+        while future.response is None:
+            self._receive_one()
+
+    def import_module( self, mod_name ):
+        """Returns future of the module proxy"""
+        return self.import_module_async( mod_name )
+
+    def call( self, remote_obj, *args ):
+        """Returns future of the value, returned by the remote call"""
+        return self.call_async( remote_obj, args )
+
+    def getattr( self, remote_obj, attr_name ):
+        """Returns future of the attribute value"""
+        return self.get_attribute_async( remote_obj, attr_name )
+
+    def resolve( self, path ):
+        """Returns future of the object, given by the dotted path, starting with the module name"""
+        return self.get_path_async( None, path )
+
+    def get_path( self, remote_obj, path ):
+        """Returns future of the attribute, given by the dotted path"""
+        return self.get_path_async( remote_obj, path )
+
+    def setattr( self, remote_obj, attr_name, attr_value ):
+        """Returns future, that is done when attribute is set"""
+        return self.set_attribute_async( remote_obj, attr_name, attr_value )
+
+    def spawn( self, coroutine ):
+        """Starts generator-based coroutine. Returns future of its result"""
+        return CoroutineTask( self, coroutine ).future
+
+    def run( self, future=None, timeout=None ):
+        """Runs asyncore loop until the future is done (or while there are requests in flight, if future is None),
+        but not longer than timeout seconds (if given)"""
+        deadline = timeout is not None and time.time() + timeout
+        socket_map = self.channel.socket_map
+        while (future.response is None) if future is not None else self.pending:
+            if deadline and time.time() >= deadline:
+                break
+            asyncore.loop( timeout=0.1, count=1, map=socket_map )
+            self._housekeep() #Housekeeper thread does not serve the asynchronous clients
+
+    def as_future( self, value ):
+        """Converts promise or list of futures and promises to the RemoteFuture"""
+        if isinstance( value, RemoteFuture ):
+            return value
+        if isinstance( value, RemotePromise ):
+            if not value._done_() and value._batch_ is None:
+                self.flush_deferred()
+            future = RemoteFuture( self, None, lambda resp: value._force_() )
+            if value._done_():
+                future._set_response( (RESP_SUCCESS,) )
+            else:
+                value._batch_.add_done_callback( lambda batch: future._set_response( (RESP_SUCCESS,) ) )
+            return future
+        if isinstance( value, (list, tuple) ):
+            futures = map( self.as_future, value )
+            future = RemoteFuture( self, None, lambda resp: [f.result() for f in futures] )
+            remaining = [ len( futures ) ]
+            def on_done( f ):
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    future._set_response( (RESP_SUCCESS,) )
+            if futures:
+                for f in futures:
+                    f.add_done_callback( on_done )
+            else:
+                future._set_response( (RESP_SUCCESS,) )
+            return future
+        raise TypeError, "Coroutine must yield futures, promises or lists of them, not %s"%(saferepr( value ))
+
+class AsyncMessageChannel( asyncore.dispatcher ):
+    """Non-blocking connection of the AsyncFarSide: buffers outgoing frames and passes received responses to the client"""
+    def __init__( self, far_side, sock, socket_map ):
+        asyncore.dispatcher.__init__( self, sock, socket_map )
+        self.far_side = far_side
+        self.socket_map = socket_map #None means global asyncore map
+        self.reader = FrameReader()
+        self.out_buffer = OutputBuffer()
+        self.compression = None
+        self.tap = None
+
+    def enable_compression( self, compression ):
+        self.compression = compression
+        self.reader.compression = compression
+
+    def enable_recording( self, tap ):
+        self.tap = tap
+        self.reader.tap = tap
+
+    def send( self, message ):
+        """Queues frame for sending"""
+        self.send_encoded( *encode_message( message ) )
+
+    def send_encoded( self, data, buffers ):
+        """Queues message, encoded by encode_message"""
+        if self.tap is not None:
+            self.tap.sent( data, buffers )
+        self.out_buffer.extend( make_frames( data, buffers, self.compression ) )
+
+    def writable( self ):
+        return bool( self.out_buffer )
+
+    def handle_write( self ):
+        self.out_buffer.send( lambda data: asyncore.dispatcher.send( self, data ) )
+
+    def handle_read( self ):
+        try:
+            messages = self.reader.receive( self.socket )
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        except EOFError:
+            self.handle_close()
+            return
+        for frame, size, decode_time in messages:
+            self.far_side._on_frame( frame, size )
+
+    def handle_close( self ):
+        asyncore.dispatcher.close( self )
+
+    def close( self ):
+        """Sends all queued frames and closes the connection"""
+        if self.out_buffer:
+            self.socket.setblocking( 1 )
+            self.out_buffer.send_blocking( self.socket )
+        asyncore.dispatcher.close( self )
+
+class AsyncProxy( ProxyObject ):
+    """Proxy of the AsyncFarSide. Attribute access returns promise (RemotePromise), call returns future (RemoteFuture)"""
+    __slots__ = ()
+
+    def __getattr__( self, name ):
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError, name
+        return getattr( self.far_side.defer( self ), name )
+
+    def __setattr__( self, name, value ):
+        raise TypeError, "Use setattr() of the AsyncFarSide to set attributes of the asynchronous proxy"
+
+    def __call__( self, *args ):
+        return self.far_side.call_async( self, args )
+
+    def _call_special_( self, name, args ):
+        return MISSING #Special methods would block
+
+    def __iter__( self ):
+        raise TypeError, "Asynchronous proxy is not iterable"
+
+class CoroutineReturn( Exception ):
+    """Raised by the coroutine to return value"""
+    def __init__( self, value ):
+        Exception.__init__( self, value )
+        self.value = value
+
+class CoroutineTask:
+    """Runs generator-based coroutine of the AsyncFarSide, resuming it when the yielded futures are done"""
+    def __init__( self, far_side, coroutine ):
+        self.far_side = far_side
+        self.coroutine = coroutine
+        self.future = RemoteFuture( far_side, None, self._on_result )
+        self._step( None, None )
+
+    def _on_result( self, resp ):
+        if resp[0] == RESP_SUCCESS:
+            return resp[1]
+        raise resp[1]
+
+    def _step( self, value, error ):
+        try:
+            if error is not None:
+                yielded = self.coroutine.throw( error )
+            else:
+                yielded = self.coroutine.send( value )
+            waited = self.far_side.as_future( yielded )
+        except StopIteration:
+            self.future._set_response( (RESP_SUCCESS, None) )
+        except CoroutineReturn, ret:
+            self.future._set_response( (RESP_SUCCESS, ret.value) )
+        except Exception, err:
+            self.future._set_response( (RESP_EXCEPT, err) )
+        else:
+            waited.add_done_callback( self._resume )
+
+    def _resume( self, waited ):
+        try:
+            value = waited.result()
+        except Exception, err:
+            self._step( None, err )
+        else:
+            self._step( value, None )
 
 ################################################################################
 # Other funcions and constants
 ################################################################################
 def msg_name( msg_id ):
-    """For debug only: returns name of the message"""
+    """Returns name of the message, for the logs and metrics"""
     try:
         return msg_name.id2name[ msg_id ]
     except AttributeError:
@@ -566,6 +3772,8 @@ def print_ret( prompt ):
 def saferepr( x ):
     if isinstance(x, ProxyObject):
         return "PROXY(%s)"%x._remote_id_
+    if isinstance(x, RemotePromise):
+        return repr(x)
     if x == None: return x
     if isinstance(x, (bool, int, long, str, unicode)): return repr(x)
     if isinstance(x, tuple):
@@ -577,10 +3785,47 @@ def saferepr( x ):
 ################################################################################
 # Protocol constants: message and responce formats (both are tuples)
 ################################################################################
+#Every message and response is sent as a frame: 4-byte big endian length, followed by the serialized data.
+FRAME_HEADER = struct.Struct( "!I" )
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+SMALL_FRAME_SIZE = 16384 #Smaller frames are sent together with the header, copying them
+#Frame with the highest bit of the length set is the out-of-band buffer: raw data, referenced by the next message.
+#Pickled message references its buffers by the persistent IDs (index, kind), kind is "str", "bytearray", "bytes"
+#or ("array", typecode, byteorder).
+FRAME_BUFFER_FLAG = 0x80000000
+#Frame with the second bit set is compressed (see Compression): data starts with the codec ID, followed by the compressed data.
+#Both message frames and out-of-band buffers may be compressed. Remaining bits are the length.
+FRAME_COMPRESSED_FLAG = 0x40000000
+FRAME_SIZE_MASK = 0x3fffffff
+#Compression codecs: name -> (ID in the frame, compress, decompress)
+COMPRESSION_CODECS = { "zlib" : ("z", zlib.compress, zlib.decompress),
+                       "bz2" : ("b", bz2.compress, bz2.decompress) }
+if lzma is not None:
+    COMPRESSION_CODECS[ "lzma" ] = ("x", lzma.compress, lzma.decompress)
+COMPRESSION_DECOMPRESSORS = dict( [ (codec_id, decompress) for codec_id, compress, decompress in COMPRESSION_CODECS.values() ] )
+OUT_OF_BAND_MIN_SIZE = 65536 #Shorter strings are serialized with the message
+
+#Wire log (see WireRecorder): WIRE_LOG_MAGIC, length and name of the codec, then the records.
+#Record: WIRE_RECORD (time, stream, direction, number of the buffers, size of the message data),
+#sizes of the buffers (WIRE_BUFFER_SIZE each), data of the buffers, data of the message - as encoded by encode_message.
+WIRE_LOG_MAGIC = "PYRWIRE1"
+WIRE_RECORD = struct.Struct( "<dIBBI" )
+WIRE_BUFFER_SIZE = struct.Struct( "<I" )
+WIRE_REQUEST = 0 #Directions of the recorded messages
+WIRE_RESPONSE = 1
+
+#Every message is sent as (msg_id, message), and response is sent back as (msg_id, response),
+#where msg_id is the request ID, chosen by the client. Client may send many requests without waiting for the responses.
+#Message can also be sent as (msg_id, message, [released-obj-id, ...]): the objects are released before the message is processed.
+#MSG_BYE is sent with msg_id=None, and is not answered.
+#Server counts references to the object, sent to every connection; released ID is repeated for every reference.
+#Response can also be sent as (msg_id, response, generation), when attributes were set since the previous response:
+#then client drops cached attributes.
+
 
 MSG_GET_ATTRIBUTE = 0
 #>(msg, remote id, attr_name)
-#<(resp-ok, wrapped-value)
+#<(resp-ok, wrapped-value, flags) - ATTR_CACHEABLE flag allows client to remember the value
 #<(resp-not-reg, id)
 #<(resp-not-found-attr)
 
@@ -590,6 +3835,7 @@ MSG_GET_GLOBALS = 1
 
 MSG_CALL = 2
 #>(msg, obj_id, args)
+#>(msg, obj_id, args, policy) - returned value is marshalled by the given policy
 #<(status-success, ans)
 #<(statue-nocall, None) - no __call__ support
 #<(status-except, err) - exception occurred
@@ -612,6 +3858,73 @@ MSG_GET_ATTR_LIST = 6
 #<(resp-false)
 
 MSG_STOP_SERVER = 7 #Client requested sever close
+
+MSG_BATCH = 8
+#>(msg, [(slot, op-code, target, operand), ...], [wanted-slot, ...])
+#   op-code is MSG_GET_ATTRIBUTE (operand: attr-name), MSG_CALL (operand: args) or MSG_GET_ITEM (operand: key)
+#   target and operand may contain PromiseRef(slot) of the previous operations
+#<(resp-success, [(wanted-slot, response-tuple-of-the-operation), ...])
+
+MSG_GET_ITEM = 9
+#>(msg, obj_id, key)
+#<(resp-success, wrapped-value) (resp-notreg, id) (resp-exc, exc)
+
+MSG_CALL_MANY = 10
+#>(msg, obj_id, [args, ...])
+#<(resp-success, [response-tuple-of-the-call, ...])
+#<(resp-notreg, id)
+
+MSG_RELEASE_MANY = 11
+#>(msg, [obj_id, ...] )
+#<(resp-success, [not-registered-id, ...])
+MSG_GET_PATH = 12
+#>(msg, remote id or None, "dotted.path") - without ID, the path starts with the module name
+#<(resp-ok, wrapped-value, flags)
+#<(resp-not-reg, id)
+#<(resp-not-found-attr, name)
+#<(resp-except, err) - module import failed
+
+MSG_RENEW_LEASE = 13
+#>(msg, )
+#<(resp-ok, lease time or None)
+
+MSG_ITERATE = 14
+#>(msg, obj_id, count, start) - start is True for the iterable object, False for the iterator, returned by the first response
+#<(resp-ok, [item, ...], more, error) - more is the iterator (first response only), True or False.
+#   error is the exception, raised by the iterator after the items, or None
+#<(resp-notreg, id) (resp-exc, exc) - iterator can't be created
+
+MSG_CALL_METHOD = 15
+#>(msg, obj_id, method name, args)
+#<(resp-ok, ans) (resp-notreg, id) (resp-nosuchattr, name) (resp-exc, exc)
+
+MSG_PREPARE = 16
+#>(msg, obj_id, struct format of the arguments, {keyword: value})
+#<(resp-ok, remote ID of the call stub) (resp-notreg, id) (resp-exc, exc) - wrong format
+MSG_INVOKE = 17
+#>(msg, stub_id, packed arguments)
+#<(resp-ok, ans) (resp-notreg, id) (resp-exc, exc)
+
+MSG_MARK_PURE = 18
+#>(msg, obj_id, cache size or None)
+#<(resp-ok, None) (resp-notreg, id) (resp-exc, exc) - not allowed
+
+MSG_NEGOTIATE = 19
+#>(msg, [codec, ...], threshold) - codecs in the order of preference; frames of threshold size and bigger are compressed
+#<(resp-ok, (codec, threshold)) - agreed codec (None, if no codec is allowed) and threshold; sent without compression
+
+MSG_GET_STATS = 20
+#>(msg, reset) - reset is True, if the counters must be cleared after reading
+#<(resp-ok, {message name: {counter: value}}) - see Metrics.snapshot; plain dict, never remoted
+
+MSG_PROFILE_START = 21
+#>(msg, scope) - PROFILE_CONNECTION or PROFILE_SERVER
+#<(resp-ok, None) (resp-exc, exc) - not allowed, already started or unknown scope
+MSG_PROFILE_STOP = 22
+#>(msg, )
+#<(resp-ok, profile) - see PythonServer.stop_profiling; plain dict, never remoted
+#<(resp-exc, exc) - not started
+
 MSG_BYE = -1 #Said by the client, before quit
 
 #Responce codes
@@ -619,3 +3932,14 @@ RESP_SUCCESS = 0
 RESP_EXCEPT = 1 #partial_success
 RESP_NOT_REGISTERED = 2 #object not registered
 RESP_NO_SUCH_ATTR = 3#Attribute requested not found
+
+ATTR_CACHEABLE = 1 #Flag of the attribute in the response to MSG_GET_ATTRIBUTE
+ATTR_PURE = 2 #Attribute is a pure function, whose results can be cached
+
+#Marshalling policies of the returned values (see PythonServer.set_policy). Integer N means BY_VALUE up to N elements.
+BY_VALUE = "value"
+BY_REFERENCE = "reference"
+
+#Scopes of the profiling (see PythonServer.start_profiling)
+PROFILE_CONNECTION = "connection" #Only requests of the connection, that started it
+PROFILE_SERVER = "server" #Requests of all connections
@@ -1,155 +1,389 @@
 #Serialization of some standard python objects
-from struct import pack, unpack
-from StringIO import StringIO
-from python_remote import RemoteObjectWrapper
+#Values are encoded into one growing bytearray, and decoded from a string or memoryview, moving the offset cursor.
+#Lengths are encoded as varints. Homogeneous lists and tuples of ints or floats are packed by one struct call.
+import struct
+import exceptions
+from struct import pack
+from python_remote import RemoteObjectWrapper, PromiseRef, UntranslatableException, OutOfBandBuffer, restore_buffer
+import python_remote
 
 TAG_NONE = "n"
 TAG_BOOL = "b"
 TAG_INT = "i"
+TAG_INT64 = "q"
 TAG_LONG = "l"
 TAG_STR = "s"
 TAG_UNICODE = "u"
 TAG_LIST = "["
 TAG_TUPLE = "("
+TAG_DICT = "{"
+TAG_SET = "<"
+TAG_FROZENSET = ">"
+TAG_BYTEARRAY = "a"
 TAG_FLOAT = "f"
 TAG_WRAPPER = 'w'
+TAG_PROMISE = 'p'
+TAG_EXCEPTION = 'e'
+TAG_BUFFER = 'B' #Out-of-band buffers are written inline
+TAG_INT_LIST = "I" #Packed lists and tuples
+TAG_INT_TUPLE = "J"
+TAG_FLOAT_LIST = "F"
+TAG_FLOAT_TUPLE = "G"
 
 HIGHEST_PROTOCOL = None
 
+PACKED_MIN_LENGTH = 8 #Shorter lists are not packed
+
+_int32 = struct.Struct( "<i" )
+_int64 = struct.Struct( "<q" )
+_float = struct.Struct( "<d" )
+
 def dump( obj, file, protocol=None ):
-    _dump(obj, file.write)
+    file.write( dumps( obj ) )
 
 def dumps( obj, protocol=None ):
-    sio = StringIO()
-    dump( obj, sio )
-    return sio.getvalue()
+    out = bytearray()
+    _dump( obj, out )
+    return str( out )
 
-def _dump( obj, write):
-    if obj is None:
-        write(TAG_NONE)
-        return
+def _dump( obj, out ):
     try:
-        dumpers[type(obj)](obj, write)
+        dumpers[type(obj)](obj, out)
     except KeyError:
         if isinstance(obj, RemoteObjectWrapper):
-            return dump_wrapper(obj, write)
+            return dump_wrapper(obj, out)
+        if isinstance(obj, PromiseRef):
+            return dump_promise(obj, out)
+        if isinstance(obj, BaseException):
+            return dump_exception(obj, out)
+        if isinstance(obj, OutOfBandBuffer):
+            return dump_buffer(obj, out)
         raise ValueError, "This type can't be searialized: %s"%(obj)
-        
-def dump_bool( x, write ):
-    write(TAG_BOOL)
-    write("1" if x else "0")
 
-def dump_int( x, write ):
-    write(TAG_INT)
-    write(pack("i",x))
+def write_varint( n, out ):
+    while n >= 0x80:
+        out.append( (n & 0x7f) | 0x80 )
+        n >>= 7
+    out.append( n )
+
+def dump_none( x, out ):
+    out += TAG_NONE
+
+def dump_bool( x, out ):
+    out += TAG_BOOL
+    out += "1" if x else "0"
+
+def dump_int( x, out ):
+    if -0x80000000 <= x < 0x80000000:
+        out += TAG_INT
+        out += _int32.pack(x)
+    elif -0x8000000000000000 <= x < 0x8000000000000000:
+        out += TAG_INT64
+        out += _int64.pack(x)
+    else:
+        dump_long( x, out )
 
-def dump_long( x, write ):
+def dump_long( x, out ):
     s = str(x)
-    write(TAG_LONG)
-    write(pack('i', len(s)))
-    write(s)
+    out += TAG_LONG
+    write_varint( len(s), out )
+    out += s
 
-def dump_str( x, write ):
-    write(TAG_STR)
-    write(pack('i',len(x)))
-    write(x)
+def dump_str( x, out ):
+    out += TAG_STR
+    write_varint( len(x), out )
+    out += x
 
-def dump_unicode( x, write ):
-    write(TAG_UNICODE)
+def dump_unicode( x, out ):
+    out += TAG_UNICODE
     xs = x.encode("utf-8")
-    write(pack('i',len(xs)))
-    write(xs)
-    
-def dump_list( x, write ):
-    write(TAG_LIST)
-    write(pack('i',len(x)))
+    write_varint( len(xs), out )
+    out += xs
+
+def dump_bytearray( x, out ):
+    out += TAG_BYTEARRAY
+    write_varint( len(x), out )
+    out += x
+
+def _dump_packed( x, out, int_tag, float_tag ):
+    """Packs homogeneous sequence of ints or floats by one struct call. Returns False, if sequence is not homogeneous"""
+    item_type = type(x[0])
+    for item in x:
+        if type(item) is not item_type:
+            return False
+    if item_type is int:
+        try:
+            data = pack( "<%dq"%len(x), *x )
+        except struct.error:
+            return False #Too big for 64 bits
+        out += int_tag
+    elif item_type is float:
+        data = pack( "<%dd"%len(x), *x )
+        out += float_tag
+    else:
+        return False
+    write_varint( len(x), out )
+    out += data
+    return True
+
+def dump_list( x, out ):
+    if len(x) >= PACKED_MIN_LENGTH and _dump_packed( x, out, TAG_INT_LIST, TAG_FLOAT_LIST ):
+        return
+    out += TAG_LIST
+    write_varint( len(x), out )
     for i in x:
-        _dump(i, write)
+        _dump(i, out)
 
-def dump_tuple( x, write ):
-    write(TAG_TUPLE)
-    write(pack('i',len(x)))
+def dump_tuple( x, out ):
+    if len(x) >= PACKED_MIN_LENGTH and _dump_packed( x, out, TAG_INT_TUPLE, TAG_FLOAT_TUPLE ):
+        return
+    out += TAG_TUPLE
+    write_varint( len(x), out )
     for i in x:
-        _dump(i, write)
+        _dump(i, out)
 
-def dump_float( x, write ):
-    write(TAG_FLOAT)
-    write(pack('d',x))
+def dump_dict( x, out ):
+    out += TAG_DICT
+    write_varint( len(x), out )
+    for key, value in x.iteritems():
+        _dump(key, out)
+        _dump(value, out)
 
-def dump_wrapper( x, write ):
-    write(TAG_WRAPPER)
-    _dump(x.remote_id, write)
+def dump_set( x, out ):
+    out += TAG_SET
+    write_varint( len(x), out )
+    for i in x:
+        _dump(i, out)
+
+def dump_frozenset( x, out ):
+    out += TAG_FROZENSET
+    write_varint( len(x), out )
+    for i in x:
+        _dump(i, out)
+
+def dump_float( x, out ):
+    out += TAG_FLOAT
+    out += _float.pack(x)
+
+def dump_wrapper( x, out ):
+    out += TAG_WRAPPER
+    _dump(x.remote_id, out)
+
+def dump_promise( x, out ):
+    out += TAG_PROMISE
+    _dump(x.slot, out)
+
+def dump_exception( x, out ):
+    """Exceptions are transferred as class name and arguments. If arguments can't be serialized, their string representation is used"""
+    cls = type(x)
+    out += TAG_EXCEPTION
+    dump_str( cls.__module__, out )
+    dump_str( cls.__name__, out )
+    args = bytearray()
+    try:
+        _dump( tuple(x.args), args )
+    except ValueError:
+        args = bytearray()
+        _dump( (str(x),), args )
+    out += args
+
+def dump_buffer( x, out ):
+    out += TAG_BUFFER
+    _dump( x.kind, out )
+    write_varint( len(x.view), out )
+    out += x.view
 
 dumpers = {
+    type(None) : dump_none,
     bool : dump_bool,
     int: dump_int,
     long : dump_long,
     str : dump_str,
     unicode : dump_unicode,
+    bytearray : dump_bytearray,
     list : dump_list,
     tuple : dump_tuple,
+    dict : dump_dict,
+    set : dump_set,
+    frozenset : dump_frozenset,
     float : dump_float
     }
 
 
 def loads( s, protocol=None ):
-    return load( StringIO(s))
+    """Decodes object from the string, buffer or memoryview"""
+    if not isinstance( s, (str, memoryview) ):
+        s = memoryview( s ) #Avoid copying buffers and bytearrays
+    try:
+        obj, pos = _load( s, 0 )
+    except (IndexError, struct.error):
+        raise ValueError, "Unexpected EOF"
+    return obj
 
 def load( file, protocol=None ):
-    return _load(file.read)
+    return loads( file.read() )
 
-def _load( read ):
-    tag = read(1)
-    if not tag: raise ValueError, "Unexpected EOF"
-    return loaders[tag](read)
+def _load( data, pos ):
+    """Decodes value, starting at the position. Returns the value and the position after it"""
+    try:
+        loader = loaders[data[pos]]
+    except KeyError:
+        raise ValueError, "Unknown tag: %r"%data[pos]
+    return loader( data, pos+1 )
 
+def _bytes( data, pos, end ):
+    """Returns string from the given part of the data"""
+    if end > len(data): raise ValueError, "Unexpected EOF"
+    s = data[pos:end]
+    if type(s) is not str:
+        s = s.tobytes()
+    return s
 
-def read_int(read):
-    d = read(4)
-    if len(d)!=4: raise ValueError, "Unexpected EOF"
-    return unpack('i', d )[0]
+def read_varint( data, pos ):
+    b = ord(data[pos])
+    if b < 0x80:
+        return b, pos+1
+    n = 0
+    shift = 0
+    while b >= 0x80:
+        n |= (b & 0x7f) << shift
+        shift += 7
+        pos += 1
+        b = ord(data[pos])
+    return n | (b << shift), pos+1
 
-load_int = read_int
+def load_none( data, pos ):
+    return None, pos
 
-def load_long( read ):
-    return long(load_str(read))
+def load_int( data, pos ):
+    return _int32.unpack_from( data, pos )[0], pos+4
 
-def load_float( read ):
-    d = read(8)
-    if len(d)!=8: raise ValueError, "Unexpected EOF"
-    return unpack( 'd', d )[0]
-    
-def load_str( read ):
-    l = read_int(read)
-    s = read(l)
-    if len(s) != l: raise ValueError, "Unexpected EOF"
-    return s
+def load_int64( data, pos ):
+    return _int64.unpack_from( data, pos )[0], pos+8
+
+def load_long( data, pos ):
+    s, pos = load_str( data, pos )
+    return long(s), pos
+
+def load_float( data, pos ):
+    return _float.unpack_from( data, pos )[0], pos+8
+
+def load_str( data, pos ):
+    l, pos = read_varint( data, pos )
+    return _bytes( data, pos, pos+l ), pos+l
+
+def load_unicode( data, pos ):
+    s, pos = load_str( data, pos )
+    return s.decode("utf-8"), pos
+
+def load_bytearray( data, pos ):
+    l, pos = read_varint( data, pos )
+    if pos+l > len(data): raise ValueError, "Unexpected EOF"
+    return bytearray( data[pos:pos+l] ), pos+l
+
+def load_list( data, pos ):
+    l, pos = read_varint( data, pos )
+    items = []
+    append = items.append
+    for idx in xrange(l):
+        item, pos = _load( data, pos )
+        append( item )
+    return items, pos
 
-def load_unicode( read ):
-    return load_str(read).decode("utf-8")
+def load_tuple( data, pos ):
+    items, pos = load_list( data, pos )
+    return tuple(items), pos
 
-def load_list( read ):
-    l = read_int(read)
-    return [_load(read) for idx in xrange(l)]
+def _load_packed( data, pos, code, size ):
+    l, pos = read_varint( data, pos )
+    end = pos + l*size
+    if end > len(data): raise ValueError, "Unexpected EOF"
+    return struct.unpack_from( "<%d%s"%(l, code), data, pos ), end
 
-def load_tuple( read ):
-    return tuple(load_list(read))
+def load_int_list( data, pos ):
+    items, pos = _load_packed( data, pos, "q", 8 )
+    return list(items), pos
 
-def load_bool(read):
-    return read(1)=='1'
+def load_int_tuple( data, pos ):
+    return _load_packed( data, pos, "q", 8 )
+
+def load_float_list( data, pos ):
+    items, pos = _load_packed( data, pos, "d", 8 )
+    return list(items), pos
+
+def load_float_tuple( data, pos ):
+    return _load_packed( data, pos, "d", 8 )
+
+def load_dict( data, pos ):
+    l, pos = read_varint( data, pos )
+    d = {}
+    for idx in xrange(l):
+        key, pos = _load( data, pos )
+        d[key], pos = _load( data, pos )
+    return d, pos
+
+def load_set( data, pos ):
+    items, pos = load_list( data, pos )
+    return set(items), pos
+
+def load_frozenset( data, pos ):
+    items, pos = load_list( data, pos )
+    return frozenset(items), pos
+
+def load_bool( data, pos ):
+    return data[pos]=='1', pos+1
+
+def load_wrapper( data, pos ):
+    remote_id, pos = _load( data, pos )
+    return RemoteObjectWrapper(remote_id), pos
+
+def load_promise( data, pos ):
+    slot, pos = _load( data, pos )
+    return PromiseRef(slot), pos
+
+def load_exception( data, pos ):
+    """Restores standard exceptions and exceptions of python_remote, other are converted to UntranslatableException"""
+    module, pos = _load( data, pos )
+    name, pos = _load( data, pos )
+    args, pos = _load( data, pos )
+    cls = None
+    if module == "exceptions":
+        cls = getattr( exceptions, name, None )
+    elif module == python_remote.__name__:
+        cls = getattr( python_remote, name, None )
+    if not (isinstance( cls, type ) and issubclass( cls, BaseException )):
+        return UntranslatableException( "%s.%s"%(module, name), args ), pos
+    try:
+        return cls( *args ), pos
+    except Exception:
+        return UntranslatableException( "%s.%s"%(module, name), args ), pos
 
-def load_wrapper(read):
-    return RemoteObjectWrapper(_load(read))
+def load_buffer( data, pos ):
+    kind, pos = _load( data, pos )
+    value, pos = load_bytearray( data, pos )
+    return restore_buffer( kind, value ), pos
 
 loaders={
-    TAG_NONE: lambda x: None,
+    TAG_NONE: load_none,
     TAG_INT: load_int,
+    TAG_INT64: load_int64,
     TAG_LONG: load_long,
     TAG_FLOAT: load_float,
     TAG_BOOL: load_bool,
     TAG_STR: load_str,
     TAG_UNICODE: load_unicode,
+    TAG_BYTEARRAY: load_bytearray,
     TAG_LIST: load_list,
     TAG_TUPLE: load_tuple,
-    TAG_WRAPPER: load_wrapper
+    TAG_DICT: load_dict,
+    TAG_SET: load_set,
+    TAG_FROZENSET: load_frozenset,
+    TAG_INT_LIST: load_int_list,
+    TAG_INT_TUPLE: load_int_tuple,
+    TAG_FLOAT_LIST: load_float_list,
+    TAG_FLOAT_TUPLE: load_float_tuple,
+    TAG_WRAPPER: load_wrapper,
+    TAG_PROMISE: load_promise,
+    TAG_EXCEPTION: load_exception,
+    TAG_BUFFER: load_buffer
     }
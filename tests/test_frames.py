@@ -0,0 +1,110 @@
+"""Round-trip tests of the framing: make_frames on the sending side, FrameReader on the receiving side.
+Run from the root of the repository: python -m unittest discover tests
+"""
+import sys
+import os
+import unittest
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+from python_remote import make_frames, encode_message, FrameReader, Compression, OutOfBandBuffer, \
+    FRAME_HEADER, FRAME_HEADER_SIZE, FRAME_BUFFER_FLAG, FRAME_COMPRESSED_FLAG, FRAME_SIZE_MASK, SMALL_FRAME_SIZE
+
+def headers( frames ):
+    """Returns list of (size, buffer flag, compressed flag) of the frames, sent as the list of data"""
+    data = "".join( map( str, frames ) )
+    result = []
+    offset = 0
+    while offset < len( data ):
+        header, = FRAME_HEADER.unpack_from( data, offset )
+        size = header & FRAME_SIZE_MASK
+        result.append( (size, bool( header & FRAME_BUFFER_FLAG ), bool( header & FRAME_COMPRESSED_FLAG )) )
+        offset += FRAME_HEADER_SIZE + size
+    return result
+
+class ChunkSocket:
+    """Non-blocking socket, that returns the data by the chunks of the given size"""
+    def __init__( self, data, chunk_size ):
+        self.data = data
+        self.offset = 0
+        self.chunk_size = chunk_size
+
+    def recv( self, size ):
+        chunk = self.data[ self.offset : self.offset + min( size, self.chunk_size ) ]
+        self.offset += len( chunk )
+        return chunk
+
+    def recv_into( self, view ):
+        chunk = self.recv( len( view ) )
+        view[ 0:len( chunk ) ] = chunk
+        return len( chunk )
+
+def round_trip( message, compression=None, chunk_size=None ):
+    """Encodes the message, passes its frames to the FrameReader (by chunks, if given) and returns the decoded messages"""
+    data = "".join( map( str, make_frames( *encode_message( message ), compression=compression ) ) )
+    reader = FrameReader()
+    sock = ChunkSocket( data, chunk_size or len( data ) )
+    messages = []
+    while sock.offset < len( data ):
+        messages.extend( reader.receive( sock ) )
+    return [ decoded for decoded, size, decode_time in messages ]
+
+class FrameTest( unittest.TestCase ):
+    def test_small_frame( self ):
+        data, buffers = encode_message( (1, (2, "abc")) )
+        frames = make_frames( data, buffers )
+        self.assertEqual( len( frames ), 1 ) #Header is joined with the small message
+        self.assertEqual( headers( frames ), [ (len( data ), False, False) ] )
+        self.assertEqual( round_trip( (1, (2, "abc")) ), [ (1, (2, "abc")) ] )
+
+    def test_big_frame( self ):
+        message = (1, range( SMALL_FRAME_SIZE ))
+        data, buffers = encode_message( message )
+        frames = make_frames( data, buffers )
+        self.assertEqual( len( frames ), 2 ) #Big message is not copied to join it with the header
+        self.assertEqual( headers( frames ), [ (len( data ), False, False) ] )
+        self.assertEqual( round_trip( message, chunk_size=1000 ), [ message ] )
+
+    def test_out_of_band_buffers( self ):
+        first, second = "x" * 70000, bytearray( "y" * 80000 )
+        message = (1, (OutOfBandBuffer( first ), 2, OutOfBandBuffer( second )))
+        data, buffers = encode_message( message )
+        self.assertEqual( headers( make_frames( data, buffers ) ),
+                          [ (len( first ), True, False), (len( second ), True, False), (len( data ), False, False) ] )
+        for chunk_size in (None, 4096):
+            decoded, = round_trip( message, chunk_size=chunk_size )
+            self.assertEqual( decoded, (1, (first, 2, second)) )
+            self.assertEqual( type( decoded[1][0] ), str )
+            self.assertEqual( type( decoded[1][2] ), bytearray )
+
+    def test_compression( self ):
+        compression = Compression( "zlib", 1024 )
+        message = (1, ("abc" * 1000, OutOfBandBuffer( "z" * 100000 ), "short"))
+        data, buffers = encode_message( message )
+        flags = headers( make_frames( data, buffers, compression ) )
+        self.assertEqual( [ (is_buffer, compressed) for size, is_buffer, compressed in flags ], [ (True, True), (False, True) ] )
+        self.assertTrue( flags[0][0] < 100000 )
+        self.assertEqual( round_trip( message, compression ), [ (1, ("abc" * 1000, "z" * 100000, "short")) ] )
+        #Small frames are not compressed
+        self.assertEqual( headers( make_frames( "x" * 100, (), compression ) ), [ (100, False, False) ] )
+
+    def test_several_messages( self ):
+        messages = [ (i, ("item", i)) for i in xrange( 100 ) ]
+        data = "".join( [ "".join( map( str, make_frames( *encode_message( message ) ) ) ) for message in messages ] )
+        reader = FrameReader()
+        received = []
+        for offset in xrange( 0, len( data ), 7 ): #Headers are split between the chunks too
+            received.extend( [ decoded for decoded, size, decode_time in reader.feed( data[ offset : offset + 7 ] ) ] )
+        self.assertEqual( received, messages )
+
+    def test_too_big( self ):
+        mask = python_remote.FRAME_SIZE_MASK
+        python_remote.FRAME_SIZE_MASK = 1000 #Length would spill into the flags
+        try:
+            self.assertRaises( ValueError, make_frames, "x" * 1001, () )
+            self.assertRaises( ValueError, make_frames, "x", (buffer( "y" * 1001 ),) )
+            make_frames( "x" * 1000, () )
+        finally:
+            python_remote.FRAME_SIZE_MASK = mask
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Round-trip tests of the remote objects: the server must forget every object, that the client has released.
+Run from the root of the repository: python -m unittest discover tests
+"""
+import sys
+import os
+import time
+import tempfile
+import threading
+import unittest
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+from python_remote import PythonServer, FarSide
+
+class ServerTestCase( unittest.TestCase ):
+    """Runs multithreaded server in this process, so that its registry can be inspected"""
+    def setUp( self ):
+        url = "unix://%s"%os.path.join( tempfile.gettempdir(), "python_remote_test%d.sock"%os.getpid() )
+        self.server = PythonServer( url, multithread=True )
+        self.server.start( blocking=False )
+        self.executor = threading.Thread( target=self._execute )
+        self.executor.daemon = True
+        self.executor.start()
+        self.far_side = FarSide( url )
+
+    def _execute( self ):
+        server = self.server
+        while not server.stop_requested:
+            server.process_pending( 0.1 )
+
+    def tearDown( self ):
+        if self.far_side.channel is not None:
+            self.far_side.close()
+        self.server.stop()
+        self.executor.join( 5 )
+
+    def sync( self ):
+        """Sends queued releases and waits, until the server has processed them"""
+        self.far_side.flush_releases()
+        self.far_side.renew_lease().result()
+
+class ObjectCountTest( ServerTestCase ):
+    def test_partly_failed_call_many( self ):
+        rlist = self.far_side.import_module( "__builtin__" ).list
+        self.sync()
+        count = len( self.server.objects )
+        #list( 5 ) fails: lists, returned by the other calls, must be released anyway
+        self.assertRaises( TypeError, self.far_side.call_many, rlist, [ ((1,),), (5,), ((2,),), ((3,),) ] )
+        self.sync()
+        self.assertEqual( len( self.server.objects ), count )
+
+    def test_release( self ):
+        rbuiltins = self.far_side.import_module( "__builtin__" )
+        rlist, rmax = rbuiltins.list, rbuiltins.max
+        self.sync()
+        count = len( self.server.objects )
+        lists = [ rlist( (i,) ) for i in xrange( 100 ) ]
+        again = rmax( (lists[1],) ) #Same object, returned twice: server counts both references
+        self.assertTrue( again is lists[1] )
+        self.sync()
+        self.assertEqual( len( self.server.objects ), count + 100 )
+        del lists, again
+        self.sync()
+        self.assertEqual( len( self.server.objects ), count )
+
+    def test_release_on_close( self ):
+        lists = [ self.far_side.import_module( "__builtin__" ).list( (i,) ) for i in xrange( 10 ) ]
+        self.assertTrue( len( self.server.objects ) > 0 )
+        self.far_side.close()
+        for i in xrange( 50 ): #Connection is forgotten by the executing thread
+            if not len( self.server.objects ):
+                break
+            time.sleep( 0.02 )
+        self.assertEqual( len( self.server.objects ), 0 )
+
+    def test_failed_batch( self ):
+        rlist = self.far_side.import_module( "__builtin__" ).list
+        self.sync()
+        count = len( self.server.objects )
+        deferred = self.far_side.defer( rlist )
+        promises = [ deferred( (1,) ), deferred( 5 ), deferred( (2,) ) ]
+        self.assertRaises( TypeError, promises[1]._force_ )
+        del promises, deferred
+        self.sync()
+        self.assertEqual( len( self.server.objects ), count )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""Round-trip tests of the simple_pickle codec.
+Run from the root of the repository: python -m unittest discover tests
+"""
+import sys
+import os
+import array
+import unittest
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+import python_remote
+import simple_pickle
+from python_remote import RemoteObjectWrapper, PromiseRef, OutOfBandBuffer, UntranslatableException, UnknownObjectError
+
+VALUES = [ None, True, False, 0, 1, -1, 2**31 - 1, -2**31, 2**31, 2**63 - 1, -2**63, 2**100, -2**100, 0L,
+           0.0, -1.5, 1e300, float( "inf" ),
+           "", "abc", "\x00\xff" * 100, u"", u"text \u044e\u043d\u0438",
+           bytearray( "bytes" ), (), (1,), [], [ 1, 2, 3 ], range( 1000 ), tuple( range( 1000 ) ),
+           [ 2**40, 1 ], [ i * 0.5 for i in xrange( 100 ) ], (0.5, 1.5), [ 1, 0.5 ], [ 1, "a", None ],
+           {}, { "a": 1, 2: (3, 4), (5, "b"): [ 6 ] }, set(), set( [ 1, "a" ] ), frozenset( [ (1, 2) ] ),
+           [ { "id": i, "tags": ("a", "b"), "items": [ i, [ i ] ] } for i in xrange( 10 ) ] ]
+
+class SimplePickleTest( unittest.TestCase ):
+    def test_values( self ):
+        for value in VALUES:
+            restored = simple_pickle.loads( simple_pickle.dumps( value ) )
+            self.assertEqual( restored, value )
+            self.assertEqual( type( restored ), type( value ), value )
+
+    def test_nested_types( self ):
+        restored = simple_pickle.loads( simple_pickle.dumps( ([ (1,), [ 2 ] ], { "x": (u"y", 3L) }) ) )
+        self.assertEqual( type( restored[0][0] ), tuple )
+        self.assertEqual( type( restored[0][1] ), list )
+        self.assertEqual( type( restored[1][ "x" ][0] ), unicode )
+        self.assertEqual( type( restored[1][ "x" ][1] ), long )
+
+    def test_buffer_input( self ):
+        data = simple_pickle.dumps( (1, "abc", [ 2.5 ]) )
+        for wrapped in (buffer( data ), bytearray( data ), memoryview( data )):
+            self.assertEqual( simple_pickle.loads( wrapped ), (1, "abc", [ 2.5 ]) )
+
+    def test_protocol_objects( self ):
+        wrapper, ref = simple_pickle.loads( simple_pickle.dumps( (RemoteObjectWrapper( 12345 ), PromiseRef( 7 )) ) )
+        self.assertTrue( isinstance( wrapper, RemoteObjectWrapper ) )
+        self.assertEqual( wrapper.remote_id, 12345 )
+        self.assertTrue( isinstance( ref, PromiseRef ) )
+        self.assertEqual( ref.slot, 7 )
+
+    def test_out_of_band_buffers( self ):
+        values = [ "x" * 100, bytearray( "y" * 100 ), array.array( "d", [ 1.5, 2.5 ] ) ]
+        restored = simple_pickle.loads( simple_pickle.dumps( map( OutOfBandBuffer, values ) ) )
+        self.assertEqual( restored, values )
+        self.assertEqual( map( type, restored ), map( type, values ) )
+
+    def test_exceptions( self ):
+        error = simple_pickle.loads( simple_pickle.dumps( ValueError( "bad", 1 ) ) )
+        self.assertEqual( type( error ), ValueError )
+        self.assertEqual( error.args, ("bad", 1) )
+        error = simple_pickle.loads( simple_pickle.dumps( UnknownObjectError( 5 ) ) )
+        self.assertEqual( type( error ), UnknownObjectError )
+        #Arbitrary classes are never created from the received data
+        error = simple_pickle.loads( simple_pickle.dumps( unittest.SkipTest( "skip" ) ) )
+        self.assertTrue( isinstance( error, UntranslatableException ) )
+        #Arguments, that can not be serialized, are replaced by the string
+        error = simple_pickle.loads( simple_pickle.dumps( KeyError( object() ) ) )
+        self.assertEqual( type( error ), KeyError )
+        self.assertEqual( type( error.args[0] ), str )
+
+    def test_errors( self ):
+        self.assertRaises( ValueError, simple_pickle.dumps, object() )
+        data = simple_pickle.dumps( (1, "abc") )
+        self.assertRaises( ValueError, simple_pickle.loads, data[:-1] )
+        self.assertRaises( ValueError, simple_pickle.loads, "\x01" )
+
+    def test_codec_of_the_messages( self ):
+        message = (3, (python_remote.MSG_CALL, 10, (1, OutOfBandBuffer( "z" * 70000 ), [ 0.5 ])))
+        python_remote.set_codec( "simple_pickle" )
+        try:
+            data, buffers = python_remote.encode_message( message )
+            self.assertEqual( buffers, () ) #Buffers are written inline
+            self.assertEqual( python_remote.decode_buffer( data ), (3, (python_remote.MSG_CALL, 10, (1, "z" * 70000, [ 0.5 ]))) )
+        finally:
+            python_remote.set_codec( "cPickle" )
+
+if __name__ == "__main__":
+    unittest.main()